@@ -0,0 +1,277 @@
+import json
+import sys
+import numpy as np
+
+from timeline import TrackTimeline
+
+'''Aligning a track's timeline with a recording.
+
+A TrackTimeline follows the written tempo exactly, recordings don't.  Given times from the
+recording (note onsets, beats or bars, from an audio analysis or a JSON fixture), the matching
+times of the tab (see grid_times) are aligned to them, notes by dynamic time warping in a band
+around the tab stretched over the recording, beats and bars by counting grid steps at the local
+tempo, and every beat onset is moved by piecewise linear interpolation between the matched
+pairs.
+
+Onset fixtures are JSON: a list of seconds, or an object with one of the lists in ONSET_KEYS,
+of seconds or of {"start": seconds, ...} (the form of an audio analysis's beats, bars, tatums
+and segments).
+
+    python alignment.py SONG ONSETS.json [track]      how far the tab drifts, before and after
+'''
+
+MIN_INTERVAL = 0.001  # Seconds, gaps are clipped to this before taking logs.
+DRIFT_COST = 0.002  # Per typical gap between recorded times, from a stretched tab time.
+STEP_PENALTY = 1.0  # For DTW steps that skip a time on one side.
+BAND = 0.05  # DTW compares times within this fraction of the recording's length,
+BAND_SECONDS = 10.0  # or within this many seconds,
+BAND_MIN_WIDTH = 8  # and always this many recorded times either side of the nearest one.
+STEP_WINDOW = 8  # Matches the local tempo of an even grid is taken over, see step_anchors.
+
+# Fixture keys and the tab times they are matched with, in the order they're looked for.
+ONSET_KEYS = {"onsets": "notes", "segments": "notes", "tatums": "notes", "beats": "beats",
+              "bars": "measures"}
+
+
+def load_onsets(path, key=None):
+    '''(times, grid) from a JSON fixture, grid is what to match them with (see grid_times).'''
+    with open(path) as file:
+        data = json.load(file)
+    grid = "notes"
+    if isinstance(data, dict):
+        if key is None:
+            key = next((key for key in ONSET_KEYS if key in data), None)
+            if key is None:
+                raise ValueError("{}: no onset list, expected one of {}".format(
+                    path, ", ".join(ONSET_KEYS)))
+        grid = ONSET_KEYS.get(key, grid)
+        data = data[key]
+    times = [item["start"] if isinstance(item, dict) else item for item in data]
+    return np.sort(np.array(times, dtype=np.float64)), grid
+
+
+def grid_times(timeline, grid="notes", numerators=None):
+    '''Times of the tab to match with the recording's.
+
+    "notes": onsets of beats that play something.  "measures": measure starts.  "beats": each
+    measure split evenly into numerators[m] beats (the time signature numerators, one per
+    measure).
+    '''
+    if grid == "notes":
+        return timeline.onsets[timeline.pc_masks != 0]
+    measure_onsets = timeline.measure_onsets
+    if grid == "measures":
+        return measure_onsets[:-1]
+    if grid == "beats":
+        numerators = np.asarray(numerators)
+        lengths = np.diff(measure_onsets)
+        measures = np.repeat(np.arange(len(numerators)), numerators)
+        first_beats = np.cumsum(numerators) - numerators
+        beat_in_measure = np.arange(len(measures)) - first_beats[measures]
+        return (measure_onsets[measures]
+                + lengths[measures] * beat_in_measure / numerators[measures])
+    raise ValueError("unknown grid {!r}".format(grid))
+
+
+def dtw(row_cost, lo, hi, step_penalty=0.0):
+    '''Minimum cost warping path through an N by M cost matrix, as (i, j) index arrays from
+    (0, 0) to (N-1, M-1).  step_penalty is added for every step that isn't diagonal.
+
+    Only a band is filled: row i covers columns lo[i] to hi[i] - 1, and row_cost(i, j) gives the
+    cost of row i at columns j.  Both bounds must not go down from row to row, and each row has to
+    start no later than the one before ends (lo[i + 1] <= hi[i]) for there to be a path.
+
+    A row's cells depend on the row before (diagonal and up steps) and on the cell to their left,
+    the left steps are a running minimum, so each row is a few vector operations.  Only the step
+    taken into each cell is kept for the backtrack, one byte a cell of the band.
+    '''
+    n = len(lo)
+    steps = []  # Per row, 0 diagonal, 1 up, 2 left.
+    previous, previous_lo, previous_hi = None, 0, 0
+    for i in range(n):
+        j = np.arange(lo[i], hi[i])
+        cost = row_cost(i, j)
+        if previous is None:
+            # Only (0, 0) can be reached from the start.
+            arrive = np.where(j == 0, 0.0, np.inf)
+            step = np.zeros(len(j), dtype=np.int8)
+        else:
+            up = np.full(len(j), np.inf)
+            diagonal = np.full(len(j), np.inf)
+            inside = (j >= previous_lo) & (j < previous_hi)
+            up[inside] = previous[j[inside] - previous_lo]
+            inside = (j - 1 >= previous_lo) & (j - 1 < previous_hi)
+            diagonal[inside] = previous[j[inside] - 1 - previous_lo]
+            step = (up + step_penalty < diagonal).astype(np.int8)
+            arrive = np.minimum(diagonal, up + step_penalty)
+        # total[k] = cost[k] + min(arrive[k], total[k - 1] + step_penalty), unrolled:
+        # total[k] = sums[k] + k p + min over m <= k of (arrive[m] - sums[m - 1] - m p).
+        sums = np.cumsum(cost)
+        k = np.arange(len(j)) * step_penalty
+        best = np.minimum.accumulate(arrive - (sums - cost) - k)
+        total = sums + k + best
+        left = np.zeros(len(j), dtype=bool)
+        left[1:] = total[:-1] + step_penalty < arrive[1:]
+        step[left] = 2
+        steps.append(step)
+        previous, previous_lo, previous_hi = total, lo[i], hi[i]
+
+    path = []
+    i, j = n - 1, hi[-1] - 1
+    while True:
+        path.append((i, j))
+        if i == 0 and j == 0:
+            break
+        step = steps[i][j - lo[i]]
+        if step != 2:
+            i -= 1
+        if step != 1:
+            j -= 1
+    path = np.array(path[::-1])
+    return path[:, 0], path[:, 1]
+
+
+def band(stretched, recorded, seconds, min_width=BAND_MIN_WIDTH):
+    '''(lo, hi) DTW band for matching times near their stretched tab times: the recorded times
+    within seconds of each, and at least min_width either side of the nearest one.'''
+    m = len(recorded)
+    nearest = np.searchsorted(recorded, stretched)
+    lo = np.minimum(np.searchsorted(recorded, stretched - seconds), nearest - min_width)
+    hi = np.maximum(np.searchsorted(recorded, stretched + seconds, side="right"),
+                    nearest + min_width)
+    lo = np.maximum.accumulate(np.clip(lo, 0, m))
+    hi = np.maximum.accumulate(np.clip(hi, 1, m))
+    lo[0], hi[-1] = 0, m
+    lo[1:] = np.minimum(lo[1:], hi[:-1])
+    return lo, np.maximum(hi, lo + 1)
+
+
+def _log_intervals(times):
+    '''log of the gaps before and after each time (the first and last are repeated).'''
+    gaps = np.log(np.maximum(np.diff(times), MIN_INTERVAL))
+    if not len(gaps):
+        gaps = np.zeros(1)
+    return np.concatenate((gaps[:1], gaps)), np.concatenate((gaps, gaps[-1:]))
+
+
+def anchors(reference, recorded):
+    '''Matched (reference times, recorded times), both strictly increasing.
+
+    The reference is stretched over the recording's span, then times are compared by the gaps
+    around them (log inter-onset intervals, so it's the rhythm that has to match, not the
+    absolute time that drifts) with a DRIFT_COST per typical gap of distance, which is all that
+    tells times apart in runs of even notes, beats or bars.  Only times within BAND of each
+    other are compared.  Where DTW matches several times on one side to a single time on the
+    other (missed or extra onsets), only the first pair is kept.
+    '''
+    reference = np.asarray(reference, dtype=np.float64)
+    recorded = np.asarray(recorded, dtype=np.float64)
+    span = reference[-1] - reference[0]
+    recorded_span = recorded[-1] - recorded[0]
+    scale = recorded_span / span if span > 0 else 1.0
+    stretched = recorded[0] + (reference - reference[0]) * scale
+    (ref_before, ref_after), (rec_before, rec_after) = (_log_intervals(stretched),
+                                                        _log_intervals(recorded))
+    gaps = np.diff(recorded)
+    drift_cost = DRIFT_COST / max(np.median(gaps) if len(gaps) else 1.0, MIN_INTERVAL)
+
+    def row_cost(i, j):
+        return (np.abs(ref_before[i] - rec_before[j]) + np.abs(ref_after[i] - rec_after[j])
+                + drift_cost * np.abs(stretched[i] - recorded[j]))
+
+    lo, hi = band(stretched, recorded, max(BAND * recorded_span, BAND_SECONDS))
+    i, j = dtw(row_cost, lo, hi, STEP_PENALTY)
+    keep = np.ones(len(i), dtype=bool)
+    keep[1:] = (np.diff(i) > 0) & (np.diff(j) > 0)
+    return reference[i[keep]], recorded[j[keep]]
+
+
+def step_anchors(reference, recorded, window=STEP_WINDOW):
+    '''Matched (reference times, recorded times) for grids of even steps, beats or bars.
+
+    Every gap of such a grid looks the same, so comparing rhythm (as anchors does) can't tell
+    where a dropped or extra time is, and the stretched tab can be whole steps off after some
+    tempo wander.  Instead times are counted: starting from both first times, each recorded gap
+    is matched with the number of grid steps closest to it at the local tempo (the median ratio
+    of recorded to tab gaps over the last window matches), so a dropped time is a gap of two
+    steps.  A gap under half a step is an extra time and is skipped.
+    '''
+    reference = np.asarray(reference, dtype=np.float64)
+    recorded = np.asarray(recorded, dtype=np.float64)
+    span = reference[-1] - reference[0]
+    ratios = [(recorded[-1] - recorded[0]) / span if span > 0 else 1.0]
+    i, last = 0, recorded[0]
+    ref, rec = [reference[0]], [recorded[0]]
+    for time in recorded[1:].tolist():
+        if i == len(reference) - 1:
+            break
+        ahead = reference[i + 1:i + 1 + window] - reference[i]
+        expected = np.maximum(ahead * np.median(ratios[-window:]), MIN_INTERVAL)
+        gap = time - last
+        if gap < 0.5 * expected[0]:
+            continue
+        steps = int(np.argmin(np.abs(np.log(gap / expected)))) + 1
+        ratios.append(gap / max(ahead[steps - 1], MIN_INTERVAL))
+        i += steps
+        last = time
+        ref.append(reference[i])
+        rec.append(time)
+    return np.array(ref), np.array(rec)
+
+
+def warp_times(times, reference, recorded, even=False):
+    '''times moved from the reference's clock to the recording's, linearly between anchors and
+    at the written tempo before the first and after the last.  even is for grids of even steps,
+    matched by step_anchors rather than anchors.'''
+    ref, rec = (step_anchors if even else anchors)(reference, recorded)
+    times = np.asarray(times, dtype=np.float64)
+    warped = np.interp(times, ref, rec)
+    warped = np.where(times < ref[0], times - ref[0] + rec[0], warped)
+    return np.where(times > ref[-1], times - ref[-1] + rec[-1], warped)
+
+
+def warp_timeline(timeline, recorded, grid="notes", numerators=None):
+    '''TrackTimeline with its onsets (and beat lengths) moved onto the recorded times.'''
+    reference = grid_times(timeline, grid, numerators)
+    if not len(reference) or not len(recorded):
+        raise ValueError("nothing to align, {} tab and {} recorded times".format(
+            len(reference), len(recorded)))
+    ends = warp_times(np.append(timeline.onsets, timeline.length), reference, recorded,
+                      even=grid != "notes")
+    return TrackTimeline(np.diff(ends), timeline.frets, timeline.pitches, timeline.pc_masks,
+                         timeline.measure_starts, timeline.measure_numbers, ends[:-1],
+                         timeline.ties)
+
+
+def drift(timeline, recorded, grid="notes", numerators=None):
+    '''Seconds between each recorded time and the nearest tab time.'''
+    reference = np.sort(grid_times(timeline, grid, numerators))
+    nearest = np.clip(np.searchsorted(reference, recorded), 1, len(reference) - 1)
+    return np.minimum(np.abs(recorded - reference[nearest - 1]),
+                      np.abs(recorded - reference[nearest]))
+
+
+def main(argv):
+    if len(argv) in (2, 3):
+        import time
+        from gp_to_kivy import KivySongBuilder
+        song = KivySongBuilder(argv[0])
+        track_num = int(argv[2]) - 1 if len(argv) == 3 else 0
+        recorded, grid = load_onsets(argv[1])
+        start = time.perf_counter()
+        warped = song.align_track(track_num, recorded, grid)
+        seconds = time.perf_counter() - start
+        numerators = song.time_signature_numerators(track_num)
+        for name, timeline in (("written", song.timelines[track_num]), ("aligned", warped)):
+            error = drift(timeline, recorded, grid, numerators)
+            print("{}: median {:.3f} s, max {:.3f} s from the recording, ends at {:.2f} s".format(
+                name, np.median(error), error.max(), timeline.length))
+        print("{} tab and {} recorded {} times aligned in {:.0f} ms".format(
+            len(grid_times(song.timelines[track_num], grid, numerators)), len(recorded), grid,
+            seconds * 1000))
+    else:
+        print("python alignment.py SONG ONSETS.json [track]")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,68 @@
+'''Time to first frame of FretlessApp and PyFiGUItarOutApp.
+
+Each run is a fresh interpreter so imports aren't cached:
+
+    python bench_startup.py [runs]
+
+Reports the median, over runs, of the time from starting the process to importing the app
+module and to the first window flip.
+'''
+import os
+import subprocess
+import statistics
+import sys
+import time
+
+apps = [("fretless", "FretlessApp"), ("kivy_app", "PyFiGUItarOutApp")]
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Runs in the child process.  argv: module, app class, time.time() when the parent started it.
+child = '''
+import os, sys, time
+module, app_name, spawned = sys.argv[1], sys.argv[2], float(sys.argv[3])
+app_module = __import__(module)
+imported = time.time()
+from kivy.base import EventLoop
+
+App = getattr(app_module, app_name)
+
+class Timed(App):
+    def on_start(self):
+        EventLoop.window.bind(on_flip=self.first_frame)
+
+    def first_frame(self, *args):
+        print(imported - spawned, time.time() - spawned, flush=True)
+        EventLoop.window.unbind(on_flip=self.first_frame)
+        self.stop()
+
+# Same kv file as the real app.
+Timed.kv_file = os.path.join(os.path.dirname(os.path.abspath(app_module.__file__)),
+                             App.__name__[:-3].lower() + ".kv")
+Timed().run()
+'''
+
+
+def time_app(module, app_name):
+    args = [sys.executable, "-c", child, module, app_name, str(time.time())]
+    env = dict(os.environ, KIVY_NO_ARGS="1", KIVY_NO_CONSOLELOG="1")
+    result = subprocess.run(args, capture_output=True, text=True, cwd=here, env=env)
+    lines = result.stdout.split()
+    if result.returncode or len(lines) < 2:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else
+                           "{} exited with {}".format(module, result.returncode))
+    return float(lines[-2]), float(lines[-1])
+
+
+def main(runs=5):
+    for module, app_name in apps:
+        imports, first_frames = [], []
+        for i in range(runs):
+            imported, first_frame = time_app(module, app_name)
+            imports.append(imported)
+            first_frames.append(first_frame)
+        print("{:<18} import {:6.3f}s  first frame {:6.3f}s  (median of {})".format(
+            app_name, statistics.median(imports), statistics.median(first_frames), runs))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
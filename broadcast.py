@@ -0,0 +1,243 @@
+import asyncio
+import json
+import socket
+import sys
+import time
+
+'''Headless playback that drives many remote fretboards.
+
+A BeatBroadcaster plays a TrackTimeline on the asyncio clock and sends every beat, as a line of
+JSON over TCP, to every connected client.  Each event is timestamped with the wall clock time
+(time.time()) it should be shown at and sent lead seconds early, so clients can schedule it
+instead of drawing it when it arrives.
+
+Every client has its own bounded queue.  A client that can't keep up only blocks its own writer;
+when its queue is full the oldest event is dropped, the newest always gets through.
+
+    python broadcast.py serve song.gp5 [port]   play track 1 to whoever connects
+    python broadcast.py demo [clients]          run against local stand-in clients
+
+Events:
+
+    {"type": "hello", "server_time": t}
+    {"type": "start", "at": t, "tuning": [64, 59, ...], "key": [root pc, "Major"]}
+    {"type": "beat", "beat": i, "at": t, "seconds": s, "frets": [fret or -1 per string]}
+    {"type": "end", "at": t}
+'''
+
+HOST, PORT = "127.0.0.1", 8765
+
+
+def encode(event):
+    return json.dumps(event, separators=(",", ":")).encode() + b"\n"
+
+
+class _Client:
+    def __init__(self, writer, queue_size):
+        self.writer = writer
+        self.queue = asyncio.Queue(queue_size)
+        self.dropped = 0
+
+    def put(self, line):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(line)
+
+    async def send(self):
+        # drain() is the backpressure: it waits while the socket buffer is full, meanwhile put()
+        # keeps the queue at the newest queue_size events.
+        while True:
+            line = await self.queue.get()
+            if line is None:
+                break
+            self.writer.write(line)
+            await self.writer.drain()
+
+
+class BeatBroadcaster:
+    '''Serve one track of a song to any number of TCP clients.
+
+        broadcaster = BeatBroadcaster(song.timelines[0], tuning, song.detected_key_sig)
+        await broadcaster.start()
+        await broadcaster.play()
+    '''
+    def __init__(self, timeline, tuning=None, key_sig=None, host=HOST, port=PORT, lead=0.5,
+                 queue_size=64, send_buffer=None):
+        self.timeline = timeline
+        self.tuning = tuning
+        self.key_sig = key_sig
+        self.host, self.port = host, port
+        self.lead = lead
+        self.queue_size = queue_size
+        # Bytes a client can have in the socket before its queue starts dropping events.  The
+        # OS default can hold seconds of stale beats, set it to bound how late a slow client
+        # gets.
+        self.send_buffer = send_buffer
+        self.clients = set()
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle_client, self.host, self.port,
+                                                 backlog=1024)
+        # port 0 picks a free one.
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def close(self, timeout=1.0):
+        '''Send what's queued, then disconnect everyone.  Clients that haven't taken their
+        events within timeout seconds are cut off.'''
+        for client in list(self.clients):
+            client.put(None)
+        self.server.close()
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self.clients and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.01)
+        for client in list(self.clients):
+            client.writer.transport.abort()
+        while self.clients:
+            await asyncio.sleep(0)
+        await self.server.wait_closed()
+
+    async def _handle_client(self, reader, writer):
+        client = _Client(writer, self.queue_size)
+        if self.send_buffer:
+            writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                                       self.send_buffer)
+            writer.transport.set_write_buffer_limits(self.send_buffer)
+        client.put(encode({"type": "hello", "server_time": time.time()}))
+        self.clients.add(client)
+        try:
+            await client.send()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.clients.discard(client)
+            writer.close()
+
+    def broadcast(self, event):
+        '''Queue event for every client, it's encoded once.'''
+        line = encode(event)
+        for client in self.clients:
+            client.put(line)
+
+    async def play(self, delay=None):
+        '''Send every beat, lead seconds before it's due.  The song starts delay seconds from
+        now (default lead) so the first beats aren't late.'''
+        loop = asyncio.get_running_loop()
+        delay = self.lead if delay is None else delay
+        # The schedule runs on the loop's monotonic clock, events carry wall clock times.
+        loop_start, wall_start = loop.time() + delay, time.time() + delay
+        self.broadcast({"type": "start", "at": wall_start, "tuning": self.tuning,
+                        "key": self.key_sig})
+
+        timeline = self.timeline
+        for beat, (onset, seconds, frets) in enumerate(zip(timeline.onsets.tolist(),
+                                                           timeline.seconds.tolist(),
+                                                           timeline.frets.tolist())):
+            wait = loop_start + onset - self.lead - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.broadcast({"type": "beat", "beat": beat, "at": wall_start + onset,
+                            "seconds": seconds, "frets": frets})
+        self.broadcast({"type": "end", "at": wall_start + timeline.length})
+
+
+async def stand_in_client(host, port, stats, read_delay=0.0):
+    '''Connect like a remote fretboard and record what arrives.
+
+    stats gets the number of beats received, the number of gaps in the beat numbers and how
+    early (at minus arrival time) the beats arrived.  read_delay slows the client down, with
+    a small receive buffer, to exercise the drop-oldest queue.
+    '''
+    if read_delay:
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024)
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, (host, port))
+        reader, writer = await asyncio.open_connection(sock=sock, limit=1024)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    stats.update(beats=0, gaps=0, early=[])
+    last_beat = -1
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            event = json.loads(line)
+            if event["type"] == "beat":
+                stats["beats"] += 1
+                stats["early"].append(event["at"] - time.time())
+                stats["gaps"] += event["beat"] != last_beat + 1
+                last_beat = event["beat"]
+            elif event["type"] == "end":
+                break
+            if read_delay:
+                await asyncio.sleep(read_delay)
+    finally:
+        writer.close()
+
+
+async def demo(timeline, num_clients=200, num_slow=5, speed=8.0):
+    '''Broadcast timeline, speed times faster than real time, to num_clients stand-in clients
+    plus num_slow that can't keep up.
+
+    Return (clients' stats, slow clients' stats, events dropped for the slow clients).
+    '''
+    from timeline import TrackTimeline
+    fast = TrackTimeline(timeline.seconds / speed, timeline.frets, timeline.pitches,
+                         timeline.pc_masks, timeline.measure_starts, timeline.measure_numbers,
+                         ties=timeline.ties)
+    broadcaster = BeatBroadcaster(fast, port=0, lead=0.25, queue_size=16, send_buffer=4096)
+    await broadcaster.start()
+
+    stats = [{} for i in range(num_clients)]
+    slow_stats = [{} for i in range(num_slow)]
+    tasks = [asyncio.create_task(stand_in_client(HOST, broadcaster.port, s)) for s in stats]
+    tasks += [asyncio.create_task(stand_in_client(HOST, broadcaster.port, s, read_delay=0.05))
+              for s in slow_stats]
+    while len(broadcaster.clients) < num_clients + num_slow:
+        await asyncio.sleep(0.01)
+
+    await broadcaster.play()
+    await asyncio.gather(*tasks[:num_clients])
+    dropped = sum(client.dropped for client in broadcaster.clients)
+    for task in tasks[num_clients:]:
+        task.cancel()
+    await asyncio.gather(*tasks[num_clients:], return_exceptions=True)
+    await broadcaster.close()
+    return stats, slow_stats, dropped
+
+
+def main(argv):
+    from gp_to_kivy import KivySongBuilder
+    if len(argv) >= 2 and argv[0] == "serve":
+        song = KivySongBuilder(argv[1])
+        tuning = [value for number, value in song.gp_tunings[0]]
+        broadcaster = BeatBroadcaster(song.timelines[0], tuning, song.detected_key_sig,
+                                      host="0.0.0.0", port=int(argv[2]) if len(argv) > 2 else PORT)
+
+        async def serve():
+            await broadcaster.start()
+            print("Serving on port {}, press enter to play".format(broadcaster.port))
+            await asyncio.get_running_loop().run_in_executor(None, sys.stdin.readline)
+            await broadcaster.play()
+            await broadcaster.close()
+        asyncio.run(serve())
+    elif argv and argv[0] == "demo":
+        num_clients = int(argv[1]) if len(argv) > 1 else 200
+        song = KivySongBuilder("tgr-nm-01-g1.gp5")
+        stats, slow_stats, dropped = asyncio.run(demo(song.timelines[0], num_clients))
+        beats = len(song.timelines[0])
+        complete = sum(s["beats"] == beats and not s["gaps"] for s in stats)
+        earliest_late = min(min(s["early"]) for s in stats)
+        print("{}/{} clients got all {} beats, in order, at least {:.3f}s early".format(
+            complete, num_clients, beats, earliest_late))
+        print("{} slow clients: {} events dropped, {} beats received".format(
+            len(slow_stats), dropped, [s["beats"] for s in slow_stats]))
+    else:
+        print("python broadcast.py serve SONG [port] | demo [clients]")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,257 @@
+import json
+import os
+import sys
+import time
+import numpy as np
+
+'''Difficulty metrics per measure and per track, for one song or a whole library.
+
+Everything is computed from a TrackTimeline's frets and beat lengths with numpy, per beat and
+then reduced per measure, plus the tempo of each measure from the parsed song.  For a library,
+songs are analysed in a process pool and the results are saved next to the library file as an
+.npz of three tables (see save_difficulty): one row per song, per track and per measure.
+
+    python difficulty.py SONG                            per track summary, hardest measures
+    python difficulty.py library LIBRARY [workers]       analyse a library, rank its tracks
+'''
+
+SHIFT_FRETS = 3  # The lowest fretted note moving further than this is a position shift.
+SKIP_STRINGS = 2  # Consecutive single notes this many strings apart or more are a string skip.
+
+MEASURE_DTYPE = np.dtype([("notes", "<i8"), ("notes_per_second", "<f8"), ("fret_span", "<i8"),
+                          ("position_shifts", "<i8"), ("shift_frets", "<i8"),
+                          ("string_skips", "<i8"), ("tempo", "<f8")])
+TRACK_DTYPE = np.dtype([("song", "<i8"), ("track", "<i8"), ("first_measure", "<i8"),
+                        ("num_measures", "<i8"), ("notes", "<i8"), ("seconds", "<f8"),
+                        ("notes_per_second", "<f8"), ("peak_notes_per_second", "<f8"),
+                        ("max_fret_span", "<i8"), ("position_shifts", "<i8"),
+                        ("string_skips", "<i8"), ("max_tempo", "<f8"),
+                        ("tempo_changes", "<i8")])
+SONG_DTYPE = np.dtype([("first_track", "<i8"), ("num_tracks", "<i8"), ("notes", "<i8"),
+                       ("seconds", "<f8"), ("peak_notes_per_second", "<f8"),
+                       ("max_fret_span", "<i8"), ("position_shifts", "<i8"),
+                       ("string_skips", "<i8"), ("max_tempo", "<f8")])
+
+
+def _per_measure(per_beat, timeline, ufunc=np.add):
+    '''(M,) reduction of a per beat array over each measure, 0 for empty measures.'''
+    out = np.zeros(timeline.num_measures, dtype=per_beat.dtype)
+    starts = timeline.measure_starts
+    filled = np.flatnonzero(np.diff(starts))
+    if len(filled):
+        out[filled] = ufunc.reduceat(per_beat, starts[filled])
+    return out
+
+
+class TrackDifficulty:
+    '''Difficulty of one TrackTimeline.  measures is an (M,) MEASURE_DTYPE array:
+
+        notes:            notes struck, every played string of every beat except tied notes
+                          (which carry on the note before)
+        notes_per_second: notes over the measure's length
+        fret_span:        widest stretch in one beat, highest minus lowest fretted note (open
+                          strings don't need the hand)
+        position_shifts:  times the lowest fretted note moves more than SHIFT_FRETS
+        shift_frets:      frets travelled in those shifts
+        string_skips:     consecutive single notes SKIP_STRINGS or more strings apart
+        tempo:            quarter notes per minute, nan if tempos weren't given
+
+    summary() is the track as one TRACK_DTYPE row.  tempos is the tempo of each measure of the
+    timeline (see measure_tempos).
+    '''
+    def __init__(self, timeline, tempos=None):
+        self.timeline = timeline
+        frets = timeline.frets.astype(np.int16)
+        struck = (frets >= 0) & ~timeline.ties
+        beat_notes = struck.sum(axis=1)
+
+        fretted = frets > 0
+        has_fretted = fretted.any(axis=1)
+        lowest = np.where(fretted, frets, 1 << 10).min(axis=1)
+        highest = np.where(fretted, frets, -1).max(axis=1)
+        span = np.where(has_fretted, highest - lowest, 0)
+
+        # Hand position: the lowest fretted note, carried over beats with nothing fretted.
+        last = np.maximum.accumulate(np.where(has_fretted, np.arange(len(frets)), -1))
+        position = np.where(last >= 0, lowest[np.maximum(last, 0)], -1)
+        move = np.zeros(len(frets), dtype=np.int64)
+        if len(frets) > 1:
+            known = (position[1:] >= 0) & (position[:-1] >= 0)
+            move[1:] = np.where(known, np.abs(position[1:] - position[:-1]), 0)
+        shifts = move > SHIFT_FRETS
+
+        # String skips between consecutive beats that strike one note each.
+        note_beats = np.flatnonzero(beat_notes)
+        single = beat_notes[note_beats] == 1
+        strings = np.argmax(struck[note_beats], axis=1)
+        skips = np.zeros(len(frets), dtype=np.int64)
+        if len(note_beats) > 1:
+            skipped = (single[1:] & single[:-1]
+                       & (np.abs(np.diff(strings)) >= SKIP_STRINGS))
+            skips[note_beats[1:][skipped]] = 1
+
+        measures = np.zeros(timeline.num_measures, dtype=MEASURE_DTYPE)
+        measures["notes"] = _per_measure(beat_notes.astype(np.int64), timeline)
+        lengths = np.diff(timeline.measure_onsets)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            measures["notes_per_second"] = np.where(lengths > 0, measures["notes"] / lengths, 0)
+        measures["fret_span"] = _per_measure(span.astype(np.int64), timeline, np.maximum)
+        measures["position_shifts"] = _per_measure(shifts.astype(np.int64), timeline)
+        measures["shift_frets"] = _per_measure(np.where(shifts, move, 0), timeline)
+        measures["string_skips"] = _per_measure(skips, timeline)
+        measures["tempo"] = np.nan if tempos is None else tempos
+        self.measures = measures
+
+    def summary(self, song_num=0, track_num=0, first_measure=0):
+        measures = self.measures
+        tempo = measures["tempo"]
+        tempo_known = tempo[~np.isnan(tempo)]
+        seconds = self.timeline.length
+        row = np.zeros(1, dtype=TRACK_DTYPE)
+        row[0] = (song_num, track_num, first_measure, len(measures), measures["notes"].sum(),
+                  seconds, measures["notes"].sum() / seconds if seconds > 0 else 0,
+                  measures["notes_per_second"].max(initial=0), measures["fret_span"].max(initial=0),
+                  measures["position_shifts"].sum(), measures["string_skips"].sum(),
+                  tempo_known.max() if len(tempo_known) else np.nan,
+                  np.count_nonzero(np.diff(tempo_known)))
+        return row
+
+
+def measure_tempos(song, track_num):
+    '''(M,) tempo of each measure of a track's timeline, from the parsed song's measure headers
+    (a KivySongBuilder, TimelineSong or anything with gp_song and timelines).'''
+    headers = song.gp_song.measureHeaders
+    numbers = song.timelines[track_num].measure_numbers
+    tempos = np.array([header.tempo.value for header in headers], dtype=np.float64)
+    return tempos[np.asarray(numbers) - 1]
+
+
+def song_difficulty(song):
+    '''[TrackDifficulty, ...] of every track of a song.'''
+    return [TrackDifficulty(timeline, measure_tempos(song, track_num))
+            for track_num, timeline in enumerate(song.timelines)]
+
+
+def _analyse_file(path, builder=None):
+    '''(track rows, measure rows) of one song file, with song 0.  Runs in the pool workers.'''
+    if builder is None:
+        from gp_to_kivy import TimelineSong as builder
+    tracks, measures = [], []
+    first_measure = 0
+    for track_num, difficulty in enumerate(song_difficulty(builder(path))):
+        tracks.append(difficulty.summary(0, track_num, first_measure))
+        measures.append(difficulty.measures)
+        first_measure += len(difficulty.measures)
+    return (np.concatenate(tracks) if tracks else np.zeros(0, TRACK_DTYPE),
+            np.concatenate(measures) if measures else np.zeros(0, MEASURE_DTYPE))
+
+
+def song_rows(tracks, num_songs):
+    '''(num_songs,) SONG_DTYPE table of a tracks table: totals, and the maximums of its
+    hardest track for the peak metrics.  seconds is the longest track.'''
+    songs = np.zeros(num_songs, dtype=SONG_DTYPE)
+    counts = np.bincount(tracks["song"], minlength=num_songs)
+    songs["num_tracks"] = counts
+    songs["first_track"] = np.cumsum(counts) - counts
+    filled = np.flatnonzero(counts)
+    if len(filled):
+        starts = songs["first_track"][filled]
+        for name in ("notes", "position_shifts", "string_skips"):
+            songs[name][filled] = np.add.reduceat(tracks[name], starts)
+        for name in ("seconds", "peak_notes_per_second", "max_fret_span", "max_tempo"):
+            songs[name][filled] = np.fmax.reduceat(tracks[name], starts)
+    return songs
+
+
+def difficulty_path(library_path):
+    return os.path.splitext(library_path)[0] + ".difficulty.npz"
+
+
+def analyse_paths(paths, workers=0):
+    '''(tracks, measures) tables of songs, analysed in a pool of workers processes (0 for one
+    per core, None to do it here).  Track rows point into measures with first_measure and into
+    paths with song.'''
+    if workers is None:
+        results = map(_analyse_file, paths)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        # spawn, like gp_to_kivy's track pool, so workers don't inherit Kivy.
+        pool = ProcessPoolExecutor(workers or None, multiprocessing.get_context("spawn"))
+        with pool:
+            results = list(pool.map(_analyse_file, paths))
+    tracks, measures = [np.zeros(0, TRACK_DTYPE)], [np.zeros(0, MEASURE_DTYPE)]
+    num_measures = 0
+    for song_num, (song_tracks, song_measures) in enumerate(results):
+        song_tracks["song"] = song_num
+        song_tracks["first_measure"] += num_measures
+        num_measures += len(song_measures)
+        tracks.append(song_tracks)
+        measures.append(song_measures)
+    return np.concatenate(tracks), np.concatenate(measures)
+
+
+def analyse_library(library_path, workers=0):
+    '''Analyse every song of a library file and save the tables next to it, return the path.'''
+    from library import Library
+    library = Library(library_path)
+    paths = library.paths
+    library.close()
+    tracks, measures = analyse_paths(paths, workers)
+    return save_difficulty(difficulty_path(library_path), paths, tracks, measures)
+
+
+def save_difficulty(path, paths, tracks, measures):
+    '''One .npz with the songs (see song_rows), tracks and measures tables and the song paths
+    (as JSON), written next to path and moved over it like build_library does.'''
+    tmp = path + ".tmp.npz"
+    np.savez(tmp, songs=song_rows(tracks, len(paths)), tracks=tracks, measures=measures,
+             paths=np.frombuffer(json.dumps(paths).encode(), dtype=np.uint8))
+    os.replace(tmp, path)
+    return path
+
+
+def load_difficulty(path):
+    '''(paths, songs, tracks, measures) saved by save_difficulty, path is the .npz or its
+    library.'''
+    if not path.endswith(".npz"):
+        path = difficulty_path(path)
+    with np.load(path) as data:
+        return (json.loads(data["paths"].tobytes()), data["songs"], data["tracks"],
+                data["measures"])
+
+
+def main(argv):
+    if len(argv) in (2, 3) and argv[0] == "library":
+        workers = int(argv[2]) if len(argv) == 3 else 0
+        start = time.perf_counter()
+        path = analyse_library(argv[1], workers)
+        seconds = time.perf_counter() - start
+        paths, songs, tracks, measures = load_difficulty(path)
+        print("{} songs, {} tracks, {} measures analysed in {:.2f} s, saved to {}".format(
+            len(paths), len(tracks), len(measures), seconds, path))
+        for row in np.sort(tracks, order="peak_notes_per_second")[::-1][:10]:
+            print("{:5.1f} peak notes/s  {:2d} span  {:3d} shifts  {:3d} skips  {}  track {}".format(
+                row["peak_notes_per_second"], row["max_fret_span"], row["position_shifts"],
+                row["string_skips"], os.path.basename(paths[row["song"]]), row["track"] + 1))
+    elif len(argv) == 1:
+        from gp_to_kivy import KivySongBuilder
+        song = KivySongBuilder(argv[0])
+        for track_num, difficulty in enumerate(song_difficulty(song)):
+            row = difficulty.summary(0, track_num)[0]
+            print("Track {}: {} notes, {:.1f} notes/s (peak {:.1f}), fret span {}, {} position "
+                  "shifts, {} string skips, tempo up to {:g}".format(
+                      track_num + 1, row["notes"], row["notes_per_second"],
+                      row["peak_notes_per_second"], row["max_fret_span"],
+                      row["position_shifts"], row["string_skips"], row["max_tempo"]))
+            hardest = np.argsort(difficulty.measures["notes_per_second"])[::-1][:3]
+            numbers = song.timelines[track_num].measure_numbers
+            print("    busiest measures: " + ", ".join(
+                "{} ({:.1f} notes/s)".format(numbers[m], difficulty.measures["notes_per_second"][m])
+                for m in hardest.tolist()))
+    else:
+        print("python difficulty.py SONG | library LIBRARY [workers]")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,154 @@
+from functools import lru_cache
+from itertools import product
+import numpy as np
+
+
+class FretIndex:
+    '''Precomputed pitch -> (string, fret) lookups for one tuning.
+
+    tuning is the open string MIDI note numbers, index 0 is string 1 (same order as
+    KivySongBuilder.gp_tunings values and TrackTimeline columns).
+
+        frets: (128, S) fret that plays each MIDI pitch on each string, -1 if it can't.
+    '''
+    def __init__(self, tuning, num_frets=24):
+        self.tuning = tuple(tuning)
+        self.num_frets = num_frets
+        frets = np.arange(128)[:, None] - np.array(self.tuning)[None, :]
+        frets[(frets < 0) | (frets > num_frets)] = -1
+        self.frets = frets.astype(np.int8)
+        self._positions = [[(string, int(fret)) for string, fret in enumerate(row) if fret >= 0]
+                           for row in self.frets]
+
+    @property
+    def num_strings(self):
+        return len(self.tuning)
+
+    def positions(self, pitch):
+        '''Every (string index, fret) that plays pitch, lowest string index first.'''
+        return self._positions[pitch]
+
+
+@lru_cache(maxsize=32)
+def get_fret_index(tuning, num_frets=24):
+    '''Shared FretIndex per tuning, tuning must be a tuple.'''
+    return FretIndex(tuning, num_frets)
+
+
+class _Candidates:
+    '''Every playable way to finger one beat's pitches.
+
+        frets: (K, S) fret per string for each candidate, -1 where the string isn't played
+        position: (K,) hand position, mean of the fretted notes (nan if only open strings)
+        stretch:  (K,) distance between lowest and highest fretted note
+    '''
+    def __init__(self, frets, num_strings):
+        self.frets = np.array(frets, dtype=np.int8).reshape(-1, num_strings)
+        fretted = np.where(self.frets > 0, self.frets, np.nan).astype(np.float64)
+        any_fretted = (self.frets > 0).any(axis=1)
+        self.position = np.full(len(self.frets), np.nan)
+        self.stretch = np.zeros(len(self.frets))
+        if any_fretted.any():
+            rows = fretted[any_fretted]
+            self.position[any_fretted] = np.nanmean(rows, axis=1)
+            self.stretch[any_fretted] = np.nanmax(rows, axis=1) - np.nanmin(rows, axis=1)
+
+
+class FingeringOptimizer:
+    '''Chooses a (string, fret) for every note of a track to minimize hand movement and
+    stretch.
+
+    Each beat's candidate fingerings come from the FretIndex, then dynamic programming
+    (Viterbi) over the beats picks the cheapest path.  Cost of a beat is its stretch plus the
+    distance the hand moves from the previous beat's position.  Open strings don't move the
+    hand.  Beats with no notes are skipped.
+    '''
+    def __init__(self, tuning, num_frets=24, max_stretch=5, stretch_weight=1.0,
+                 movement_weight=1.0, height_weight=0.1):
+        self.index = get_fret_index(tuple(tuning), num_frets)
+        self.max_stretch = max_stretch
+        self.stretch_weight = stretch_weight
+        self.movement_weight = movement_weight
+        # Slight preference for positions near the nut.
+        self.height_weight = height_weight
+        self._candidates = {}
+
+    def candidates(self, pitches):
+        '''_Candidates for a beat's pitches (tuple, sorted).  Cached, chords repeat a lot.'''
+        cached = self._candidates.get(pitches)
+        if cached is not None:
+            return cached
+        num_strings = self.index.num_strings
+        options = [self.index.positions(pitch) for pitch in pitches]
+        fingerings = []
+        for choice in product(*options):
+            strings = [string for string, fret in choice]
+            if len(set(strings)) != len(strings):
+                continue
+            fretted = [fret for string, fret in choice if fret > 0]
+            if fretted and max(fretted) - min(fretted) > self.max_stretch:
+                continue
+            frets = [-1] * num_strings
+            for string, fret in choice:
+                frets[string] = fret
+            fingerings.append(frets)
+        if not fingerings:
+            # Unplayable in this tuning.  Play what fits, lowest positions first.
+            frets, used = [-1] * num_strings, set()
+            for option in options:
+                for string, fret in option:
+                    if string not in used:
+                        frets[string] = fret
+                        used.add(string)
+                        break
+            fingerings.append(frets)
+        cached = self._candidates[pitches] = _Candidates(fingerings, num_strings)
+        return cached
+
+    def _beat_cost(self, candidates):
+        return (self.stretch_weight * candidates.stretch +
+                self.height_weight * np.nan_to_num(candidates.position))
+
+    def optimize(self, pitches):
+        '''Re-finger a (N, 6) pitch matrix (TrackTimeline.pitches, -1 == not played).
+
+        Return (N, S) fret matrix for this tuning, -1 where no string is played.
+        '''
+        num_beats = len(pitches)
+        frets = np.full((num_beats, self.index.num_strings), -1, dtype=np.int8)
+        beats, beat_candidates = [], []
+        for i, row in enumerate(pitches.tolist()):
+            played = tuple(sorted(pitch for pitch in row if pitch >= 0))
+            if played:
+                beats.append(i)
+                beat_candidates.append(self.candidates(played))
+        if not beats:
+            return frets
+
+        # Viterbi.  Hand position of the cheapest path ending at each candidate is carried
+        # forward so open strings don't reset it.
+        cost = self._beat_cost(beat_candidates[0])
+        hand = beat_candidates[0].position.copy()
+        back = []
+        for candidates in beat_candidates[1:]:
+            position = candidates.position
+            # (previous, current) movement, no movement if either hand position is unknown.
+            movement = np.abs(hand[:, None] - position[None, :])
+            movement = np.nan_to_num(movement, nan=0.0)
+            total = cost[:, None] + self.movement_weight * movement
+            best = total.argmin(axis=0)
+            cost = total[best, np.arange(len(best))] + self._beat_cost(candidates)
+            hand = np.where(np.isnan(position), hand[best], position)
+            back.append(best)
+
+        choice = int(cost.argmin())
+        for i in reversed(range(len(beats))):
+            frets[beats[i]] = beat_candidates[i].frets[choice]
+            if i:
+                choice = int(back[i - 1][choice])
+        return frets
+
+    def alternatives(self, pitches):
+        '''Every candidate fret row for one beat's pitches, cheapest first.'''
+        candidates = self.candidates(tuple(sorted(pitches)))
+        return candidates.frets[np.argsort(self._beat_cost(candidates), kind='stable')]
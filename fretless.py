@@ -8,11 +8,11 @@ from kivy.uix.button import Button
 from kivy.uix.spinner import Spinner
 from kivy.uix.dropdown import DropDown
 from kivy.uix.popup import Popup
-from kivy.properties import ObjectProperty, StringProperty
+from kivy.properties import NumericProperty, ObjectProperty, StringProperty
 from kivy.graphics import Color, Rectangle, Ellipse
 from kivy.graphics.instructions import InstructionGroup
 from kivy.uix.scrollview import ScrollView
-from kivy.clock import Clock, ClockBaseInterrupt
+from kivy.clock import Clock, ClockBaseInterrupt, mainthread
 from kivy.config import Config
 Config.set('graphics', 'width', '800')
 Config.set('graphics', 'height', '300')
@@ -20,16 +20,39 @@ Config.set("graphics", "kivy_clock", "interrupt")
 Config.set("graphics", "maxfps", 90)
 ClockBaseInterrupt.interrupt_next_only = False
 
-from kivy.uix.screenmanager import ScreenManager, Screen
+from kivy.uix.screenmanager import ScreenManager, Screen, SlideTransition
+from kivy.factory import Factory
 
-from gp_to_kivy import KivySongBuilder
+from music_theory import chrom_scale, key_sig_pcs, key_sig_name, note_to_pc
 # from spt_connect_user import spt_play_song
-import random, time, timeit
+from functools import lru_cache
+import os, random, time, timeit
+
+# Only imported if fretless.kv actually uses it.
+Factory.register('MeshFretboard', module='mesh_fretboard')
 
-chrom_scale = 'C C#/Db D D#/Eb E F F#/Gb G G#/Ab A A#/Bb B'.split()
 
 class ScreenSwitcher(ScreenManager):
-    pass
+    '''Only Main is built at startup.  Other screens are built the first time they're shown.'''
+    song = ObjectProperty(None)
+
+    def show_screen(self, name, direction):
+        if not self.has_screen(name):
+            screen = self.lazy_screens[name]()
+            self.add_widget(screen)
+            if self.song is not None:
+                screen.load_song(self.song)
+        self.transition = SlideTransition(direction=direction)
+        self.current = name
+
+    def on_song(self, instance, value):
+        for name in self.lazy_screens:
+            if self.has_screen(name):
+                self.get_screen(name).load_song(self.song)
+
+    @property
+    def lazy_screens(self):
+        return {"key_sig_display": KeySigDisplay}
 
 
 class Main(Screen):
@@ -47,8 +70,38 @@ class Main(Screen):
         self._popup.open()
 
     def load(self, filepath):
+        # Song loading and analysis (pyguitarpro, numpy) isn't imported until it's needed.
+        from gp_to_kivy import KivySongBuilder
         print("Main.load()... filepath: {}".format(filepath))
-        self.song = KivySongBuilder(filepath[0])
+        # Multi-track songs are built a track per core, the pool stays up for the next song.
+        song = KivySongBuilder(filepath[0], workers=0)
+        # A recording's onsets next to the song (song.onsets.json) line the fretboard up with
+        # the recording rather than the written tempo, see alignment.py.
+        onsets_path = os.path.splitext(filepath[0])[0] + ".onsets.json"
+        if os.path.exists(onsets_path):
+            from alignment import load_onsets
+            song.align_track(0, *load_onsets(onsets_path))
+        self.song = song
+        self.manager.song = self.song
+        self.dismiss_popup()
+
+    def show_load_midi(self):
+        content = LoadDialog(load=self.load_midi, cancel=self.dismiss_popup)
+        self._popup = Popup(title="MIDI Input (device, pipe or file)", content=content,
+                            size_hint=(0.9, 0.9))
+        self._popup.open()
+
+    def load_midi(self, filepath):
+        '''Light up the fretboard from the MIDI notes arriving on filepath, in the loaded
+        song's tuning (standard tuning if there isn't one).'''
+        from midi_io import MidiInput
+        if getattr(self, "midi_input", None):
+            self.midi_input.stop()
+        tuning = (64, 59, 55, 50, 45, 40)
+        if self.song:
+            tuning = [value for number, value in self.song.gp_tunings[0][:6]]
+        self.midi_input = MidiInput(filepath[0], tuning, mainthread(self.ids.fretboard._play_beat))
+        self.midi_input.start()
         self.dismiss_popup()
 
     def print_song_data(self):
@@ -70,12 +123,26 @@ class RootNoteScrollContainer(GridLayout):
 
 class Fretboard(BoxLayout):
     song = ObjectProperty(None)
+    # Name of the chord being played, looked up from song.beat_chord_names.
+    chord_name = StringProperty("")
+    # How many upcoming fret states are shown as fading ghost notes while playing, 0 for none.
+    look_ahead = NumericProperty(3)
+    # What songs play on, simulator.py swaps in a virtual clock.
+    clock = Clock
 
     def __init__(self, *args, **kwargs):
         super().__init__(**kwargs)
         self.fret_bars = InstructionGroup()
         self.inlays = InstructionGroup()
         self.beat_num = 0
+        self.frets = [None] * 6  # What the strings show, see _play_changes.
+        # A Color and a rectangle per string for each slot of the look-ahead ring buffer, made
+        # when a song starts and moved in place while it plays.
+        self.upcoming = None
+        self.ghosts = InstructionGroup()
+        self.ghost_colors = []
+        self.ghost_rects = []
+        self.canvas.after.add(self.ghosts)
         self.background = Rectangle(size=self.size, pos=self.pos)
         self.bind(size=self._update_canvas, pos=self._update_canvas)
 
@@ -85,6 +152,8 @@ class Fretboard(BoxLayout):
         self._update_fret_bars()
         self._update_fret_ranges()
         self._update_inlays()
+        if self.upcoming is not None:
+            self._draw_ghosts(range(self.upcoming.size))
 
     def _update_background(self):
         self.background.pos = self.pos
@@ -142,30 +211,8 @@ class Fretboard(BoxLayout):
                 self.inlays.add(Ellipse(size=[d, d], pos=[x_pos - d / 2, y_pos2 - d / 2]))
         self.canvas.add(self.inlays)
 
-    def _update_key_sig_colored_frets(self, key_sig):
-        from itertools import compress
-        from collections import deque
-        note, mode = key_sig.split()
-        # Representative of W-W-H-W-W-W-H (the major scale).
-        interval_sequence = deque([1, 0, 1, 0, 1, 1, 0, 1, 0, 1, 0, 1])
-        roygbiv = ['red', 'orange', 'yellow', 'green', 'blue', 'indigo', 'violet']
-        modes = {
-            'Major': 0, 'Dorian': 2, 'Phrygian': 4, 'Lydian': 5, 'Mixolydian': 7, 'Minor': 9,
-            'Locrian': 11
-        }
-        chrom_scale = 'C C#/Db D D#/Eb E F F#/Gb G G#/Ab A A#/Bb B'.split()
-
-        mode_pattern = interval_sequence.copy()
-        mode_pattern.rotate(-1 * modes[mode])
-        note_pattern = chrom_scale.copy()
-        while note != note_pattern[0]:
-            note_pattern.rotate(-1)
-        notes_in_key = list(compress(note_pattern, mode_pattern))
-        color_map = {note: color for note, color in zip(notes_in_key, roygbiv)}
-
     def _clear_frets(self):
-        for i in range(1, 7):
-            self.ids[str(i)]._play_note(None)
+        self._play_beat([None] * 6)
 
     def play_notes(self):
         for string in range(1, 7):
@@ -173,8 +220,23 @@ class Fretboard(BoxLayout):
             self.ids[str(string)].play_note(fret_num)
 
     def play_song(self):
+        from playback import EventPlayer, EventStream, FrameRenderer
         track1 = self.song.song[0]
         self.track = track1
+        self.chord_names = self.song.beat_chord_names[0]
+        # Only the beats where the frets change get a Clock callback, see playback.py.  An
+        # aligned track plays at the recording's times.
+        aligned = self.song.aligned_timeline(0)
+        self.events = EventStream.from_beats(self.track, None if aligned is None else aligned.onsets)
+        if getattr(self, "player", None):
+            self.player.stop()
+            self.renderer.stop()
+        self.player = EventPlayer(self.events, self._play_event, self._end_song, self.clock)
+        # Drawing happens once per frame, whatever the note density.
+        self.renderer = FrameRenderer(self.player, self._draw_event)
+        self._make_ghosts()
+        self.beat_num = 0
+        self._clear_frets()
         self.start1 = time.time()
         self.start2 = timeit.default_timer()
         # spt_play_song(self.song)
@@ -184,23 +246,70 @@ class Fretboard(BoxLayout):
         # spt_restart()
         self._play_song()
 
-    def _play_song(self, seconds=None):
-        # Clock will pass beat.seconds as an argument, it is not needed.
-        beat = self.track[self.beat_num]
-        Clock.schedule_once(self._play_song, beat.seconds)
-        self._play_beat(beat.frets)
-        self.beat_num += 1
-        if self.beat_num == len(self.track):
-            end1 = time.time()
-            end2 = timeit.default_timer()
-            print("Total Time (time): ", end1 - self.start1)
-            print("Total Time (timeit): ", end2 - self.start2)
-            self._clear_frets()
+    def _play_song(self):
+        # Carry on from the start of beat beat_num, or from 0 at the start: an aligned track's
+        # first beat is wherever the recording has it.
+        self.player.play(self.events.onsets[self.beat_num] if self.beat_num else 0.0)
+        self.renderer.start(self.frets)
+
+    def _play_event(self, event_num):
+        self.beat_num = self.events.beat_nums[event_num]
+
+    def _draw_event(self, changes, event_num):
+        self._play_changes(changes)
+        beat_num = self.events.beat_nums[event_num]
+        self.chord_name = self.chord_names[beat_num] if beat_num < len(self.chord_names) else ""
+        if self.upcoming is not None:
+            self._draw_ghosts(self.upcoming.advance(event_num))
+
+    def _make_ghosts(self):
+        from playback import LookAhead
+        size = int(self.look_ahead)
+        self.upcoming = LookAhead(self.events, size) if size else None
+        if len(self.ghost_colors) == size:
+            self._draw_ghosts(range(size))
             return
+        self.ghosts.clear()
+        self.ghost_colors = [Color(1, 1, 1, 0) for slot in range(size)]
+        self.ghost_rects = [[Rectangle(size=[0, 0]) for string in range(6)] for slot in range(size)]
+        for color, rects in zip(self.ghost_colors, self.ghost_rects):
+            self.ghosts.add(color)
+            for rect in rects:
+                self.ghosts.add(rect)
+
+    def _draw_ghosts(self, slots):
+        '''Move the rectangles of the refilled look-ahead slots, then fade every slot by how far
+        ahead it is.'''
+        upcoming = self.upcoming
+        for slot in slots:
+            for string, (rect, fret_num) in enumerate(zip(self.ghost_rects[slot],
+                                                          upcoming.states[slot].tolist())):
+                if fret_num < 0:
+                    rect.size = [0, 0]
+                    continue
+                left, right = self.fret_ranges[fret_num]
+                string_widget = self.ids[str(string + 1)]
+                rect.pos = [left, string_widget.y]
+                rect.size = [right - left, string_widget.height]
+        for slot, color in enumerate(self.ghost_colors):
+            color.a = 0.15 * (1 - upcoming.distance(slot) / upcoming.size)
+
+    def _end_song(self):
+        end1 = time.time()
+        end2 = timeit.default_timer()
+        print("Total Time (time): ", end1 - self.start1)
+        print("Total Time (timeit): ", end2 - self.start2)
+        self.beat_num = 0
+
+    def _play_changes(self, changes):
+        '''changes is ((string index, fret or None), ...), only those strings are redrawn.'''
+        for string, fret_num in changes:
+            self.frets[string] = fret_num
+            self.ids[str(string + 1)]._play_note(fret_num)
 
     def _play_beat(self, frets):
-        for i, fret_num in enumerate(frets, 1):
-            self.ids[str(i)]._play_note(fret_num)
+        self._play_changes([(string, fret_num) for string, fret_num in enumerate(frets)
+                            if fret_num != self.frets[string]])
 
 
 class String(Widget):
@@ -209,25 +318,28 @@ class String(Widget):
     def __init__(self, active_fret=None, *args, **kwargs):
         super().__init__(**kwargs)
         self.active_fret = active_fret
+        # Allocated once and moved in place, a note is a pos/size write rather than new
+        # instructions on the canvas.
         self.active_rect = InstructionGroup()
+        self.active_rectangle = Rectangle(size=[0, 0])
+        self.active_rect.add(Color(1, 1, 1, 0.2))
+        self.active_rect.add(self.active_rectangle)
+        self.canvas.add(self.active_rect)
         self.bind(size=self._update_canvas, pos=self._update_canvas)
 
     def _update_canvas(self, instance, value):
         self._update_note(instance, value)
 
     def _update_note(self, instance, value):
-        self.active_rect.clear()
         if self.active_fret is None:
+            self.active_rectangle.size = [0, 0]
             return
         left, right = self.parent.fret_ranges[self.active_fret]
-        width = right - left
-        x_pos = left
-        self.active_rect.add(Color(1, 1, 1, 0.2))
-        self.active_rect.add(Rectangle(size=[width, self.height], pos=[x_pos, self.y]))
-        self.canvas.add(self.active_rect)
+        self.active_rectangle.pos = [left, self.y]
+        self.active_rectangle.size = [right - left, self.height]
 
     def _clear_note(self):
-        self.active_rect.clear()
+        self._play_note(None)
 
     def _play_note(self, fret_num):
         self.active_fret = fret_num
@@ -235,6 +347,31 @@ class String(Widget):
 
 
 '''PAGE 2 - OBJECTS WITH TUNER'''
+roygbiv = [(1, 0.102, 0.102, 1),  # red
+           (1, 0.549, 0.102, 1),  # orange
+           (1, 1, 0.102, 1),  # yellow
+           (0.102, 1, 0.102, 1),  # green
+           (0.102, 0.102, 1, 1),  # blue
+           (0.549, 0.102, 1, 1),  # indigo
+           (1, 0, 0.502, 1)]  # violet
+not_in_key = (0, 0, 0, 0)
+
+
+@lru_cache(maxsize=512)
+def key_color_layers(tuning, root, mode):
+    '''Colours of one key on every string.
+
+    tuning is the open string pitch classes from string 1.  Returns one tuple per string with the
+    rgba of the 12 semitones above the open string (fret i, i+12 and i+24 share entry i), fully
+    transparent for notes not in the key.  Cached so flipping between keys and tunings is a
+    lookup.
+    '''
+    color_map = [not_in_key] * 12
+    for pc, color in zip(key_sig_pcs(root, mode), roygbiv):
+        color_map[pc] = color
+    return tuple(tuple(color_map[(open_pc + i) % 12] for i in range(12)) for open_pc in tuning)
+
+
 class KeySigChooser(FloatLayout):
     load_key_sig = ObjectProperty(None)
 
@@ -250,6 +387,11 @@ class KeySigDisplay(Screen):
     def display_key_sig(self):
         self.fretboard._update_key_sig_colored_frets(self.key_sig)
 
+    def load_song(self, song):
+        # Start on the key detected from the song's note profile.
+        self.fretboard.song = song
+        self.key_sig = key_sig_name(*song.detected_key_sig)
+
     def dismiss_popup(self):
         self._popup.dismiss()
 
@@ -271,19 +413,59 @@ class FretboardWithTuner(BoxLayout):
         self.fret_bars = InstructionGroup()
         self.inlays = InstructionGroup()
         self.beat_num = 0
-        self.color_map = {}
+        # (root pitch class, mode) of the coloured key, None until one is chosen.
+        self.key_sig = None
+        # True while several tuners are set at once, so the song is retuned once at the end.
+        self._setting_tuners = False
         self.bind(size=self._update_canvas, pos=self._update_canvas)
         Clock.schedule_once(self._tune_to_standard, 0)  # cannot use kv id's until __init__ is done.
 
     def _tune_to_standard(self, dt):
-        for id, tuning in zip([6, 5, 4, 3, 2, 1], "EADGBE"):
-            self.ids[str(id)].string_tuning.text = tuning
+        if self.song is not None:
+            return  # Already tuned to the song by on_song.
+        self._set_tuners(zip([6, 5, 4, 3, 2, 1], "EADGBE"))
+
+    def on_song(self, instance, value):
+        # Show the song's own tuning on the tuners.
+        self._set_tuners((number, chrom_scale[value % 12])
+                         for number, value in self.song.gp_tunings[0][:6])
+
+    def _set_tuners(self, notes):
+        '''Set the Tuner spinners to (string number, note) and retune once, rather than once
+        per on_text with the rest of the tuners still on the old tuning.'''
+        self._setting_tuners = True
+        try:
+            for number, note in notes:
+                self.ids[str(number)].string_tuning.text = note
+        finally:
+            self._setting_tuners = False
+        self._update_tuning()
+
+    def _update_tuning(self):
+        '''Retune the loaded song to the Tuner spinners and recolour the frets.'''
+        if self._setting_tuners:
+            return
+        tuners = [self.ids[str(i)].string_tuning.text for i in range(1, 7)]
+        self._update_colored_frets()
+        if self.song is None or '' in tuners:
+            return
+        # Tuners only give the note.  Pick the octave closest to the song's open string, so E -> D
+        # on string 6 is Drop D rather than an octave up.
+        tuning = []
+        for tuner, (number, original) in zip(tuners, self.song.gp_tunings[0]):
+            shift = (note_to_pc[tuner] - original) % 12
+            tuning.append(original + shift if shift < 6 else original + shift - 12)
+        dropped = self.song.apply_tuning(0, tuning)
+        if dropped:
+            print("Retuned to {}: {} notes couldn't be placed".format(tuners, dropped))
 
     def _update_canvas(self, instance, value):
         # instance is self, value is bound value that changed (size or pos).
         self._update_fret_bars()
         self._update_fret_ranges()
         self._update_inlays()
+        for child in self.children:
+            child._update_colored_fret_positions()
 
     def _update_fret_bars(self):
         temperament = 2**(1/12)  # Ratio of fret[i]/fret[i+1] for 12-tone equal temperament.
@@ -338,32 +520,20 @@ class FretboardWithTuner(BoxLayout):
         self.canvas.add(self.inlays)
 
     def _update_key_sig_colored_frets(self, key_sig):
-        from itertools import compress
-        from collections import deque
+        # Key signature arrives as names from KeySigChooser, everything after this is ints.
         note, mode = key_sig.split()
-        roygbiv = [[1, 0.102, 0.102, 1],  # red
-                   [1, 0.549, 0.102, 1],  # orange
-                   [1, 1, 0.102, 1],  # yellow
-                   [0.102, 1, 0.102, 1],  # green
-                   [0.102, 0.102, 1, 1],  # blue
-                   [0.549, 0.102, 1, 1],  # indigo
-                   [1, 0, 0.502, 1]]  # violet'
-        modes = {
-            'Major'  : 0, 'Dorian': 2, 'Phrygian': 4, 'Lydian': 5, 'Mixolydian': 7, 'Minor': 9,
-            'Locrian': 11
-        }
-        # Representative of W-W-H-W-W-W-H (the major scale).
-        mode_pattern = deque([1, 0, 1, 0, 1, 1, 0, 1, 0, 1, 0, 1])
-        note_pattern = deque(chrom_scale[:])
-
-        mode_pattern.rotate(-1 * modes[mode])
-        while note != note_pattern[0]:
-            note_pattern.rotate(-1)
-        notes_in_key = list(compress(note_pattern, mode_pattern))
-        self.color_map = {note: color for note, color in zip(notes_in_key, roygbiv)}
+        self.key_sig = note_to_pc[note], mode
+        self._update_colored_frets()
 
-        for child in self.children:
-            child._update_colored_frets()
+    def _update_colored_frets(self):
+        '''Recolour every string in place from the cached layers of this tuning and key.'''
+        # Tuner text is the only place the open string is a name.  Not tuned yet == ''.
+        tuning = tuple(note_to_pc.get(self.ids[str(i)].string_tuning.text) for i in range(1, 7))
+        if self.key_sig is None or None in tuning:
+            return
+        layers = key_color_layers(tuning, *self.key_sig)
+        for i, colors in enumerate(layers, 1):
+            self.ids[str(i)]._update_colored_frets(colors)
 
     def _clear_frets(self):
         for i in range(1, 7):
@@ -377,12 +547,22 @@ class StringWithTuner(Widget):
         super().__init__(**kwargs)
         self.active_fret = active_fret
         self.active_rect = InstructionGroup()
+        # Allocated once and recoloured in place.  Frets i, i+12 and i+24 are the same note, so
+        # they share fret_colors[i] and a key change is 12 colour writes per string.
         self.colored_frets = InstructionGroup()
+        self.fret_colors = [Color(*not_in_key) for i in range(12)]
+        self.fret_rects = [None] * 25
+        for i, color in enumerate(self.fret_colors):
+            self.colored_frets.add(color)
+            for fret_num in range(i, 25, 12):
+                self.fret_rects[fret_num] = Rectangle()
+                self.colored_frets.add(self.fret_rects[fret_num])
+        self.canvas.add(self.colored_frets)
         self.bind(size=self._update_canvas, pos=self._update_canvas)
 
     def _update_canvas(self, instance, value):
         self._update_note(instance, value)
-        self._update_colored_frets()
+        self._update_colored_fret_positions()
 
     def _update_note(self, instance, value):
         self.active_rect.clear()
@@ -395,20 +575,18 @@ class StringWithTuner(Widget):
         self.active_rect.add(Rectangle(size=[width, self.height], pos=[x_pos, self.y]))
         self.canvas.add(self.active_rect)
 
-    def _update_colored_frets(self):
-        color_map = self.parent.color_map
-        self.colored_frets.clear()
-        note_idx = chrom_scale.index(self.string_tuning.text)
-        i = 0
-        while i < 25:
-            note = chrom_scale[(note_idx + i) % 12]
-            if note in color_map:
-                left, right = self.parent.fret_ranges[i]
-                width = right - left
-                self.colored_frets.add(Color(*color_map[note]))
-                self.colored_frets.add(Rectangle(size=[width, self.height], pos=[left, self.y]))
-            i += 1
-        self.canvas.add(self.colored_frets)
+    def _update_colored_frets(self, colors):
+        # colors is one string of key_color_layers().
+        for color, rgba in zip(self.fret_colors, colors):
+            color.rgba = rgba
+
+    def _update_colored_fret_positions(self):
+        fret_ranges = getattr(self.parent, "fret_ranges", None)
+        if not fret_ranges:
+            return
+        for rect, (left, right) in zip(self.fret_rects, fret_ranges):
+            rect.pos = [left, self.y]
+            rect.size = [right - left, self.height]
 
     def _clear_note(self):
         self.active_rect.clear()
@@ -0,0 +1,758 @@
+import struct
+import sys
+import time
+from enum import Enum
+import numpy as np
+
+from music_theory import pc_bits
+from timeline import TrackTimeline
+
+'''Notes-only Guitar Pro 3/4/5 reader.
+
+KivySongBuilder only needs durations, strings, frets, tempo, key, tuning and the repeat marks of
+measure headers, guitarpro.parse decodes everything: effects, chord diagrams, lyrics, RSE, page
+setup, each into its own attrs object.  parse() here walks the same file format with
+struct.unpack_from over one bytes buffer, skips what isn't needed by its length and builds small
+slotted objects with the same names as pyguitarpro's models, for the attributes the app uses.
+
+Results match guitarpro.parse attribute for attribute, quirks included (tied notes take the
+value pyguitarpro's getTiedNoteValue finds, a mix table tempo only changes its own measure),
+so the two readers are interchangeable.  compare() checks that on real files:
+
+    python gp_reader.py check SONG...    compare against guitarpro.parse
+    python gp_reader.py time SONG...     time both readers
+
+read_song(file, reader) is the reader layer behind GPReader, track_timeline() fills a
+TrackTimeline's arrays straight from a parsed song, without building KivyBeats.
+'''
+
+# Version string: (versionTuple, major version).
+VERSIONS = {
+    "FICHIER GUITAR PRO v3.00": ((3, 0, 0), 3),
+    "FICHIER GUITAR PRO v4.00": ((4, 0, 0), 4),
+    "FICHIER GUITAR PRO v4.06": ((4, 0, 6), 4),
+    "FICHIER GUITAR PRO L4.06": ((4, 0, 6), 4),
+    "CLIPBOARD GUITAR PRO 4.0 [c6]": ((4, 0, 6), 4),
+    "FICHIER GUITAR PRO v5.00": ((5, 0, 0), 5),
+    "FICHIER GUITAR PRO v5.10": ((5, 1, 0), 5),
+    "CLIPBOARD GP 5.0": ((5, 0, 0), 5),
+    "CLIPBOARD GP 5.1": ((5, 1, 0), 5),
+    "CLIPBOARD GP 5.2": ((5, 2, 0), 5),
+}
+
+TUPLETS = {3: (3, 2), 5: (5, 4), 6: (6, 4), 7: (7, 4), 9: (9, 8), 10: (10, 8), 11: (11, 8),
+           12: (12, 8)}
+DEFAULT_VELOCITY = 95  # guitarpro.Velocities.forte
+
+_byte = struct.Struct("<b")
+_short = struct.Struct("<h")
+_int = struct.Struct("<i")
+
+
+class BeatStatus(Enum):
+    empty = 0
+    normal = 1
+    rest = 2
+
+
+class NoteType(Enum):
+    rest = 0
+    normal = 1
+    tie = 2
+    dead = 3
+
+
+_BEAT_STATUSES = list(BeatStatus)
+_NOTE_TYPES = list(NoteType)
+
+
+class Value:
+    '''Stands in for the one-field models: Tempo, KeySignature, MixTableItem.'''
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class Song:
+    __slots__ = ("version", "versionTuple", "title", "subtitle", "artist", "album", "tempo",
+                 "key", "tracks", "measureHeaders")
+
+    def __init__(self):
+        self.tracks, self.measureHeaders = [], []
+
+
+class Track:
+    __slots__ = ("song", "number", "name", "strings", "channel", "isPercussionTrack",
+                 "fretCount", "offset", "measures")
+
+    def __init__(self, song, number):
+        self.song, self.number = song, number
+        self.strings, self.measures = [], []
+
+
+class GuitarString:
+    __slots__ = ("number", "value")
+
+    def __init__(self, number, value):
+        self.number, self.value = number, value
+
+
+class MidiChannel:
+    __slots__ = ("channel", "effectChannel", "instrument", "bank")
+
+    def __init__(self, channel, instrument):
+        self.channel = self.effectChannel = channel
+        self.instrument = instrument
+        self.bank = 0
+
+    @property
+    def isPercussionChannel(self):
+        return self.channel % 16 == 9
+
+
+class Duration:
+    __slots__ = ("value", "isDotted", "isDoubleDotted", "tuplet")
+
+    def __init__(self, value=4, isDotted=False, tuplet=None):
+        self.value = value
+        self.isDotted = isDotted
+        self.isDoubleDotted = False
+        self.tuplet = tuplet or _NO_TUPLET
+
+    @property
+    def time(self):
+        # Same rounding as guitarpro.Duration.time.
+        result = int(960 * (4.0 / self.value))
+        if self.isDotted:
+            result += int(result / 2)
+        elif self.isDoubleDotted:
+            result += int((result / 4) * 3)
+        return int(result * self.tuplet.times / self.tuplet.enters)
+
+
+class Tuplet:
+    __slots__ = ("enters", "times")
+
+    def __init__(self, enters, times):
+        self.enters, self.times = enters, times
+
+
+_NO_TUPLET = Tuplet(1, 1)
+
+
+class TimeSignature:
+    __slots__ = ("numerator", "denominator")
+
+    def __init__(self, numerator, denominator):
+        self.numerator = numerator
+        self.denominator = Duration(denominator)
+
+
+class MeasureHeader:
+    __slots__ = ("number", "start", "timeSignature", "tempo", "isRepeatOpen", "repeatClose",
+                 "repeatAlternative", "hasDoubleBar")
+
+    def __init__(self, number, time_signature, tempo):
+        self.number = number
+        self.start = 960
+        self.timeSignature = time_signature
+        self.tempo = Value(tempo)
+        self.isRepeatOpen = False
+        self.repeatClose = -1
+        self.repeatAlternative = 0
+        self.hasDoubleBar = False
+
+    @property
+    def length(self):
+        return self.timeSignature.numerator * self.timeSignature.denominator.time
+
+
+class Measure:
+    __slots__ = ("track", "header", "voices")
+
+    def __init__(self, track, header):
+        self.track, self.header = track, header
+        self.voices = [Voice(self), Voice(self)]
+
+
+class Voice:
+    __slots__ = ("measure", "beats")
+
+    def __init__(self, measure):
+        self.measure = measure
+        self.beats = []
+
+
+class BeatEffect:
+    __slots__ = ("mixTableChange",)
+
+    def __init__(self):
+        self.mixTableChange = None
+
+
+class MixTableChange:
+    __slots__ = ("tempo",)
+
+    def __init__(self, tempo=None):
+        self.tempo = tempo
+
+
+class Beat:
+    __slots__ = ("voice", "start", "status", "duration", "effect", "notes")
+
+    def __init__(self, voice, start):
+        self.voice, self.start = voice, start
+        self.status = BeatStatus.empty
+        self.duration = Duration()
+        self.effect = BeatEffect()
+        self.notes = []
+
+
+class Note:
+    '''realValue is worked out once the note is read, notes aren't edited.'''
+    __slots__ = ("beat", "string", "value", "realValue", "type", "velocity")
+
+    def __init__(self, beat, string):
+        self.beat, self.string = beat, string
+        self.value = self.realValue = 0
+        self.type = NoteType.rest
+        self.velocity = DEFAULT_VELOCITY
+
+
+class _Decoder:
+    '''Reads one file.  Method names follow guitarpro's GP3File/GP4File/GP5File, with the
+    differences between versions inline.'''
+    def __init__(self, data, encoding="cp1252"):
+        self.data = data
+        self.pos = 0
+        self.encoding = encoding
+
+    # Primitives.
+    def skip(self, count):
+        self.pos += count
+
+    def byte(self):
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def signed_byte(self):
+        self.pos += 1
+        return _byte.unpack_from(self.data, self.pos - 1)[0]
+
+    def short(self):
+        self.pos += 2
+        return _short.unpack_from(self.data, self.pos - 2)[0]
+
+    def int(self):
+        self.pos += 4
+        return _int.unpack_from(self.data, self.pos - 4)[0]
+
+    def string(self, size, length=None):
+        if length is None:
+            length = size
+        count = size if size > 0 else length
+        raw = self.data[self.pos:self.pos + count]
+        self.pos += count
+        return raw[:length if length >= 0 else size].decode(self.encoding)
+
+    def byte_size_string(self, size):
+        return self.string(size, self.byte())
+
+    def int_byte_size_string(self):
+        return self.byte_size_string(self.int() - 1)
+
+    def skip_int_byte_size_string(self):
+        size = self.int() - 1
+        length = self.byte()
+        self.pos += size if size > 0 else length
+
+    # Song.
+    def read_song(self):
+        song = Song()
+        song.version = self.byte_size_string(30)
+        if song.version not in VERSIONS:
+            raise ValueError("unsupported version '{}'".format(song.version))
+        song.versionTuple, self.major = VERSIONS[song.version]
+        self.version = song.versionTuple
+        clipboard = song.version.startswith("CLIPBOARD")
+        if self.major >= 4 and clipboard:
+            self.skip(16 if self.major == 4 else 28)
+
+        song.title = self.int_byte_size_string()
+        song.subtitle = self.int_byte_size_string()
+        song.artist = self.int_byte_size_string()
+        song.album = self.int_byte_size_string()
+        # Words, (GP5) music, copyright, tab, instructions.
+        for i in range(5 if self.major == 5 else 4):
+            self.skip_int_byte_size_string()
+        for i in range(self.int()):
+            self.skip_int_byte_size_string()
+
+        if self.major < 5:
+            self.skip(1)  # Triplet feel.
+        if self.major >= 4:
+            self.skip(4)  # Lyrics track.
+            for i in range(5):
+                self.skip(4)
+                self.skip(self.int())
+        if self.major == 5:
+            if song.versionTuple > (5, 0, 0):
+                self.skip(19)  # RSE master effect.
+            self.skip(30)  # Page setup.
+            for i in range(10):
+                self.skip_int_byte_size_string()
+            self.skip_int_byte_size_string()  # Tempo name.
+        song.tempo = self.int()
+        if self.major == 5:
+            if song.versionTuple > (5, 0, 0):
+                self.skip(1)
+            song.key = Value((self.signed_byte(), 0))
+            self.skip(4)
+        else:
+            song.key = Value((self.int(), 0))
+            if self.major == 4:
+                self.skip(1)
+        channels = self.read_midi_channels()
+        if self.major == 5:
+            self.skip(38 + 4)  # Directions, master reverb.
+        measure_count, track_count = self.int(), self.int()
+        previous = None
+        for number in range(1, measure_count + 1):
+            previous = self.read_measure_header(song, number, previous)
+            song.measureHeaders.append(previous)
+        for number in range(1, track_count + 1):
+            song.tracks.append(self.read_track(song, number, channels))
+        if self.major == 5:
+            self.skip(2 if song.versionTuple == (5, 0, 0) else 1)
+        self.read_measures(song)
+        return song
+
+    def read_midi_channels(self):
+        channels = []
+        for channel in range(64):
+            instrument = self.int()
+            if channel % 16 == 9 and instrument == -1:
+                instrument = 0
+            channels.append(MidiChannel(channel, instrument))
+            self.skip(8)  # Volume, balance, chorus, reverb, phaser, tremolo, padding.
+        return channels
+
+    def read_measure_header(self, song, number, previous):
+        if self.major == 5 and previous is not None:
+            self.skip(1)
+        flags = self.byte()
+        numerator = self.signed_byte() if flags & 1 else previous.timeSignature.numerator
+        denominator = (self.signed_byte() if flags & 2 else
+                       previous.timeSignature.denominator.value)
+        header = MeasureHeader(number, TimeSignature(numerator, denominator), song.tempo)
+        header.isRepeatOpen = bool(flags & 4)
+        if flags & 8:
+            header.repeatClose = self.signed_byte()
+        if flags & 16:
+            value = self.byte()
+            if self.major == 5:
+                header.repeatAlternative = value
+            else:
+                existing = 0
+                for other in reversed(song.measureHeaders):
+                    if other.isRepeatOpen:
+                        break
+                    existing |= other.repeatAlternative
+                header.repeatAlternative = (1 << value) - 1 ^ existing
+        if flags & 32:
+            self.skip_int_byte_size_string()  # Marker title.
+            self.skip(4)  # Marker color.
+        if flags & 64:
+            self.skip(2)  # Key signature.
+        header.hasDoubleBar = bool(flags & 128)
+        if self.major == 5:
+            if header.repeatClose > -1:
+                header.repeatClose -= 1
+            if flags & 3:
+                self.skip(4)  # Beams.
+            if not flags & 16:
+                self.skip(1)
+            self.skip(1)  # Triplet feel.
+        return header
+
+    def read_track(self, song, number, channels):
+        track = Track(song, number)
+        if self.major == 5 and (number == 1 or song.versionTuple == (5, 0, 0)):
+            self.skip(1)
+        track.isPercussionTrack = bool(self.byte() & 1)
+        track.name = self.byte_size_string(40)
+        string_count = self.int()
+        for i in range(7):
+            value = self.int()
+            if i < string_count:
+                track.strings.append(GuitarString(i + 1, value))
+        self.skip(4)  # Port.
+        index, effect_channel = self.int() - 1, self.int() - 1
+        track.channel = None
+        if 0 <= index < len(channels):
+            track.channel = channels[index]
+            if track.channel.instrument < 0:
+                track.channel.instrument = 0
+            if not track.channel.isPercussionChannel:
+                track.channel.effectChannel = effect_channel
+            if track.channel.channel == 9:
+                track.isPercussionTrack = True
+        track.fretCount, track.offset = self.int(), self.int()
+        self.skip(4)  # Color.
+        if self.major == 5:
+            self.skip(3)  # Settings, auto accentuation.
+            track.channel.bank = self.byte()
+            self.skip(13 + 12)  # Humanize, 3 ints, 12 unknown bytes.
+            self.skip(15 if song.versionTuple == (5, 0, 0) else 16)  # RSE instrument.
+            if song.versionTuple > (5, 0, 0):
+                self.skip(4)  # Equalizer.
+                self.skip_int_byte_size_string()
+                self.skip_int_byte_size_string()
+        return track
+
+    # Measures.
+    def read_measures(self, song):
+        start = 960
+        for header in song.measureHeaders:
+            header.start = start
+            for track in song.tracks:
+                measure = Measure(track, header)
+                track.measures.append(measure)
+                for voice in measure.voices[:2 if self.major == 5 else 1]:
+                    beat_start = start
+                    for i in range(self.int()):
+                        beat_start += self.read_beat(beat_start, voice)
+                if self.major == 5 and self.pos < len(self.data):
+                    self.skip(1)  # Line break.
+            start += header.length
+
+    def read_beat(self, start, voice):
+        flags = self.byte()
+        # Same as GP3File.getBeat: an empty beat takes no time and shares its start with the
+        # next one, which is read into the same Beat.
+        if voice.beats and voice.beats[-1].start == start:
+            beat = voice.beats[-1]
+        else:
+            beat = Beat(voice, start)
+            voice.beats.append(beat)
+        beat.status = _BEAT_STATUSES[self.byte()] if flags & 64 else BeatStatus.normal
+        duration = Duration(1 << self.signed_byte() + 2, bool(flags & 1))
+        if flags & 32:
+            duration.tuplet = Tuplet(*TUPLETS.get(self.int(), (1, 1)))
+        if flags & 2:
+            self.skip_chord()
+        if flags & 4:
+            self.skip_int_byte_size_string()  # Text.
+        if flags & 8:
+            beat.effect = BeatEffect()
+            self.skip_beat_effects()
+        if flags & 16:
+            beat.effect.mixTableChange = self.read_mix_table_change(voice.measure.header)
+
+        track = voice.measure.track
+        string_flags = self.byte()
+        for guitar_string in track.strings:
+            if string_flags & 1 << 7 - guitar_string.number:
+                note = Note(beat, guitar_string.number)
+                beat.notes.append(note)
+                self.read_note(note, guitar_string, track)
+            beat.duration = duration
+        if self.major == 5 and self.short() & 2048:
+            self.skip(1)
+        return duration.time if beat.status is not BeatStatus.empty else 0
+
+    def skip_chord(self):
+        if not self.byte():  # Old format.
+            self.skip_int_byte_size_string()
+            if self.int():
+                self.skip(24)
+        elif self.major == 3:
+            self.skip(1 + 3 + 20 + 1 + 1 + 22 + 12 + 4 + 24 + 4 + 24 + 7 + 1)
+        else:
+            self.skip(1 + 3 + 3 + 8 + 1 + 1 + 22 + 3 + 4 + 28 + 1 + 15 + 7 + 1 + 7 + 1)
+
+    def skip_beat_effects(self):
+        if self.major == 3:
+            flags = self.byte()
+            if flags & 32:
+                self.skip(1 + 4)  # Slap effect or tremolo bar, then its value.
+            if flags & 64:
+                self.skip(2)  # Stroke.
+            return
+        flags1, flags2 = self.byte(), self.byte()
+        if flags1 & 32:
+            self.skip(1)
+        if flags2 & 4:
+            self.skip_bend()
+        if flags1 & 64:
+            self.skip(2)
+        if flags2 & 2:
+            self.skip(1)
+
+    def skip_bend(self):
+        self.skip(5)
+        self.skip(9 * self.int())
+
+    def read_mix_table_change(self, header):
+        if self.major == 5:
+            instrument = self.signed_byte()
+            self.skip(16)  # RSE instrument.
+            values = [self.signed_byte() for i in range(6)]
+            self.skip_int_byte_size_string()  # Tempo name.
+        else:
+            instrument = self.signed_byte()
+            values = [self.signed_byte() for i in range(6)]
+        tempo = self.int()
+        # One duration byte per item that is set, the instrument has none.
+        self.skip(sum(value >= 0 for value in values))
+        table_change = MixTableChange()
+        if tempo >= 0:
+            table_change.tempo = Value(tempo)
+            header.tempo.value = tempo
+            self.skip(1)
+            if self.major == 5 and self.version > (5, 0, 0):
+                self.skip(1)  # Hide tempo.
+        if self.major >= 4:
+            flags = self.byte()
+            if self.major == 5:
+                self.skip(1)  # Wah.
+                if self.version > (5, 0, 0):
+                    self.skip_int_byte_size_string()
+                    self.skip_int_byte_size_string()
+        return table_change
+
+    def read_note(self, note, guitar_string, track):
+        flags = self.byte()
+        if flags & 32:
+            note.type = _NOTE_TYPES[self.byte()]
+        if flags & 1 and self.major < 5:
+            self.skip(2)  # Duration and tuplet.
+        if flags & 16:
+            note.velocity = 15 + 16 * self.signed_byte() - 16
+        if flags & 32:
+            fret = self.signed_byte()
+            value = self.tied_value(note.string, track) if note.type is NoteType.tie else fret
+            if self.major == 5:
+                note.value = value if 0 <= value < 100 else 0
+            else:
+                note.value = max(0, min(99, value))
+        note.realValue = note.value + guitar_string.value
+        if flags & 128:
+            self.skip(2)  # Fingering.
+        if self.major == 5:
+            if flags & 1:
+                self.skip(8)  # Duration percent.
+            self.skip(1)
+        if flags & 8:
+            self.skip_note_effects()
+
+    @staticmethod
+    def tied_value(string, track):
+        '''GP3File.getTiedNoteValue: first note on string in the last measure with one, the
+        note being read (value 0 so far) included.'''
+        for measure in reversed(track.measures):
+            for voice in reversed(measure.voices):
+                for beat in voice.beats:
+                    if beat.status is not BeatStatus.empty:
+                        for note in beat.notes:
+                            if note.string == string:
+                                return note.value
+        return -1
+
+    def skip_note_effects(self):
+        if self.major == 3:
+            flags = self.byte()
+            if flags & 1:
+                self.skip_bend()
+            if flags & 16:
+                self.skip(4)  # Grace note.
+            return
+        flags1, flags2 = self.byte(), self.byte()
+        if flags1 & 1:
+            self.skip_bend()
+        if flags1 & 16:
+            self.skip(5 if self.major == 5 else 4)  # Grace note.
+        if flags2 & 4:
+            self.skip(1)  # Tremolo picking.
+        if flags2 & 8:
+            self.skip(1)  # Slides.
+        if flags2 & 16:
+            harmonic = self.signed_byte()
+            if self.major == 5 and harmonic == 2:
+                self.skip(3)
+            elif self.major == 5 and harmonic == 3:
+                self.skip(1)
+        if flags2 & 32:
+            self.skip(2)  # Trill.
+
+
+def parse(file, encoding="cp1252"):
+    '''Read a Guitar Pro 3, 4 or 5 file (path or binary file object) into a Song.
+
+    Raises ValueError for versions it doesn't know and files it can't make sense of.
+    '''
+    if isinstance(file, str):
+        with open(file, "rb") as stream:
+            data = stream.read()
+    else:
+        data = file.read()
+    decoder = _Decoder(data, encoding)
+    try:
+        return decoder.read_song()
+    except (IndexError, struct.error) as error:
+        raise ValueError("can't read {}: {}".format(getattr(file, "name", file), error)) from error
+
+
+def parse_pyguitarpro(file):
+    # Deferred until a song is actually loaded, keeps pyguitarpro out of app startup.
+    import guitarpro
+    return guitarpro.parse(file)
+
+
+READERS = {"fast": parse, "pyguitarpro": parse_pyguitarpro}
+
+
+def read_song(file, reader="fast"):
+    '''Parse file with reader: a name in READERS or a callable taking the file.
+
+    The fast reader falls back to pyguitarpro for files it can't read.
+    '''
+    if callable(reader):
+        return reader(file)
+    if reader == "fast":
+        try:
+            return parse(file)
+        except ValueError:
+            if not isinstance(file, str):
+                file.seek(0)
+            return parse_pyguitarpro(file)
+    return READERS[reader](file)
+
+
+def track_timeline(gp_song, track_num):
+    '''TrackTimeline of one track, the same as TrackTimeline.from_track_data of
+    KivySongBuilder's song_data, filled straight from the parsed song.
+
+    Beats are gathered once per measure as written, then repeats are unrolled by indexing.
+    '''
+    gp_track = gp_song.tracks[track_num]
+    # Per beat, beat_notes is (beat, string, value, realValue, tied).
+    times, beat_notes = [], []
+    measure_beats = [0]
+    for gp_measure in gp_track.measures:
+        for gp_voice in gp_measure.voices[:-1]:
+            for gp_beat in gp_voice.beats:
+                for gp_note in gp_beat.notes:
+                    # type is either reader's NoteType, so compare values.
+                    tied = gp_note.type.value == NoteType.tie.value
+                    beat_notes.append((len(times), gp_note.string, gp_note.value,
+                                       gp_note.realValue, tied))
+                times.append(gp_beat.duration.time)
+        measure_beats.append(len(times))
+
+    frets = np.full((len(times), 6), -1, dtype=np.int8)
+    pitches = np.full((len(times), 6), -1, dtype=np.int16)
+    pc_masks = np.zeros(len(times), dtype=np.uint16)
+    ties = np.zeros((len(times), 6), dtype=bool)
+    if beat_notes:
+        beats, strings, values, real_values, tied = np.array(beat_notes, dtype=np.int64).T
+        frets[beats, strings - 1] = values
+        pitches[beats, strings - 1] = real_values
+        ties[beats, strings - 1] = tied
+        np.bitwise_or.at(pc_masks, beats, np.array(pc_bits, dtype=np.uint16)[real_values % 12])
+    # Same arithmetic as KivySongBuilder._build_track, so seconds are bit for bit the same.
+    seconds = np.array(times, dtype=np.float64) / 960 * (gp_song.tempo / 60) ** (-1)
+
+    # Measure order with repeats, the same walk as _build_track.
+    order, group = [], []
+    for index, gp_measure in enumerate(gp_track.measures):
+        group.append(index)
+        header = gp_measure.header
+        if header.isRepeatOpen:
+            continue
+        order.extend(group * header.repeatClose if header.repeatClose > 0 else group)
+        group.clear()
+    order = np.array(order, dtype=np.intp)
+    measure_beats = np.array(measure_beats, dtype=np.intp)
+    counts = measure_beats[order + 1] - measure_beats[order]
+    measure_starts = np.concatenate(([0], np.cumsum(counts))).astype(np.intp)
+    # Index of every beat of the unrolled track in the as-written arrays.
+    beats = np.repeat(measure_beats[order] - measure_starts[:-1], counts) + np.arange(counts.sum())
+    numbers = np.array([gp_measure.header.number for gp_measure in gp_track.measures],
+                       dtype=np.intp)
+    return TrackTimeline(seconds[beats], frets[beats], pitches[beats], pc_masks[beats],
+                         measure_starts, numbers[order], ties=ties[beats])
+
+
+def compare(file):
+    '''Differences between parse and guitarpro.parse of file in everything the app reads, as a
+    list of strings.  Empty if they agree.'''
+    fast, full = parse(file), parse_pyguitarpro(file)
+    differences = []
+
+    def check(where, ours, theirs):
+        if ours != theirs:
+            differences.append("{}: {!r} != {!r}".format(where, ours, theirs))
+
+    for name in ("title", "artist", "tempo"):
+        check(name, getattr(fast, name), getattr(full, name))
+    check("key", fast.key.value, full.key.value)
+    check("tracks", len(fast.tracks), len(full.tracks))
+    for track, full_track in zip(fast.tracks, full.tracks):
+        where = "track {}".format(track.number)
+        check(where + " name", track.name, full_track.name)
+        check(where + " strings", [(s.number, s.value) for s in track.strings],
+              [(s.number, s.value) for s in full_track.strings])
+        check(where + " channel", (track.channel.channel, track.channel.instrument,
+                                   track.isPercussionTrack),
+              (full_track.channel.channel, full_track.channel.instrument,
+               full_track.isPercussionTrack))
+        check(where + " measures", len(track.measures), len(full_track.measures))
+        for measure, full_measure in zip(track.measures, full_track.measures):
+            header, full_header = measure.header, full_measure.header
+            where = "track {} measure {}".format(track.number, header.number)
+            check(where, (header.number, header.start, header.length, header.isRepeatOpen,
+                          header.repeatClose, header.repeatAlternative,
+                          header.timeSignature.numerator, header.timeSignature.denominator.value,
+                          header.tempo.value),
+                  (full_header.number, full_header.start, full_header.length,
+                   full_header.isRepeatOpen, full_header.repeatClose,
+                   full_header.repeatAlternative, full_header.timeSignature.numerator,
+                   full_header.timeSignature.denominator.value, full_header.tempo.value))
+            for voice, full_voice in zip(measure.voices, full_measure.voices):
+                check(where + " beats", [_beat_fields(beat) for beat in voice.beats],
+                      [_beat_fields(beat) for beat in full_voice.beats])
+    return differences
+
+
+def _beat_fields(beat):
+    duration, mix = beat.duration, beat.effect.mixTableChange
+    return (beat.start, beat.status.name, duration.value, duration.isDotted,
+            duration.isDoubleDotted, duration.tuplet.enters, duration.tuplet.times, duration.time,
+            None if mix is None or mix.tempo is None else mix.tempo.value,
+            [(note.string, note.value, note.realValue, note.type.name, note.velocity)
+             for note in beat.notes])
+
+
+def main(argv):
+    if len(argv) >= 2 and argv[0] == "check":
+        for path in argv[1:]:
+            differences = compare(path)
+            print("{}: {}".format(path, "same" if not differences else
+                                  "{} differences".format(len(differences))))
+            for difference in differences[:20]:
+                print("   ", difference)
+    elif len(argv) >= 2 and argv[0] == "time":
+        for name, reader in READERS.items():
+            start = time.perf_counter()
+            for path in argv[1:]:
+                reader(path)
+            seconds = (time.perf_counter() - start) / (len(argv) - 1)
+            print("{:12} {:.2f} ms per song".format(name, seconds * 1000))
+    else:
+        print("python gp_reader.py check SONG... | time SONG...")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
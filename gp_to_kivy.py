@@ -1,21 +1,164 @@
-import guitarpro
-from math import isclose
 import heapq
+from bisect import bisect_left
 from collections import Counter, defaultdict
-
-chrom_scale = 'C C#/Db D D#/Eb E F F#/Gb G G#/Ab A A#/Bb B'.split()
+import numpy as np
+from music_theory import chrom_scale, note_to_pc, pc_bits, find_keys, key_modes, find_chords, chord_name
+from timeline import TrackTimeline
+from gp_reader import NoteType, read_song, track_timeline
+from note_stats import NoteStatistics
+from fingering import FingeringOptimizer
+from retune import retune_frets
 
 
 class KivyBeat:
-    def __init__(self, seconds: float, frets: list, notes: list = None):
+    '''One beat of a track.
+
+    frets and pitches are per string (index 0 is string 1), None where the string isn't played.
+    pitches are MIDI note numbers, notes are pitch classes (0-11, C == 0) and pc_mask is the
+    12-bit mask of those pitch classes.  ties is per string, True where the note is tied to the
+    one before, or None if nothing is.  Use note_names for display.
+    '''
+    def __init__(self, seconds: float, frets: list, notes: list = None, pitches: list = None,
+                 pc_mask: int = 0, ties: list = None):
         self.seconds = seconds
         self.frets = frets
         self.notes = notes
+        self.pitches = pitches
+        self.pc_mask = pc_mask
+        self.ties = ties
+
+    @property
+    def note_names(self):
+        return [chrom_scale[note] for note in self.notes]
+
+
+class MeasureLengthReport:
+    '''Per-measure result of check_measure_lengths().
+
+    One row per (track, measure, voice), all stored as parallel numpy arrays.  Lengths are in
+    Guitar Pro ticks (960 per quarter note), seconds use the measure's own tempo.
+
+        tracks, measures, voices:  0-based track index, MeasureHeader.number, voice index
+        expected:  length of the measure according to its time signature
+        counted_1: sum of beat.duration.time (Guitar Pro does the math)
+        counted_2: sum of beat lengths from value, dots and tuplet (manually do the math)
+        seconds_per_tick: conversion factor for this measure's tempo
+    '''
+    def __init__(self, tracks, measures, voices, expected, counted_1, counted_2,
+                 seconds_per_tick):
+        self.tracks = tracks
+        self.measures = measures
+        self.voices = voices
+        self.expected = expected
+        self.counted_1 = counted_1
+        self.counted_2 = counted_2
+        self.seconds_per_tick = seconds_per_tick
+        # Both calculations must agree with the time signature.  Allow a tick of rounding
+        # because Duration.time truncates tuplets.
+        self.is_length_correct = (np.isclose(counted_1, expected, rtol=0, atol=1) &
+                                  np.isclose(counted_2, expected, rtol=0, atol=1))
+
+    @property
+    def all_beats_captured(self):
+        return bool(self.is_length_correct.all())
+
+    @property
+    def difference(self):
+        '''Ticks over (positive) or under (negative) the expected length of each measure.'''
+        return self.counted_1 - self.expected
+
+    @property
+    def difference_seconds(self):
+        return self.difference * self.seconds_per_tick
+
+    def over(self):
+        return self._rows(~self.is_length_correct & (self.difference > 0))
+
+    def under(self):
+        return self._rows(~self.is_length_correct & (self.difference <= 0))
+
+    def errors(self):
+        '''List of (track, measure, voice, expected, counted, difference_seconds) for every bad
+        measure, in track/measure order.'''
+        return self._rows(~self.is_length_correct)
+
+    def _rows(self, mask):
+        idx = np.flatnonzero(mask)
+        return [(int(self.tracks[i]), int(self.measures[i]), int(self.voices[i]),
+                 int(self.expected[i]), int(self.counted_1[i]),
+                 float(self.difference_seconds[i])) for i in idx]
+
+    def print_errors(self):
+        for track, measure, voice, expected, counted, seconds in self.errors():
+            print("Track {}  Measure {}  Voice {}  Expected {}  Counted {}  ({:+.4f}s)".format(
+                track + 1, measure, voice + 1, expected, counted, seconds))
+
+
+def check_measure_lengths(gp_song):
+    '''Ensure length of every beat is correct, and that no beats have been missed, in every
+    measure of every track and voice.
+
+    We need beat lengths in seconds for GUI.  Calculating this may be error-prone due to
+    GuitarPro/PyGuitarPro/music theory.  Make sure sum of beats in each measure is equal to the
+    measure's length, calculated two different ways to catch logic errors or issues with the
+    guitar pro file.
+
+    The object graph is walked once to fill flat duration arrays, then every sum and comparison
+    is done with numpy.  Cheap enough to triage a whole library without building the songs.
+
+    Return MeasureLengthReport.
+    '''
+    # Per (track, measure, voice) group.
+    tracks, measures, voices, expected, seconds_per_tick = [], [], [], [], []
+    # Per beat.
+    group, times, values, enters, tuplet_times, dotted, double_dotted = [], [], [], [], [], [], []
+
+    for t, gp_track in enumerate(gp_song.tracks):
+        for gp_measure in gp_track.measures:
+            header = gp_measure.header
+            # Second voice holds default values, same as _build_track().
+            for v, voice in enumerate(gp_measure.voices[:-1]):
+                g = len(tracks)
+                tracks.append(t)
+                measures.append(header.number)
+                voices.append(v)
+                expected.append(header.length)
+                seconds_per_tick.append(60 / (960 * header.tempo.value))
+                for beat in voice.beats:
+                    duration = beat.duration
+                    group.append(g)
+                    times.append(duration.time)
+                    values.append(duration.value)
+                    enters.append(duration.tuplet.enters)
+                    tuplet_times.append(duration.tuplet.times)
+                    dotted.append(duration.isDotted)
+                    double_dotted.append(duration.isDoubleDotted)
+
+    group = np.array(group, dtype=np.intp)
+    # Manually do the math: a whole note is 4 quarters of 960 ticks.
+    manual = 3840 / np.array(values, dtype=float)
+    manual *= np.array(tuplet_times, dtype=float) / np.array(enters, dtype=float)
+    manual *= np.where(dotted, 3 / 2, np.where(double_dotted, 7 / 4, 1))
+
+    n_groups = len(tracks)
+    counted_1 = np.bincount(group, weights=np.array(times, dtype=float), minlength=n_groups)
+    counted_2 = np.bincount(group, weights=manual, minlength=n_groups)
+    return MeasureLengthReport(np.array(tracks, dtype=np.intp),
+                               np.array(measures, dtype=np.intp),
+                               np.array(voices, dtype=np.intp),
+                               np.array(expected, dtype=float),
+                               counted_1, counted_2,
+                               np.array(seconds_per_tick, dtype=float))
 
 
 class GPReader:
-    def __init__(self, file):
-        self.gp_song = guitarpro.parse(file)
+    '''
+    reader chooses the parser, see gp_reader.read_song: "fast" reads only what the app uses
+    (and falls back to pyguitarpro for files it can't read), "pyguitarpro" the full object
+    model, or a callable taking the file.
+    '''
+    def __init__(self, file, reader="fast"):
+        self.gp_song = read_song(file, reader)
         self.gp_key_sig = self._gp_key_sig_parser(self.gp_song)
         self.gp_tunings = self._gp_tuning_parser(self.gp_song)
 
@@ -24,9 +167,8 @@ class GPReader:
         for track in gp_song.tracks:
             tuning = []
             for string in track.strings:
-                octave, open_string = divmod(string.value, 12)
-                note = chrom_scale[open_string]
-                tuning.append([string.number, note])
+                # MIDI note number of the open string, chrom_scale[value % 12] for display.
+                tuning.append([string.number, string.value])
             gp_tunings.append(tuning[:])
         return gp_tunings
 
@@ -41,16 +183,83 @@ class GPReader:
         return circ_of_fifths[mode][pos], modes[mode]
 
 
+_track_pools = {}  # workers: (pool, number of processes in it).
+RETUNINGS_KEPT = 4  # Per track, see KivySongBuilder.retune.
+
+
+def _track_pool(workers):
+    '''(pool, size), the process pool is kept for the next song and started with spawn so it
+    doesn't inherit Kivy.'''
+    if workers not in _track_pools:
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+        import os
+        if not _track_pools:
+            import atexit
+            atexit.register(_shutdown_track_pools)
+        size = workers or os.cpu_count() or 1
+        _track_pools[workers] = (ProcessPoolExecutor(size, multiprocessing.get_context("spawn")),
+                                 size)
+    return _track_pools[workers]
+
+
+def _shutdown_track_pools():
+    for pool, size in _track_pools.values():
+        pool.shutdown(cancel_futures=True)
+    _track_pools.clear()
+
+
+def _submit_track_builds(build, file, num_tracks, workers, reader="fast"):
+    '''Futures of build(file, first, step, reader), one task per worker with every step-th
+    track, so no worker parses the file for nothing.'''
+    pool, size = _track_pool(workers)
+    step = min(size, num_tracks)
+    return [pool.submit(build, file, first, step, reader) for first in range(step)]
+
+
+def build_tracks(file, first=0, step=1, reader="fast"):
+    '''Parse file and build tracks first, first + step, ... as KivySongBuilder._build_track_arrays
+    dicts.  Runs in the pool workers, numpy arrays pickle as flat buffers rather than the
+    object graphs of KivyBeats and pyguitarpro models.'''
+    builder = KivySongBuilder.__new__(KivySongBuilder)
+    GPReader.__init__(builder, file, reader)
+    return [builder._build_track_arrays(track_num)
+            for track_num in range(first, len(builder.gp_song.tracks), step)]
+
+
 class KivySongBuilder(GPReader):
-    def __init__(self, file):
-        super().__init__(file)
-        self.song, self.song_data = self._build_song()
+    '''
+    workers=None builds and analyses the tracks one after another.  Otherwise the per track work
+    of songs with more than one track is spread over a pool of that many processes (0 for one
+    per core), see build_tracks: each worker parses the file itself and sends its tracks back
+    as arrays, which are turned into KivyBeats here as they arrive.  reader is passed on to
+    GPReader.
+    '''
+    def __init__(self, file, workers=None, reader="fast"):
+        super().__init__(file, reader)
+        num_tracks = len(self.gp_song.tracks)
+        if workers is None or num_tracks < 2:
+            self.song, self.song_data = self._build_song()
+            self.timelines, self.note_stats = self._build_timelines()
+            self.optimized_frets = self._optimize_song_fingerings()
+            self.key_sigs_per_measure = self._detect_song_key_signatures()
+            self.key_sigs_per_measure_nr = self._detect_song_key_signatures_nr()
+            self.key_profiles_per_measure = self._detect_song_key_profiles()
+            self.beat_chords, self.measure_chords = self._detect_song_chords()
+        else:
+            self._merge_track_builds(_submit_track_builds(build_tracks, file, num_tracks,
+                                                          workers, reader))
+        # song as written, self.song may be swapped for a retuned version (see apply_tuning).
+        self.original_song = self.song[:]
+        self._retuned_tracks = {}
+        self._aligned_timelines = {}
         self.song_data_no_repeat = self._strip_repeat_groups()
-        self.key_sigs_per_measure = self._detect_song_key_signatures()
-        self.key_sigs_per_measure_nr = self._detect_song_key_signatures_nr()
+        self.detected_key_sig = self._detect_song_key_profile()
         self.note_counts = self._note_counter()
+        self.beat_chord_names = self._name_song_chords()
         # Might not need functions associated with all_beats_captured.
-        self.all_beats_captured = self._sum_and_check_song()
+        self.measure_length_report = self._sum_and_check_song()
+        self.all_beats_captured = self.measure_length_report.all_beats_captured
 
     def _build_song(self):
         '''
@@ -107,15 +316,20 @@ class KivySongBuilder(GPReader):
                 for gp_beat in gp_voice.beats:
                     seconds = gp_beat.duration.time / 960 * (self.gp_song.tempo / 60) ** (-1)
 
-                    frets, notes = [None] * 6, []
+                    frets, pitches, notes, pc_mask = [None] * 6, [None] * 6, [], 0
+                    ties = None
                     for gp_note in gp_beat.notes:
                         frets[gp_note.string - 1] = gp_note.value
+                        pitches[gp_note.string - 1] = gp_note.realValue
+                        if gp_note.type.value == NoteType.tie.value:
+                            ties = ties or [False] * 6
+                            ties[gp_note.string - 1] = True
 
-                        octave, semitone = divmod(gp_note.realValue, 12)
-                        note = chrom_scale[semitone]
-                        notes += [note]
+                        semitone = gp_note.realValue % 12
+                        notes.append(semitone)
+                        pc_mask |= pc_bits[semitone]
 
-                    beat = KivyBeat(seconds, frets, notes)
+                    beat = KivyBeat(seconds, frets, notes, pitches, pc_mask, ties)
                     measure.append(beat)
                     measure_data.append(beat)
                 repeat_group_data.append(measure_data[:])
@@ -142,6 +356,182 @@ class KivySongBuilder(GPReader):
                     repeat_group_data.clear()
         return track, track_data
 
+    def _build_track_arrays(self, track_num):
+        '''Everything the per track build and analysis produce for one track, as arrays.'''
+        gp_track = self.gp_song.tracks[track_num]
+        track, track_data = self._build_track(gp_track)
+        timeline = track_timeline(self.gp_song, track_num)
+        measure_index = {id(gp_measure.header): i for i, gp_measure in enumerate(gp_track.measures)}
+        beat_chords, measure_chords = self._track_chords(timeline)
+        return dict(
+            track_num=track_num,
+            seconds=timeline.seconds, frets=timeline.frets, pitches=timeline.pitches,
+            pc_masks=timeline.pc_masks, measure_starts=timeline.measure_starts,
+            measure_numbers=timeline.measure_numbers, ties=timeline.ties,
+            # gp_track.measures index of each measure of track_data, for its header.
+            measures=np.array([measure_index[id(measure[0])] for measure in track_data],
+                              dtype=np.int32),
+            optimized_frets=self.optimize_fingering(track_num, timeline=timeline),
+            key_sigs=np.array(self._detect_track_key_signatures(gp_track), dtype=np.uint16),
+            key_sigs_nr=np.array(self._detect_track_key_signatures_nr(gp_track), dtype=np.uint16),
+            key_profiles=self._track_key_profiles(NoteStatistics(timeline)),
+            beat_chords=beat_chords, measure_chords=measure_chords)
+
+    def _merge_track_builds(self, futures):
+        '''Set the per track attributes from the _build_track_arrays results of futures, each
+        track as soon as its worker is done with it, while the others are still working.'''
+        from concurrent.futures import as_completed
+        num_tracks = len(self.gp_song.tracks)
+        for name in ("song", "song_data", "timelines", "note_stats", "optimized_frets",
+                     "key_sigs_per_measure", "key_sigs_per_measure_nr",
+                     "key_profiles_per_measure", "beat_chords", "measure_chords"):
+            setattr(self, name, [None] * num_tracks)
+        for future in as_completed(futures):
+            for build in future.result():
+                self._merge_track_build(build)
+
+    def _merge_track_build(self, build):
+        '''KivyBeats, song_data and the rest of one track from its _build_track_arrays dict.'''
+        track_num = build["track_num"]
+        gp_track = self.gp_song.tracks[track_num]
+        timeline = TrackTimeline(build["seconds"], build["frets"], build["pitches"],
+                                 build["pc_masks"], build["measure_starts"],
+                                 build["measure_numbers"], ties=build["ties"])
+        track = []
+        for seconds, frets, pitches, pc_mask, ties in zip(timeline.seconds.tolist(),
+                                                          timeline.frets.tolist(),
+                                                          timeline.pitches.tolist(),
+                                                          timeline.pc_masks.tolist(),
+                                                          timeline.ties.tolist()):
+            track.append(KivyBeat(seconds,
+                                  [None if fret < 0 else fret for fret in frets],
+                                  [pitch % 12 for pitch in pitches if pitch >= 0],
+                                  [None if pitch < 0 else pitch for pitch in pitches],
+                                  pc_mask, ties if any(ties) else None))
+        starts = timeline.measure_starts.tolist()
+        self.song_data[track_num] = [[gp_track.measures[index].header] + track[start:stop]
+                                     for index, start, stop in zip(build["measures"].tolist(),
+                                                                   starts, starts[1:])]
+        self.song[track_num] = track
+        self.timelines[track_num] = timeline
+        self.note_stats[track_num] = NoteStatistics(timeline)
+        self.optimized_frets[track_num] = build["optimized_frets"]
+        self.key_sigs_per_measure[track_num] = build["key_sigs"].tolist()
+        self.key_sigs_per_measure_nr[track_num] = build["key_sigs_nr"].tolist()
+        self.key_profiles_per_measure[track_num] = build["key_profiles"]
+        self.beat_chords[track_num] = build["beat_chords"]
+        self.measure_chords[track_num] = build["measure_chords"]
+
+    def _build_timelines(self):
+        '''Array form of each track (TrackTimeline) and its windowed note statistics.  Same as
+        TrackTimeline.from_track_data of song_data, filled from gp_song directly.'''
+        timelines = [track_timeline(self.gp_song, track_num)
+                     for track_num in range(len(self.song_data))]
+        return timelines, [NoteStatistics(timeline) for timeline in timelines]
+
+    def _optimize_song_fingerings(self):
+        '''Re-fingered (N, strings) fret matrix of each track for its own tuning, chosen to
+        minimize hand movement and stretch.  See fingering.FingeringOptimizer.'''
+        return [self.optimize_fingering(track_num) for track_num in range(len(self.timelines))]
+
+    def optimize_fingering(self, track_num, tuning=None, timeline=None):
+        '''Re-finger one track, for its own tuning or for tuning (open string MIDI values, index 0
+        is string 1).'''
+        if tuning is None:
+            tuning = [value for number, value in self.gp_tunings[track_num]]
+        if timeline is None:
+            timeline = self.timelines[track_num]
+        return FingeringOptimizer(tuning).optimize(timeline.pitches)
+
+    def retune(self, track_num, tuning, capo=0, transpose=0):
+        '''Track track_num remapped to tuning (open string MIDI values, index 0 is string 1),
+        capo and transposition in semitones.  Notes that fall off the neck move to other strings.
+
+        Results are cached per (track, tuning, capo, transpose), the last RETUNINGS_KEPT of
+        each track, so switching back and forth between tunings doesn't redo any work.  Each
+        cached track is patched by every measure edit, see _splice_measures.
+
+        Return (track, dropped): list of KivyBeat and the number of notes that couldn't be placed.
+        '''
+        key = (track_num, tuple(tuning), capo, transpose)
+        if key in self._retuned_tracks:
+            # Most recently used last.
+            self._retuned_tracks[key] = self._retuned_tracks.pop(key)
+            return self._retuned_tracks[key]
+        track, dropped = self._retune_beats(self.timelines[track_num], *key[1:])
+        self._retuned_tracks[key] = track, dropped
+        # Oldest first, but never the one that's playing: edits only patch cached tracks.
+        old = [cached for cached, (cached_track, _) in self._retuned_tracks.items()
+               if cached[0] == track_num and cached_track is not self.song[track_num]]
+        for cached in old[:max(len(old) - RETUNINGS_KEPT, 0)]:
+            del self._retuned_tracks[cached]
+        return track, dropped
+
+    @staticmethod
+    def _retune_beats(timeline, tuning, capo=0, transpose=0, start=0, stop=None):
+        '''KivyBeats of timeline beats [start, stop) retuned, and the number of dropped notes.'''
+        frets, dropped = retune_frets(timeline.pitches[start:stop], tuning, capo, transpose)
+
+        open_strings = np.array(tuning) + capo
+        pitches = np.where(frets >= 0, frets + open_strings, -1)
+        track = []
+        for seconds, beat_frets, beat_pitches in zip(timeline.seconds[start:stop].tolist(),
+                                                     frets.tolist(), pitches.tolist()):
+            notes, pc_mask = [], 0
+            for pitch in beat_pitches:
+                if pitch >= 0:
+                    notes.append(pitch % 12)
+                    pc_mask |= pc_bits[pitch % 12]
+            track.append(KivyBeat(seconds,
+                                  [None if fret < 0 else fret for fret in beat_frets],
+                                  notes,
+                                  [None if pitch < 0 else pitch for pitch in beat_pitches],
+                                  pc_mask))
+        return track, dropped
+
+    def apply_tuning(self, track_num, tuning, capo=0, transpose=0):
+        '''Swap self.song[track_num] (what the fretboards play) for its retuned version.  The
+        track's own tuning with no capo or transposition restores the original.'''
+        original_tuning = [value for number, value in self.gp_tunings[track_num]]
+        if list(tuning) == original_tuning and not capo and not transpose:
+            self.song[track_num] = self.original_song[track_num]
+            return 0
+        self.song[track_num], dropped = self.retune(track_num, tuning, capo, transpose)
+        return dropped
+
+    def align_track(self, track_num, recorded, grid="notes"):
+        '''Timeline of track track_num warped onto times from a recording, see alignment.py.
+        grid says what the recorded times are: "notes", "beats" or "measures".
+
+        Kept per track until the track is edited or aligned to different times, see
+        aligned_timeline.
+        '''
+        from alignment import warp_timeline
+        recorded = np.asarray(recorded, dtype=np.float64)
+        key = (grid, recorded.tobytes())
+        cached = self._aligned_timelines.get(track_num)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        timeline = warp_timeline(self.timelines[track_num], recorded, grid,
+                                 self.time_signature_numerators(track_num))
+        self._aligned_timelines[track_num] = key, timeline
+        return timeline
+
+    def aligned_timeline(self, track_num):
+        '''The track's last align_track result, None if it hasn't been aligned.'''
+        cached = self._aligned_timelines.get(track_num)
+        return None if cached is None else cached[1]
+
+    def time_signature_numerators(self, track_num):
+        '''(M,) beats per measure of a track, in song_data order.'''
+        return np.array([measure[0].timeSignature.numerator
+                         for measure in self.song_data[track_num]], dtype=np.intp)
+
+    def export_midi(self, path, track_num=0):
+        '''Write one track to a Standard MIDI File, see midi_io.export_track.'''
+        from midi_io import export_track
+        return export_track(self, track_num, path)
+
     @property
     def track_lengths(self):
         track_lengths = []
@@ -156,7 +546,7 @@ class KivySongBuilder(GPReader):
     def print_song(self):
         for i, track in enumerate(self.song):
             for j, beat in enumerate(track):
-                print("\t", j, beat.frets, beat.notes, beat.seconds)
+                print("\t", j, beat.frets, beat.note_names, beat.seconds)
 
     def print_song_data(self):
         for i, track in enumerate(self.song_data, 1):
@@ -170,92 +560,135 @@ class KivySongBuilder(GPReader):
                     header.repeatClose,
                     header.repeatAlternative))
                 for beat in measure[1:]:
-                    print("\t", beat.frets, beat.notes, beat.seconds)
+                    print("\t", beat.frets, beat.note_names, beat.seconds)
                     seconds += beat.seconds
                 header_time += header.length / 960 * (self.gp_song.tempo / 60) ** (-1)
                 print("\t", "HeaderTime {}  CalcTime {}".format(header_time, seconds))
             return
 
+    ### Editing ###
+    # Measures are numbered from 1 in song_data order, like print_song_data, and ranges include
+    # both ends.  Every edit is a splice of song_data: the song, timelines, statistics and
+    # analyses are patched over the edited measures (plus a few neighbours for windowed
+    # analyses) instead of being rebuilt, so fixing a few measures of a long song is cheap.
+
     def del_measures(self, start, stop=None):
         '''
         Problem reading Measure.Header.repeatAlternative causes extra measures to be added.
-        Delete the extra measures manually here, then rewrite the song for kivy.
+        Delete the extra measures (start to stop, default just start) from every track here.
         '''
-        start -= 1
         if stop is None:
-            stop = start + 1
-        for track in range(len(self.song_data)):
-            for measure in reversed(range(start, stop)):
-                del self.song_data[track][measure]
-        self._rewrite_song()
-
-    def _rewrite_song(self):
-        song = []
-        for track_data in self.song_data:
-            track = []
-            for measure in track_data:
-                track.extend(measure[1:])
-            song.append(track)
-        self.song = song
+            stop = start
+        for track_num in range(len(self.song_data)):
+            self._splice_measures(track_num, start - 1, stop, [])
+        self._update_song_totals()
 
-    def _sum_and_check_song(self):
-        for track in self.gp_song.tracks:
-            if not self._sum_and_check_track(track):
-                return False
-        return True
+    def insert_measures(self, before, measures):
+        '''Insert measures before measure number before (len + 1 appends).  measures is one
+        list of song_data style measures ([header, KivyBeat, ...]) per track.'''
+        for track_num, track_measures in enumerate(measures):
+            self._splice_measures(track_num, before - 1, before - 1, list(track_measures))
+        self._update_song_totals()
+
+    def copy_measures(self, start, stop, before):
+        '''Insert a copy of measures start to stop before measure number before.'''
+        self.insert_measures(before, [track_data[start - 1:stop] for track_data in self.song_data])
+
+    def move_measures(self, start, stop, before):
+        '''Move measures start to stop so they come right before measure number before.'''
+        if start <= before <= stop + 1:
+            return
+        moved = [track_data[start - 1:stop] for track_data in self.song_data]
+        for track_num in range(len(self.song_data)):
+            self._splice_measures(track_num, start - 1, stop, [])
+        if before > stop:
+            before -= stop - start + 1
+        self.insert_measures(before, moved)
 
-    def _sum_and_check_track(self, track):
-        for measure in track.measures:
-            if not self._sum_and_check_measure(measure):
-                return False
-        return True
+    def _splice_measures(self, track_num, start, stop, measures):
+        '''Replace measures [start, stop) (0-based) of one track with measures and patch
+        everything derived from that track.  Call _update_song_totals after the last track.'''
+        old_timeline = self.timelines[track_num]
+        b0, b1 = int(old_timeline.measure_starts[start]), int(old_timeline.measure_starts[stop])
+        inserted = TrackTimeline.from_track_data(measures)
+        timeline = old_timeline.splice(start, stop, inserted)
+        self.note_stats[track_num] = self.note_stats[track_num].splice(
+            timeline, start, stop, NoteStatistics(inserted))
+        self.timelines[track_num] = timeline
+        self.song_data[track_num][start:stop] = measures
+        self._aligned_timelines.pop(track_num, None)
 
-    def _sum_and_check_measure(self, measure):
-        '''Ensure length of each beat in seconds is correct, and that no beats have been missed.
+        # song and original_song share track lists unless the track is retuned, and fretboards
+        # hold on to them, so edit them in place.
+        self.original_song[track_num][b0:b1] = [beat for measure in measures for beat in measure[1:]]
+        for key, (track, dropped) in list(self._retuned_tracks.items()):
+            if key[0] == track_num:
+                removed = retune_frets(old_timeline.pitches[b0:b1], *key[1:])[1]
+                track[b0:b1], added = self._retune_beats(timeline, *key[1:], b0, b0 + len(inserted))
+                self._retuned_tracks[key] = track, dropped - removed + added
 
-        We need beat lengths in seconds for GUI.  Calculating this may be error-prone due to
-        GuitarPro/PyGuitarPro/music theory. Make sure sum of beats in this measure is equal to the
-        measure's length. Calculate this a few different ways to catch any logic errors or issues
-        with the guitar pro file.
+        self._splice_fingering(track_num, b0, b1, len(inserted))
+        self._splice_analyses(track_num, start, stop, b0, b1, inserted)
 
-        Return Bool.
+    def _splice_fingering(self, track_num, b0, b1, num_inserted, context=16):
+        '''Re-finger only the inserted beats, with context beats either side so they join up
+        with the fingering around them.'''
+        timeline = self.timelines[track_num]
+        lo, hi = max(b0 - context, 0), min(b0 + num_inserted + context, len(timeline))
+        tuning = [value for number, value in self.gp_tunings[track_num]]
+        frets = FingeringOptimizer(tuning).optimize(timeline.pitches[lo:hi])
+        old = self.optimized_frets[track_num]
+        self.optimized_frets[track_num] = np.concatenate(
+            (old[:b0], frets[b0 - lo:b0 - lo + num_inserted], old[b1:]))
+
+    def _splice_analyses(self, track_num, start, stop, b0, b1, inserted):
+        '''Patch chords, measure keys and the no-repeat view of one track after a splice.'''
+        def join(old, new, first, last):
+            return np.concatenate((old[:first], new, old[last:]))
+
+        beat_chords, measure_chords = self._track_chords(inserted)
+        self.beat_chords[track_num] = join(self.beat_chords[track_num], beat_chords, b0, b1)
+        self.measure_chords[track_num] = join(self.measure_chords[track_num], measure_chords,
+                                              start, stop)
+        self.beat_chord_names[track_num][b0:b1] = self._name_track_chords(inserted, beat_chords)
+        self.key_sigs_per_measure[track_num][start:stop] = inserted.measure_pc_masks.tolist()
+
+        # Windowed keys: measures whose window reaches into the edit, and the last few whose
+        # window is clipped by the end of the track.
+        stats = self.note_stats[track_num]
+        num_measures, width = stats.timeline.num_measures, 4
+        end = start + inserted.num_measures
+        measures = np.union1d(np.arange(max(start - width, 0), min(end + width, num_measures)),
+                              np.arange(max(num_measures - width, 0), num_measures))
+        profiles = []
+        for old, fill in zip(self.key_profiles_per_measure[track_num], (-1, 0, np.nan)):
+            profile = join(old, np.full(inserted.num_measures, fill, dtype=old.dtype), start, stop)
+            profiles.append(profile)
+        if len(measures):
+            for profile, new in zip(profiles, self._track_key_profiles(stats, width, measures)):
+                profile[measures] = new
+        self.key_profiles_per_measure[track_num] = tuple(profiles)
+
+        # Measures before the edit keep their first plays, the rest are scanned again.
+        positions = self._no_repeat_positions[track_num]
+        kept = bisect_left(positions, start)
+        track_data = self.song_data[track_num]
+        positions[kept:] = self._first_plays(track_data, start, kept + 1)
+        self.song_data_no_repeat[track_num][kept:] = [track_data[i] for i in positions[kept:]]
+        key_sigs = self.key_sigs_per_measure[track_num]
+        self.key_sigs_per_measure_nr[track_num][kept:] = [key_sigs[i] for i in positions[kept:]]
+
+    def _update_song_totals(self):
+        '''Whole song results, from the (already patched) per track totals.'''
+        self.note_counts = self._note_counter()
+        self.detected_key_sig = self._detect_song_key_profile()
+
+    def _sum_and_check_song(self):
+        '''Check every measure of every track and voice in one pass.  See check_measure_lengths().
+
+        Return MeasureLengthReport.
         '''
-        BPM = measure.header.tempo.value
-        beats_this_measure = measure.header.timeSignature.numerator
-
-        seconds_per_beat = (BPM / 60) ** (-1)
-        seconds_this_measure = seconds_per_beat * beats_this_measure
-        seconds_counted_this_measure_1, seconds_counted_this_measure_2 = 0, 0
-        for voice in measure.voices[:-1]:
-            for beat in voice.beats:
-                # Calculate seconds for rests and notes.
-                # Rests == Beat with Beat.Duration but w/o Beat.Note object.
-                seconds_counted_this_measure_1 += self._get_beat_length_1(beat)
-                seconds_counted_this_measure_2 += self._get_beat_length_2(measure, beat)
-
-            is_length_correct = isclose(seconds_this_measure, seconds_counted_this_measure_1,
-                                        abs_tol=0.0001) and isclose(seconds_this_measure,
-                                                                    seconds_counted_this_measure_2,
-                                                                    abs_tol=0.0001)
-        return is_length_correct
-
-    def _get_beat_length_1(self, beat):
-        # Guitar Pro does the math.
-        return beat.duration.time / 960 * (self.gp_song.tempo / 60) ** (-1)
-
-    def _get_beat_length_2(self, measure, beat):
-        # Manually do the math.
-        BPM = measure.header.tempo.value
-        seconds_per_beat = (BPM / 60) ** (-1)
-        unit_beat = measure.header.timeSignature.denominator.value
-        percentage_beat = unit_beat / beat.duration.value
-        tuplet_feel = beat.duration.tuplet.times / beat.duration.tuplet.enters
-        seconds = seconds_per_beat * percentage_beat * tuplet_feel
-        if beat.duration.isDotted:
-            seconds *= (3 / 2)
-        elif beat.duration.isDoubleDotted:
-            seconds *= (7 / 4)
-        return seconds
+        return check_measure_lengths(self.gp_song)
 
     ### Music Theory Section ###
     def _detect_song_key_signatures(self):
@@ -267,25 +700,6 @@ class KivySongBuilder(GPReader):
 
     def _detect_track_key_signatures(self, gp_track):
         track_keys = []
-        note_filter = {
-            "C": 0b100000000000,
-            "C#/Db": 0b010000000000,
-            "D": 0b001000000000,
-            "D#/Eb": 0b000100000000,
-            "E": 0b000010000000,
-            "F": 0b000001000000,
-            "F#/Gb": 0b000000100000,
-            "G": 0b000000010000,
-            "G#/Ab": 0b000000001000,
-            "A": 0b000000000100,
-            "A#/Bb": 0b000000000010,
-            "B": 0b000000000001,
-        }
-        note_to_int = {
-            "C": 2048, "C#/Db": 1024, "D": 512, "D#/Eb": 256,
-            "E": 128, "F": 64, "F#/Gb": 32, "G": 16,
-            "G#/Ab": 8, "A": 4, "A#/Bb": 2, "B": 1,
-        }
         maj_filter = {
             'c_maj': 0b101011010101,
             'cs_maj': 0b110101101010,
@@ -312,9 +726,7 @@ class KivySongBuilder(GPReader):
             for voice in gp_measure.voices[:-1]:
                 for gp_beat in voice.beats:
                     for gp_note in gp_beat.notes:
-                        octave, semitone = divmod(gp_note.realValue, 12)
-                        note = chrom_scale[semitone]
-                        key_filter |= note_filter[note]
+                        key_filter |= pc_bits[gp_note.realValue % 12]
             this_measure_key.append(key_filter)
             # If we're starting a repeat group, let this_measure build until its closed.
             if gp_measure.header.isRepeatOpen:
@@ -332,6 +744,71 @@ class KivySongBuilder(GPReader):
                 this_measure_key.clear()
         return track_keys
 
+    def _detect_song_key_profiles(self, width=4):
+        '''Profile-correlation (Krumhansl-Schmuckler) key of every measure of every track.
+
+        Unlike the bitmask filters, a key isn't ruled out by a single passing tone: each measure
+        gets the key that best correlates with the duration-weighted pitch classes of the width
+        measures around it.  All windows of a track are scored in one batch.
+
+        Return [(roots, modes, scores), ...] per track, arrays with one entry per measure of
+        song_data (see music_theory.find_keys).
+        '''
+        return [self._track_key_profiles(stats, width) for stats in self.note_stats]
+
+    @staticmethod
+    def _track_key_profiles(stats, width=4, measures=None):
+        '''(roots, modes, scores) of measures (default all) of one track.'''
+        num_measures = stats.timeline.num_measures
+        if measures is None:
+            measures = np.arange(num_measures)
+        track_width = max(min(width, num_measures), 1)
+        # Measure m takes the window centered on it, windows at the edges are reused.
+        starts = np.clip(measures - track_width // 2, 0, max(num_measures - track_width, 0))
+        return find_keys(stats.measures(starts, starts + track_width))
+
+    def _detect_song_key_profile(self):
+        '''Best key for the whole song, (root pitch class, mode name).  Falls back to the key
+        in the file if there are no notes.'''
+        roots, modes, scores = find_keys(sum(stats.total_seconds for stats in self.note_stats))
+        if roots[0] < 0:
+            note, mode = self.gp_key_sig
+            return note_to_pc[note], mode
+        return int(roots[0]), key_modes[modes[0]]
+
+    def _detect_song_chords(self):
+        '''Chord of every beat and every measure of every track, see music_theory.find_chords.
+
+        The root is inferred from the lowest sounding note, so C E G A is C6 with C in the bass
+        and Am7 with A in the bass.  A measure's chord is that of all its pitch classes over its
+        lowest note.  Return ([(N,) chords per track], [(M,) chords per track]).
+        '''
+        chords = [self._track_chords(timeline) for timeline in self.timelines]
+        return [beat for beat, measure in chords], [measure for beat, measure in chords]
+
+    @staticmethod
+    def _track_chords(timeline):
+        bass = timeline.bass_pitches
+        beat_chords = find_chords(timeline.pc_masks, np.where(bass >= 0, bass % 12, -1))
+
+        measure_bass = np.full(timeline.num_measures, -1)
+        filled = np.flatnonzero(np.diff(timeline.measure_starts))
+        if len(filled):
+            lowest = np.minimum.reduceat(np.where(bass >= 0, bass, 1 << 14),
+                                         timeline.measure_starts[filled])
+            measure_bass[filled] = np.where(lowest < (1 << 14), lowest % 12, -1)
+        return beat_chords, find_chords(timeline.measure_pc_masks, measure_bass)
+
+    def _name_song_chords(self):
+        '''Display name of each beat's chord, per track, aligned with self.song.'''
+        return [self._name_track_chords(timeline, chords)
+                for timeline, chords in zip(self.timelines, self.beat_chords)]
+
+    @staticmethod
+    def _name_track_chords(timeline, chords):
+        return [chord_name(chord, pitch % 12 if pitch >= 0 else -1)
+                for chord, pitch in zip(chords.tolist(), timeline.bass_pitches.tolist())]
+
     def _detect_song_key_signatures_nr(self):
         song_keys = []
         for track in self.gp_song.tracks:
@@ -341,25 +818,6 @@ class KivySongBuilder(GPReader):
 
     def _detect_track_key_signatures_nr(self, gp_track):
         track_keys = []
-        note_filter = {
-            "C": 0b100000000000,
-            "C#/Db": 0b010000000000,
-            "D": 0b001000000000,
-            "D#/Eb": 0b000100000000,
-            "E": 0b000010000000,
-            "F": 0b000001000000,
-            "F#/Gb": 0b000000100000,
-            "G": 0b000000010000,
-            "G#/Ab": 0b000000001000,
-            "A": 0b000000000100,
-            "A#/Bb": 0b000000000010,
-            "B": 0b000000000001,
-        }
-        note_to_int = {
-            "C": 2048, "C#/Db": 1024, "D": 512, "D#/Eb": 256,
-            "E": 128, "F": 64, "F#/Gb": 32, "G": 16,
-            "G#/Ab": 8, "A": 4, "A#/Bb": 2, "B": 1,
-        }
         maj_filter = {
             'c_maj': 0b101011010101,
             'cs_maj': 0b110101101010,
@@ -385,39 +843,39 @@ class KivySongBuilder(GPReader):
             for voice in gp_measure.voices[:-1]:
                 for gp_beat in voice.beats:
                     for gp_note in gp_beat.notes:
-                        octave, semitone = divmod(gp_note.realValue, 12)
-                        note = chrom_scale[semitone]
-                        key_filter |= note_filter[note]
+                        key_filter |= pc_bits[gp_note.realValue % 12]
             track_keys.append(key_filter)
         return track_keys
 
     def _note_counter(self):
-        '''Create 2 dictionaries per track to map each note to its total number of occurences and
-        total number of seconds.  For eventual use in key signature detection.'''
+        '''Create 2 lists per track, indexed by pitch class, with each note's total number of
+        occurences and total number of seconds.  For eventual use in key signature detection.
+
+        These are the whole-track totals of self.note_stats, use NoteStatistics for bar ranges
+        and time windows.'''
         note_counts = []
-        for track in self.song:
-            track_note_counts, track_note_seconds = {n: 0 for n in chrom_scale}, {n: 0 for n in
-                                                                                  chrom_scale}
-            for beat in track:
-                for note in beat.notes:
-                    track_note_counts[note] += 1
-                    track_note_seconds[note] += beat.seconds
+        for stats in self.note_stats:
+            track_note_counts = [int(count) for count in stats.total_counts]
+            track_note_seconds = stats.total_seconds.tolist()
             note_counts.append([track_note_counts, track_note_seconds])
         return note_counts
 
     def _strip_repeat_groups(self):
         '''Removes repeat groups from song_data and saves it for later.'''
-        stripped_song_data = []
-        for track_data in self.song_data:
-            stripped_track_data = []
-            nxt_measure = 1
-            for measure in track_data:
-                header = measure[0]
-                if header.number == nxt_measure:
-                    stripped_track_data.append(measure)
-                    nxt_measure += 1
-            stripped_song_data.append(stripped_track_data)
-        return stripped_song_data
+        # Index in song_data of each measure of song_data_no_repeat, for edits.
+        self._no_repeat_positions = [self._first_plays(track_data) for track_data in self.song_data]
+        return [[track_data[i] for i in positions]
+                for track_data, positions in zip(self.song_data, self._no_repeat_positions)]
+
+    @staticmethod
+    def _first_plays(track_data, start=0, nxt_measure=1):
+        '''Indices of the first play of each measure number, scanning from track_data[start].'''
+        positions = []
+        for i in range(start, len(track_data)):
+            if track_data[i][0].number == nxt_measure:
+                positions.append(i)
+                nxt_measure += 1
+        return positions
 
     def print_song_data_no_repeat(self):
         '''Pretty prints stripped_song_data from _strip_repeat_groups().'''
@@ -432,12 +890,50 @@ class KivySongBuilder(GPReader):
                     header.repeatClose,
                     header.repeatAlternative))
                 for beat in measure[1:]:
-                    print("\t", beat.frets, beat.notes, beat.seconds)
+                    print("\t", beat.frets, beat.note_names, beat.seconds)
                     seconds += beat.seconds
                 header_time += header.length / 960 * (self.gp_song.tempo / 60) ** (-1)
                 print("\t", "HeaderTime {}  CalcTime {}".format(header_time, seconds))
         return
 
+class TimelineSong(GPReader):
+    '''The parts of KivySongBuilder that catalogs use: timelines, note statistics, per measure
+    keys and the song's key, all the same as KivySongBuilder's.  Built straight from the parsed
+    song (see gp_reader.track_timeline), with no KivyBeats, fingering or chords.
+
+    The default builder of library.build_library and RiffIndex.update.  workers is the same as
+    KivySongBuilder's, the pool is shared with it, see build_timelines.
+    '''
+    def __init__(self, file, reader="fast", workers=None):
+        super().__init__(file, reader)
+        num_tracks = len(self.gp_song.tracks)
+        if workers is None or num_tracks < 2:
+            builds = build_timelines(self.gp_song)
+        else:
+            futures = _submit_track_builds(build_timelines, file, num_tracks, workers, reader)
+            builds = sorted((build for future in futures for build in future.result()),
+                            key=lambda build: build[0])
+        self.timelines = [build[1] for build in builds]
+        self.note_stats = [build[2] for build in builds]
+        self.key_profiles_per_measure = [build[3] for build in builds]
+        self.detected_key_sig = self._detect_song_key_profile()
+
+    _detect_song_key_profile = KivySongBuilder._detect_song_key_profile
+
+
+def build_timelines(file, first=0, step=1, reader="fast"):
+    '''[(track_num, TrackTimeline, NoteStatistics, key profiles)] of tracks first, first + step,
+    ... of file (or a parsed song).  Runs in the pool workers for TimelineSong, everything in
+    it pickles as numpy arrays.'''
+    gp_song = read_song(file, reader) if isinstance(file, str) else file
+    builds = []
+    for track_num in range(first, len(gp_song.tracks), step):
+        timeline = track_timeline(gp_song, track_num)
+        stats = NoteStatistics(timeline)
+        builds.append((track_num, timeline, stats, KivySongBuilder._track_key_profiles(stats)))
+    return builds
+
+
 # WORK IN PROGRESS.  Best way to find key signature(s) of song...?
 # TODO: Improve pruning/priority level by using repeat groups.
 def test_key_sig_A_star():
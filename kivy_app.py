@@ -13,8 +13,7 @@ ClockBaseInterrupt.interrupt_next_only = False
 Config.set('graphics', 'width', '800')
 Config.set('graphics', 'height', '300')
 
-from gp_to_kivy import KivySongBuilder
-from music_theory import key_sig_color_map
+from music_theory import key_sig_color_map, get_key_sig_color_map
 # from spt_connect_user import spt_play_song
 import time, timeit
 
@@ -34,6 +33,8 @@ class Main(BoxLayout):
         self._popup.open()
 
     def load(self, filepath):
+        # Song loading and analysis (pyguitarpro, numpy) isn't imported until it's needed.
+        from gp_to_kivy import KivySongBuilder
         print("Main.load()... filepath: {}".format(filepath))
         self.song = KivySongBuilder(filepath[0])
         self.dismiss_popup()
@@ -54,14 +55,22 @@ class Fretboard(BoxLayout):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.beat_num = 0
-        for string in range(6):
-            self.add_widget(String(num=string, note_val=0))
+        # 150 Fret labels (and their text textures) don't need to hold up the first frame.
+        Clock.schedule_once(self._add_placeholder_strings, 0)
+
+    def _add_placeholder_strings(self, dt):
+        if self.song is None:
+            for string in range(6):
+                self.add_widget(String(num=string, note_val=0))
 
     def on_song(self, arg1, arg2):
         self.clear_widgets()
         self.tracks = self.song.song
+        # Colour the frets in the key detected from the song's note profile.
+        color_map = get_key_sig_color_map(*self.song.detected_key_sig)
         for string in self.song.gp_song.tracks[0].strings:
-            self.add_widget(String(num=string.number, note_val=string.value))
+            self.add_widget(String(num=string.number, note_val=string.value,
+                                   color_map=color_map))
 
     def play_song(self, instance):
         # spt_play_song(self.song)
@@ -90,7 +99,7 @@ class Fretboard(BoxLayout):
 
 
 class String(BoxLayout):
-    def __init__(self, num, note_val, **kwargs):
+    def __init__(self, num, note_val, color_map=key_sig_color_map, **kwargs):
         super(String, self).__init__(**kwargs)
         self.orientation = "horizontal"
         self.size_hint_y = 1/6
@@ -108,11 +117,9 @@ class String(BoxLayout):
             "black": [0, 0, 0, 1]
         }
         temperament = 2**(1/12)  # Ratio of fret[i]/fret[i+1] for 12-tone equal temperament.
-        notes = 'C C#/Db D D#/Eb E F F#/Gb G G#/Ab A A#/Bb B'.split()
         for fret_num in range(25):
-            octave, semitone = divmod(self.note_val+fret_num, 12)
-            note = notes[semitone]
-            color = key_sig_color_map.get(note, "black")
+            semitone = (self.note_val + fret_num) % 12
+            color = color_map[semitone] or "black"
             fret = Fret(fret_color=fret_colors[color], size_hint_x=(1 / temperament ** fret_num),
                         text=str(fret_num))
             if fret_num == 0:
@@ -0,0 +1,251 @@
+import json
+import mmap
+import os
+import sys
+import time
+import numpy as np
+
+from music_theory import key_modes, note_to_pc
+from timeline import TrackTimeline
+
+'''Many compiled songs in one memory-mapped file.
+
+The file holds every track's TrackTimeline arrays, measure index and per measure keys, laid out
+back to back and found through an offset table, so opening a song is a handful of numpy views
+into the mapping: nothing is parsed or copied, and every process that opens the library shares
+the same pages of the OS page cache.
+
+    build_library("set.fretlib", paths)
+    library = Library("set.fretlib")
+    song = library.song("tgr-nm-01-g1.gp5")  # Or an index.
+    song.timelines[0].pitches
+
+Layout, all little-endian:
+
+    header     HEADER_DTYPE, offsets of the tables below
+    arrays     per track, TRACK_ARRAYS in order, each aligned to ALIGN bytes
+    songs      SONG_DTYPE table, one row per song
+    tracks     track_dtype() table, one row per track with the offset of each of its arrays
+    paths      JSON list of song paths, same order as songs
+'''
+
+MAGIC = b"FRETLIB2"
+ALIGN = 64
+NUM_STRINGS = 6
+
+# (name, dtype, row shape, rows: "beats" or "measures", measure_starts has one extra row).
+TRACK_ARRAYS = [
+    ("seconds", "<f8", (), "beats"),
+    ("onsets", "<f8", (), "beats"),
+    ("frets", "i1", (NUM_STRINGS,), "beats"),
+    ("pitches", "<i2", (NUM_STRINGS,), "beats"),
+    ("pc_masks", "<u2", (), "beats"),
+    ("ties", "?", (NUM_STRINGS,), "beats"),
+    ("measure_starts", "<i8", (), "measures"),
+    ("measure_numbers", "<i8", (), "measures"),
+    ("key_roots", "<i8", (), "measures"),
+    ("key_modes", "<i8", (), "measures"),
+    ("key_scores", "<f8", (), "measures"),
+]
+
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("num_songs", "<u8"), ("songs_offset", "<u8"),
+                         ("num_tracks", "<u8"), ("tracks_offset", "<u8"),
+                         ("paths_offset", "<u8"), ("paths_length", "<u8")])
+SONG_DTYPE = np.dtype([("first_track", "<i8"), ("num_tracks", "<i8"), ("key_root", "<i8"),
+                       ("key_mode", "<i8"), ("mtime", "<f8")])
+
+
+def track_dtype():
+    return np.dtype([("song", "<i8"), ("track", "<i8"), ("num_beats", "<i8"),
+                     ("num_measures", "<i8"), ("tuning", "<i2", (NUM_STRINGS,)),
+                     ("offsets", "<u8", (len(TRACK_ARRAYS),))])
+
+
+def _rows(num_beats, num_measures, rows, name):
+    if rows == "beats":
+        return num_beats
+    return num_measures + 1 if name == "measure_starts" else num_measures
+
+
+class _Writer:
+    '''Appends aligned arrays to a file and remembers where they went.'''
+    def __init__(self, file):
+        self.file = file
+        self.offset = 0
+
+    def write(self, data):
+        padding = -self.offset % ALIGN
+        self.file.write(b"\0" * padding)
+        offset = self.offset + padding
+        self.file.write(data)
+        self.offset = offset + len(data)
+        return offset
+
+
+def build_library(path, paths, builder=None, workers=None):
+    '''Compile songs into a library file at path, return the number of songs.
+
+    builder(path) returns a KivySongBuilder or a TimelineSong (the default, built with
+    workers, see TimelineSong).  The library is written next to path and moved over it, so
+    processes that have the old one open keep a consistent (old) view.
+    '''
+    if builder is None:
+        from gp_to_kivy import TimelineSong
+        builder = lambda song_path: TimelineSong(song_path, workers=workers)
+    songs, tracks, song_paths = [], [], []
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as file:
+        writer = _Writer(file)
+        writer.write(np.zeros(1, HEADER_DTYPE).tobytes())
+        for song_path in paths:
+            song_path = os.path.abspath(song_path)
+            song = builder(song_path)
+            root, mode = song.detected_key_sig
+            songs.append((len(tracks), len(song.timelines), note_to_pc.get(root, root),
+                          key_modes.index(mode), os.path.getmtime(song_path)))
+            song_paths.append(song_path)
+            for track_num, timeline in enumerate(song.timelines):
+                tracks.append(_write_track(writer, len(songs) - 1, track_num, timeline,
+                                           song.key_profiles_per_measure[track_num],
+                                           song.gp_tunings[track_num]))
+
+        header = np.zeros(1, HEADER_DTYPE)
+        header["magic"] = MAGIC
+        header["num_songs"], header["num_tracks"] = len(songs), len(tracks)
+        header["songs_offset"] = writer.write(np.array(songs, SONG_DTYPE).tobytes())
+        header["tracks_offset"] = writer.write(np.array(tracks, track_dtype()).tobytes())
+        paths_json = json.dumps(song_paths).encode()
+        header["paths_offset"] = writer.write(paths_json)
+        header["paths_length"] = len(paths_json)
+        file.seek(0)
+        file.write(header.tobytes())
+    os.replace(tmp, path)
+    return len(songs)
+
+
+def _write_track(writer, song_num, track_num, timeline, key_profiles, gp_tuning):
+    arrays = dict(seconds=timeline.seconds, onsets=timeline.onsets, frets=timeline.frets,
+                  pitches=timeline.pitches, pc_masks=timeline.pc_masks, ties=timeline.ties,
+                  measure_starts=timeline.measure_starts,
+                  measure_numbers=timeline.measure_numbers, key_roots=key_profiles[0],
+                  key_modes=key_profiles[1], key_scores=key_profiles[2])
+    offsets = [writer.write(np.ascontiguousarray(arrays[name], dtype=dtype).tobytes())
+               for name, dtype, shape, rows in TRACK_ARRAYS]
+    tuning = [-1] * NUM_STRINGS
+    for number, value in gp_tuning[:NUM_STRINGS]:
+        tuning[number - 1] = value
+    return song_num, track_num, len(timeline), timeline.num_measures, tuning, offsets
+
+
+class LibrarySong:
+    '''One song of a Library, the parts of KivySongBuilder that are stored in it.
+
+    Every array is a read-only view into the library file.
+    '''
+    def __init__(self, path, timelines, key_profiles_per_measure, detected_key_sig,
+                 gp_tunings, mtime):
+        self.path = path
+        self.timelines = timelines
+        self.key_profiles_per_measure = key_profiles_per_measure
+        self.detected_key_sig = detected_key_sig
+        self.gp_tunings = gp_tunings
+        self.mtime = mtime
+
+    @property
+    def key_sigs_per_measure(self):
+        return [timeline.measure_pc_masks for timeline in self.timelines]
+
+    @property
+    def note_stats(self):
+        '''NoteStatistics of each track.  These are computed, not stored, so they allocate.'''
+        from note_stats import NoteStatistics
+        return [NoteStatistics(timeline) for timeline in self.timelines]
+
+
+class Library:
+    '''Read-only, memory-mapped view of a file written by build_library.
+
+        library = Library("set.fretlib")
+        len(library), library.paths
+        song = library.song(3)
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = np.frombuffer(self._map, HEADER_DTYPE, count=1)[0]
+        if header["magic"] != MAGIC and header["magic"].startswith(MAGIC[:7]):
+            raise ValueError("{} is an older song library, build it again".format(path))
+        if header["magic"] != MAGIC:
+            raise ValueError("{} is not a song library".format(path))
+        self.songs = np.frombuffer(self._map, SONG_DTYPE, int(header["num_songs"]),
+                                   int(header["songs_offset"]))
+        self.tracks = np.frombuffer(self._map, track_dtype(), int(header["num_tracks"]),
+                                    int(header["tracks_offset"]))
+        paths_offset = int(header["paths_offset"])
+        self.paths = json.loads(self._map[paths_offset:paths_offset + int(header["paths_length"])])
+        self._song_nums = {path: num for num, path in enumerate(self.paths)}
+
+    def __len__(self):
+        return len(self.songs)
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self._song_nums
+
+    def close(self):
+        '''Views handed out keep the mapping alive, it's released when they're all gone.'''
+        self.songs = self.tracks = None
+        self._map = None
+
+    def song_num(self, path):
+        return self._song_nums[os.path.abspath(path)]
+
+    def song(self, key):
+        '''LibrarySong by index or path.'''
+        song_num = key if isinstance(key, (int, np.integer)) else self.song_num(key)
+        first, num_tracks, root, mode, mtime = self.songs[song_num].tolist()
+        timelines, key_profiles, gp_tunings = [], [], []
+        for track_num in range(first, first + num_tracks):
+            arrays = self.track_arrays(track_num)
+            timelines.append(TrackTimeline(arrays["seconds"], arrays["frets"], arrays["pitches"],
+                                           arrays["pc_masks"], arrays["measure_starts"],
+                                           arrays["measure_numbers"], arrays["onsets"],
+                                           arrays["ties"]))
+            key_profiles.append((arrays["key_roots"], arrays["key_modes"], arrays["key_scores"]))
+            gp_tunings.append([[number, value] for number, value in
+                               enumerate(self.tracks[track_num]["tuning"].tolist(), 1)
+                               if value >= 0])
+        return LibrarySong(self.paths[song_num], timelines, key_profiles,
+                           (root, key_modes[mode]), gp_tunings, mtime)
+
+    def track_arrays(self, track_num):
+        '''{name: view} of every TRACK_ARRAYS array of a track, track_num counts over all songs.'''
+        track = self.tracks[track_num]
+        num_beats, num_measures = int(track["num_beats"]), int(track["num_measures"])
+        arrays = {}
+        for (name, dtype, shape, rows), offset in zip(TRACK_ARRAYS, track["offsets"].tolist()):
+            arrays[name] = np.ndarray((_rows(num_beats, num_measures, rows, name),) + shape,
+                                      dtype, self._map, offset)
+        return arrays
+
+
+def main(argv):
+    '''python library.py build [-j WORKERS] LIBRARY SONG...     compile songs into a library
+       python library.py time LIBRARY                          time opening every song in it'''
+    if len(argv) > 4 and argv[:2] == ["build", "-j"]:
+        print("{} songs".format(build_library(argv[3], argv[4:], workers=int(argv[2]))))
+    elif len(argv) > 2 and argv[0] == "build":
+        print("{} songs".format(build_library(argv[1], argv[2:])))
+    elif len(argv) == 2 and argv[0] == "time":
+        library = Library(argv[1])
+        start = time.perf_counter()
+        for song_num in range(len(library)):
+            library.song(song_num)
+        seconds = time.perf_counter() - start
+        print("{} songs, {:.1f} us per song".format(len(library), seconds / max(len(library), 1) * 1e6))
+    else:
+        print(main.__doc__)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
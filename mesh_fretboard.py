@@ -0,0 +1,270 @@
+from functools import lru_cache
+from kivy.uix.widget import Widget
+from kivy.properties import NumericProperty, ObjectProperty
+from kivy.graphics import Color, InstructionGroup, Mesh, Rectangle
+from kivy.clock import Clock
+from kivy.utils import get_color_from_hex
+import numpy as np
+
+from music_theory import key_sig_pcs
+
+'''Single-widget fretboard.
+
+Everything is drawn by one widget with a handful of Mesh instructions (fret bars, inlays, one per
+key colour, active notes) instead of a widget per string or per fret.  Vertex buffers are numpy
+arrays that get rewritten in place, the active note mesh always has 6 quads (unplayed strings
+are collapsed to nothing) so playing a beat never changes its indices, and only the quads of
+strings that changed are recomputed.  Look-ahead ghost notes get a mesh of 6 quads per slot of
+the playback.LookAhead ring buffer, made when a song starts.
+'''
+
+NUM_STRINGS = 6
+NUM_FRETS = 25  # Including the nut box, fret 0.
+STANDARD_TUNING = (64, 59, 55, 50, 45, 40)
+
+roygbiv = [(1, 0.102, 0.102, 1),  # red
+           (1, 0.549, 0.102, 1),  # orange
+           (1, 1, 0.102, 1),  # yellow
+           (0.102, 1, 0.102, 1),  # green
+           (0.102, 0.102, 1, 1),  # blue
+           (0.549, 0.102, 1, 1),  # indigo
+           (1, 0, 0.502, 1)]  # violet
+
+
+def fret_bar_positions(width, x):
+    '''Left edge of each of the 25 fret bars, same layout as FretboardWithTuner.'''
+    temperament = 2**(1/12)  # Ratio of fret[i]/fret[i+1] for 12-tone equal temperament.
+    fret_num = np.arange(NUM_FRETS)
+    fret_positions = 1 - 1 / temperament**fret_num
+    # Move fret_position[0] up to make a box for the nut, scale fret_position[i] accordingly.
+    nut_width_ratio = 0.03
+    offset_fret_positions = 2 * fret_positions + nut_width_ratio / temperament**fret_num
+    # Stretch all fret_positions so they fit the entire width of the fretboard.
+    return offset_fret_positions / offset_fret_positions[-1] * width + x
+
+
+def _quad_vertices(x0, y0, x1, y1, out=None):
+    '''(Q, 16) vertices of Q quads, 4 corners of (x, y, u, v).'''
+    x0, y0, x1, y1 = np.broadcast_arrays(x0, y0, x1, y1)
+    if out is None:
+        out = np.zeros((len(x0), 16), dtype=np.float32)
+    out[:, 0], out[:, 1] = x0, y0
+    out[:, 4], out[:, 5] = x1, y0
+    out[:, 8], out[:, 9] = x1, y1
+    out[:, 12], out[:, 13] = x0, y1
+    return out
+
+
+def _quad_indices(num_quads):
+    corners = np.arange(num_quads)[:, None] * 4
+    return (corners + np.array([0, 1, 2, 2, 3, 0])).ravel().tolist()
+
+
+def _circle_mesh(centers_x, centers_y, radius, segments=16):
+    '''Vertices and indices of filled circles as triangle fans.'''
+    angles = np.linspace(0, 2 * np.pi, segments, endpoint=False)
+    vertices, indices = [], []
+    for i, (cx, cy) in enumerate(zip(centers_x, centers_y)):
+        base = i * (segments + 1)
+        ring = np.zeros((segments + 1, 4), dtype=np.float32)
+        ring[0, :2] = cx, cy
+        ring[1:, 0] = cx + radius * np.cos(angles)
+        ring[1:, 1] = cy + radius * np.sin(angles)
+        vertices.append(ring.ravel())
+        for j in range(segments):
+            indices += [base, base + 1 + j, base + 1 + (j + 1) % segments]
+    if not vertices:
+        return [], []
+    return np.concatenate(vertices).tolist(), indices
+
+
+@lru_cache(maxsize=512)
+def key_cells(tuning, root, mode):
+    '''(string index, fret) cells of each key colour, cached per (tuning, root, mode).
+
+    tuning is the open string MIDI values from string 1.  Returns one (strings, frets) pair of
+    arrays per colour in roygbiv.
+    '''
+    frets = np.arange(NUM_FRETS)
+    pcs = (np.array(tuning)[:, None] + frets[None, :]) % 12
+    cells = []
+    for pc in key_sig_pcs(root, mode):
+        strings, fret_nums = np.nonzero(pcs == pc)
+        cells.append((strings, fret_nums))
+    return tuple(cells)
+
+
+class MeshFretboard(Widget):
+    '''Drop-in alternative to fretless.Fretboard drawn with a few Mesh instructions.'''
+    song = ObjectProperty(None)
+    # How many upcoming fret states are shown as fading ghost notes while playing, 0 for none.
+    look_ahead = NumericProperty(3)
+    # What songs play on, simulator.py swaps in a virtual clock.
+    clock = Clock
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.beat_num = 0
+        self.tuning = STANDARD_TUNING
+        self.key_sig = None
+        self.active_frets = np.full(NUM_STRINGS, -1)
+        self.fret_lefts = self.fret_rights = np.zeros(NUM_FRETS)
+        self.string_bottoms = self.string_tops = np.zeros(NUM_STRINGS)
+
+        self._active_vertices = np.zeros((NUM_STRINGS, 16), dtype=np.float32)
+        with self.canvas:
+            Color(*get_color_from_hex('#964b00'))
+            self.background = Rectangle(pos=self.pos, size=self.size)
+            self.key_meshes = []
+            for rgba in roygbiv:
+                Color(*rgba)
+                self.key_meshes.append(Mesh(mode='triangles'))
+            Color(0, 0, 0, 1)
+            self.fret_bar_mesh = Mesh(mode='triangles')
+            Color(1, 1, 1, 1)
+            self.inlay_mesh = Mesh(mode='triangles')
+            Color(1, 1, 1, 0.2)
+            self.active_mesh = Mesh(mode='triangles', indices=_quad_indices(NUM_STRINGS),
+                                    vertices=self._active_vertices.ravel().tolist())
+            self.ghosts = InstructionGroup()
+        self.upcoming = None
+        self.ghost_colors = []
+        self.ghost_meshes = []
+        self._ghost_vertices = np.zeros((0, NUM_STRINGS, 16), dtype=np.float32)
+        self.bind(size=self._update_canvas, pos=self._update_canvas)
+
+    def on_song(self, instance, value):
+        self.tuning = tuple(value for number, value in self.song.gp_tunings[0][:NUM_STRINGS])
+        self.set_key_sig(*self.song.detected_key_sig)
+
+    def _update_canvas(self, instance, value):
+        self.background.pos = self.pos
+        self.background.size = self.size
+
+        fret_bar_width = self.width * (0.1/24.75)  # Gibson ratio of fret bar width to scale length.
+        bars = fret_bar_positions(self.width, self.x)
+        self.fret_lefts = np.concatenate(([self.x], bars[:-1] + fret_bar_width))
+        self.fret_rights = bars
+        # String 1 is the top row.
+        row_height = self.height / NUM_STRINGS
+        self.string_tops = self.top - row_height * np.arange(NUM_STRINGS)
+        self.string_bottoms = self.string_tops - row_height
+
+        bar_vertices = _quad_vertices(bars, self.y, bars + fret_bar_width, self.top)
+        self.fret_bar_mesh.indices = _quad_indices(NUM_FRETS)
+        self.fret_bar_mesh.vertices = bar_vertices.ravel().tolist()
+        self._update_inlays()
+        self._update_key_meshes()
+        self._update_active_mesh()
+        if self.upcoming is not None:
+            self._update_ghost_meshes(range(self.upcoming.size))
+
+    def _update_inlays(self):
+        centers = (self.fret_lefts + self.fret_rights) / 2
+        single = [i for i in range(NUM_FRETS) if i in range(3, 10, 2) or i in range(15, 25, 2)]
+        xs = list(centers[single]) + [centers[12]] * 2
+        ys = [self.y + self.height / 2] * len(single) + [self.y + self.height / 3,
+                                                          self.y + 2 * self.height / 3]
+        vertices, indices = _circle_mesh(xs, ys, self.height * 0.15 / 2)
+        self.inlay_mesh.vertices = vertices
+        self.inlay_mesh.indices = indices
+
+    def set_key_sig(self, root, mode):
+        '''Colour the notes of a key, root is a pitch class or note name.'''
+        self.key_sig = root, mode
+        self._update_key_meshes()
+
+    def _update_key_meshes(self):
+        if self.key_sig is None:
+            cells = [(np.zeros(0, dtype=int), np.zeros(0, dtype=int))] * len(self.key_meshes)
+        else:
+            cells = key_cells(self.tuning, *self.key_sig)
+        for mesh, (strings, frets) in zip(self.key_meshes, cells):
+            vertices = _quad_vertices(self.fret_lefts[frets], self.string_bottoms[strings],
+                                      self.fret_rights[frets], self.string_tops[strings])
+            mesh.indices = _quad_indices(len(strings))
+            mesh.vertices = vertices.ravel().tolist()
+
+    def _fret_quads(self, frets, strings=slice(None)):
+        '''Quads of frets (-1 where unplayed, collapsed to nothing) on strings.'''
+        played = frets >= 0
+        fret_nums = np.where(played, frets, 0)
+        left = np.where(played, self.fret_lefts[fret_nums], 0)
+        right = np.where(played, self.fret_rights[fret_nums], 0)
+        bottom = np.where(played, self.string_bottoms[strings], 0)
+        top = np.where(played, self.string_tops[strings], 0)
+        return _quad_vertices(left, bottom, right, top)
+
+    def _update_active_mesh(self, strings=slice(None)):
+        '''Rewrite the quads of strings (all of them by default) and upload the mesh.'''
+        self._active_vertices[strings] = self._fret_quads(self.active_frets[strings], strings)
+        self.active_mesh.vertices = self._active_vertices.ravel().tolist()
+
+    def _make_ghosts(self):
+        from playback import LookAhead
+        size = int(self.look_ahead)
+        self.upcoming = LookAhead(self.events, size) if size else None
+        if len(self.ghost_meshes) != size:
+            self.ghosts.clear()
+            self._ghost_vertices = np.zeros((size, NUM_STRINGS, 16), dtype=np.float32)
+            self.ghost_colors = [Color(1, 1, 1, 0) for slot in range(size)]
+            self.ghost_meshes = [Mesh(mode='triangles', indices=_quad_indices(NUM_STRINGS))
+                                 for slot in range(size)]
+            for color, mesh in zip(self.ghost_colors, self.ghost_meshes):
+                self.ghosts.add(color)
+                self.ghosts.add(mesh)
+        if size:
+            self._update_ghost_meshes(range(size))
+
+    def _update_ghost_meshes(self, slots):
+        '''Rewrite the meshes of the refilled look-ahead slots, fade every slot by how far ahead
+        it is.'''
+        for slot in slots:
+            self._ghost_vertices[slot] = self._fret_quads(self.upcoming.states[slot])
+            self.ghost_meshes[slot].vertices = self._ghost_vertices[slot].ravel().tolist()
+        for slot, color in enumerate(self.ghost_colors):
+            color.a = 0.15 * (1 - self.upcoming.distance(slot) / self.upcoming.size)
+
+    def _play_changes(self, changes):
+        '''changes is ((string index, fret or None), ...), see playback.EventStream.'''
+        if not changes:
+            return
+        strings = [string for string, fret in changes]
+        self.active_frets[strings] = [-1 if fret is None else fret for string, fret in changes]
+        self._update_active_mesh(strings)
+
+    def _play_beat(self, frets):
+        new = np.array([-1 if fret is None else fret for fret in frets[:NUM_STRINGS]])
+        strings = np.flatnonzero(new != self.active_frets)
+        self._play_changes([(string, new[string]) for string in strings.tolist()])
+
+    def _clear_frets(self):
+        self._play_beat([None] * NUM_STRINGS)
+
+    def play_song(self):
+        from playback import EventPlayer, EventStream, FrameRenderer
+        self.track = self.song.song[0]
+        aligned = self.song.aligned_timeline(0)
+        self.events = EventStream.from_beats(self.track, None if aligned is None else aligned.onsets)
+        if getattr(self, "player", None):
+            self.player.stop()
+            self.renderer.stop()
+        self.player = EventPlayer(self.events, self._play_event, None, self.clock)
+        self.renderer = FrameRenderer(self.player, self._draw_event)
+        self._make_ghosts()
+        self.beat_num = 0
+        self._clear_frets()
+        self._play_song()
+
+    def _play_song(self):
+        # From 0 at the start, an aligned track's first beat is wherever the recording has it.
+        self.player.play(self.events.onsets[self.beat_num] if self.beat_num else 0.0)
+        self.renderer.start(self.active_frets)
+
+    def _play_event(self, event_num):
+        self.beat_num = self.events.beat_nums[event_num]
+
+    def _draw_event(self, changes, event_num):
+        self._play_changes(changes)
+        if self.upcoming is not None:
+            self._update_ghost_meshes(self.upcoming.advance(event_num))
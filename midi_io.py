@@ -0,0 +1,307 @@
+import os
+import struct
+import sys
+import threading
+import time
+
+from fingering import get_fret_index
+
+'''Standard MIDI File export, and live fretboards driven by incoming MIDI.
+
+export_track writes one track of a KivySongBuilder as a type 1 SMF: a conductor track with the
+tempo map and time signatures, and the notes of every voice, in the measure order of song_data
+(repeats unrolled, edits included).  Events are collected, sorted once and encoded into one
+buffer, which is written in one go.
+
+MidiParser turns a raw MIDI byte stream (a pipe, a device like /dev/snd/midiC1D0, a file of
+recorded bytes) into note events and LiveFretMapper places each note on the fretboard with the
+tuning's precomputed FretIndex.  MidiInput runs both on a thread and hands every new fret state
+to a callback.
+
+    python midi_io.py export song.gp5 out.mid [track]
+    python midi_io.py listen PATH                       print frets as notes arrive
+    python midi_io.py time song.gp5                     time the per-event handling
+'''
+
+TICKS_PER_QUARTER = 960  # Same as Guitar Pro's Duration.time.
+NOTE_OFF, NOTE_ON = 0x80, 0x90
+PERCUSSION_CHANNEL = 9
+
+
+def _vlq(value):
+    '''MIDI variable length quantity.'''
+    out = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        out.insert(0, 0x80 | (value & 0x7F))
+        value >>= 7
+    return out
+
+
+def _chunk(kind, data):
+    return kind + struct.pack(">I", len(data)) + data
+
+
+def _encode_track(events):
+    '''MTrk chunk of (tick, order, bytes) events.  Sorted here, order breaks ties at a tick
+    (meta events first, then note offs before note ons).'''
+    data = bytearray()
+    tick = 0
+    for event_tick, order, message in sorted(events, key=lambda event: event[:2]):
+        data += _vlq(event_tick - tick)
+        data += message
+        tick = event_tick
+    data += b"\x00\xff\x2f\x00"  # End of track.
+    return _chunk(b"MTrk", bytes(data))
+
+
+def _meta(kind, data):
+    return bytes([0xFF, kind]) + _vlq(len(data)) + data
+
+
+def _tempo_event(bpm):
+    return _meta(0x51, struct.pack(">I", round(60000000 / bpm))[1:])
+
+
+def _time_signature_event(numerator, denominator):
+    return _meta(0x58, bytes([numerator, denominator.bit_length() - 1, 24, 8]))
+
+
+def track_events(song, track_num):
+    '''(conductor events, note events) of one track, as (tick, order, bytes) lists.'''
+    gp_track = song.gp_song.tracks[track_num]
+    gp_measures = {id(gp_measure.header): gp_measure for gp_measure in gp_track.measures}
+    channel = PERCUSSION_CHANNEL if gp_track.isPercussionTrack else gp_track.channel.channel & 0x0F
+
+    conductor = [(0, 0, _meta(0x03, gp_track.name.encode("latin-1", "replace")))]
+    notes = [(0, 0, bytes([0xC0 | channel, gp_track.channel.instrument & 0x7F]))]
+    tempo, time_signature = None, None
+    # [start, end, pitch, velocity] of every note, the last one on each string for ties.
+    played, sounding = [], {}
+
+    measure_tick = 0
+    for measure in song.song_data[track_num]:
+        header = measure[0]
+        gp_measure = gp_measures[id(header)]
+        signature = (header.timeSignature.numerator, header.timeSignature.denominator.value)
+        if signature != time_signature:
+            time_signature = signature
+            conductor.append((measure_tick, 0, _time_signature_event(*signature)))
+        if header.tempo.value != tempo:
+            tempo = header.tempo.value
+            conductor.append((measure_tick, 0, _tempo_event(tempo)))
+
+        for gp_voice in gp_measure.voices:
+            tick = measure_tick
+            for gp_beat in gp_voice.beats:
+                if gp_beat.status.name == "empty":
+                    continue
+                mix = gp_beat.effect.mixTableChange
+                if mix is not None and mix.tempo is not None and mix.tempo.value != tempo:
+                    tempo = mix.tempo.value
+                    conductor.append((tick, 0, _tempo_event(tempo)))
+                end = tick + gp_beat.duration.time
+                for gp_note in gp_beat.notes:
+                    kind = gp_note.type.name
+                    if kind == "tie" and gp_note.string in sounding:
+                        sounding[gp_note.string][1] = end
+                    elif kind == "normal":
+                        note = [tick, end, gp_note.realValue, min(max(gp_note.velocity, 1), 127)]
+                        played.append(note)
+                        sounding[gp_note.string] = note
+                tick = end
+        measure_tick += header.length
+
+    for start, end, pitch, velocity in played:
+        if 0 <= pitch < 128:
+            notes.append((start, 2, bytes([NOTE_ON | channel, pitch, velocity])))
+            notes.append((end, 1, bytes([NOTE_OFF | channel, pitch, 0])))
+    return conductor, notes
+
+
+def export_track(song, track_num, path):
+    '''Write track track_num of a KivySongBuilder to a Standard MIDI File, return the number
+    of notes.'''
+    conductor, notes = track_events(song, track_num)
+    header = _chunk(b"MThd", struct.pack(">HHH", 1, 2, TICKS_PER_QUARTER))
+    data = header + _encode_track(conductor) + _encode_track(notes)
+    with open(path, "wb") as file:
+        file.write(data)
+    return (len(notes) - 1) // 2
+
+
+class MidiParser:
+    '''Incremental MIDI byte stream parser, only note events are kept.
+
+    feed(data) returns [(pitch, velocity), ...] in arrival order, velocity 0 for note offs.
+    Running status, realtime bytes in the middle of messages and SysEx are handled.
+    '''
+    # Data bytes that follow each channel message status (high nibble).
+    DATA_LENGTHS = {0x80: 2, 0x90: 2, 0xA0: 2, 0xB0: 2, 0xC0: 1, 0xD0: 1, 0xE0: 2}
+
+    def __init__(self, channel=None):
+        self.channel = channel  # None listens to every channel.
+        self.status = None
+        self.data = []
+        self.in_sysex = False
+
+    def feed(self, data):
+        events = []
+        for byte in data:
+            if byte >= 0xF8:  # Realtime, can appear anywhere.
+                continue
+            if byte >= 0x80:
+                # Any status byte ends SysEx (0xF7 is the usual one), system common messages
+                # cancel running status.
+                self.in_sysex = byte == 0xF0
+                self.status = byte if byte < 0xF0 else None
+                self.data = []
+                continue
+            if self.in_sysex or self.status is None:
+                continue
+            self.data.append(byte)
+            kind = self.status & 0xF0
+            if len(self.data) < self.DATA_LENGTHS[kind]:
+                continue
+            if kind in (NOTE_ON, NOTE_OFF) and (self.channel is None or
+                                               self.status & 0x0F == self.channel):
+                pitch, velocity = self.data
+                events.append((pitch, velocity if kind == NOTE_ON else 0))
+            self.data = []
+        return events
+
+
+class LiveFretMapper:
+    '''Fret state of a fretboard played by incoming notes.
+
+    Each note on goes to the free string whose fret is closest to where the hand is (the
+    average fretted position of the notes held), using the tuning's FretIndex so a note is a
+    list lookup.  Notes with no free string are ignored.
+
+    frets is per string (index 0 is string 1), None where nothing is held, the same form as
+    KivyBeat.frets.
+    '''
+    def __init__(self, tuning, num_frets=24):
+        self.index = get_fret_index(tuple(tuning), num_frets)
+        self.frets = [None] * self.index.num_strings
+        self.held = {}  # pitch: string index
+
+    def note(self, pitch, velocity):
+        '''Apply one note event, return True if the frets changed.'''
+        if velocity:
+            if pitch in self.held:
+                return False
+            fretted = [fret for fret in self.frets if fret]
+            hand = sum(fretted) / len(fretted) if fretted else 0
+            free = [(abs(fret - hand), string, fret) for string, fret in self.index.positions(pitch)
+                    if self.frets[string] is None]
+            if not free:
+                return False
+            distance, string, fret = min(free)
+            self.frets[string] = fret
+            self.held[pitch] = string
+            return True
+        string = self.held.pop(pitch, None)
+        if string is None:
+            return False
+        self.frets[string] = None
+        return True
+
+
+class MidiInput:
+    '''Read a MIDI byte stream on a thread and call on_frets(frets) after every change.
+
+    on_frets runs on the reading thread, wrap it with kivy.clock.mainthread to draw.  The thread
+    waits on the device and on a pipe that stop() writes to, so stop() doesn't have to wait for
+    the next MIDI byte: it wakes the thread, which closes the device, and joins it.
+    '''
+    def __init__(self, path, tuning, on_frets, channel=None):
+        self.path = path
+        self.parser = MidiParser(channel)
+        self.mapper = LiveFretMapper(tuning)
+        self.on_frets = on_frets
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.running = False
+        self.wake = None  # (read end, write end) of the pipe stop() wakes the thread with.
+
+    def start(self):
+        self.running = True
+        self.wake = os.pipe()
+        self.thread.start()
+
+    def stop(self, timeout=1.0):
+        self.running = False
+        if self.wake is None:
+            return
+        try:
+            # The thread closes the read end when it stops by itself (end of input, or the
+            # device couldn't be opened), then there's nothing to wake.
+            if self.thread.is_alive():
+                os.write(self.wake[1], b"\0")
+                if self.thread is not threading.current_thread():
+                    self.thread.join(timeout)
+        except OSError:
+            pass
+        finally:
+            os.close(self.wake[1])
+            self.wake = None
+
+    def _read(self):
+        import select
+        wake = self.wake[0]
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            os.close(wake)
+            raise
+        try:
+            while self.running:
+                readable = select.select([fd, wake], [], [])[0]
+                if wake in readable:
+                    break
+                data = os.read(fd, 256)
+                if not data:
+                    break
+                self.feed(data)
+        finally:
+            os.close(fd)
+            os.close(wake)
+
+    def feed(self, data):
+        changed = False
+        for pitch, velocity in self.parser.feed(data):
+            changed |= self.mapper.note(pitch, velocity)
+        if changed:
+            self.on_frets(list(self.mapper.frets))
+
+
+def main(argv):
+    if len(argv) >= 3 and argv[0] == "export":
+        from gp_to_kivy import KivySongBuilder
+        song = KivySongBuilder(argv[1])
+        track_num = int(argv[3]) - 1 if len(argv) > 3 else 0
+        print("{} notes".format(export_track(song, track_num, argv[2])))
+    elif len(argv) == 2 and argv[0] == "listen":
+        midi_input = MidiInput(argv[1], (64, 59, 55, 50, 45, 40), print)
+        midi_input.start()
+        midi_input.thread.join()
+    elif len(argv) == 2 and argv[0] == "time":
+        from gp_to_kivy import KivySongBuilder
+        song = KivySongBuilder(argv[1])
+        conductor, notes = track_events(song, 0)
+        stream = b"".join(message for tick, order, message in sorted(notes) if message[0] >= 0x80
+                          and message[0] & 0xF0 in (NOTE_ON, NOTE_OFF))
+        tuning = [value for number, value in song.gp_tunings[0]]
+        midi_input = MidiInput(os.devnull, tuning, lambda frets: None)
+        events = len(stream) // 3
+        start = time.perf_counter()
+        for i in range(0, len(stream), 3):
+            midi_input.feed(stream[i:i + 3])
+        seconds = time.perf_counter() - start
+        print("{} events, {:.1f} us per event".format(events, seconds / events * 1e6))
+    else:
+        print("python midi_io.py export SONG OUT.mid [track] | listen PATH | time SONG")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
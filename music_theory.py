@@ -1,4 +1,5 @@
 from collections import deque, defaultdict
+from functools import lru_cache
 import itertools
 
 
@@ -28,25 +29,145 @@ interval_sequence = deque([1, 0, 1, 0, 1, 1, 0, 1, 0, 1, 0, 1])
 modes = {'Major': 0, 'Dorian': 2, 'Phrygian': 4, 'Lydian': 5,
          'Mixolydian': 7, 'Minor': 9, 'Locrian': 11}
 
-def get_key_sig_color_map(note, mode):
-    # Representative of W-W-H-W-W-W-H (the major scale).
-    interval_sequence = deque([1, 0, 1, 0, 1, 1, 0, 1, 0, 1, 0, 1])
+chrom_scale = 'C C#/Db D D#/Eb E F F#/Gb G G#/Ab A A#/Bb B'.split()
+
+# Pitch classes are ints 0-11 (C == 0) everywhere outside the GUI.  Names are only for display,
+# note_to_pc converts a name coming back from a widget.
+note_to_pc = {note: pc for pc, note in enumerate(chrom_scale)}
 
-    modes = {
-        'Major'  : 0, 'Dorian': 2, 'Phrygian': 4, 'Lydian': 5, 'Mixolydian': 7, 'Minor': 9,
-        'Locrian': 11}
+# 12-bit pitch class masks.  C is the high bit, B the low bit (0b100000000000 == C).
+pc_bits = tuple(1 << (11 - pc) for pc in range(12))
 
-    chrom_scale = 'C C#/Db D D#/Eb E F F#/Gb G G#/Ab A A#/Bb B'.split()
 
+def key_sig_pcs(root, mode):
+    '''Pitch classes in the key, in scale order starting at root.
+
+    root may be a pitch class or a note name.'''
+    if isinstance(root, str):
+        root = note_to_pc[root]
     mode_pattern = interval_sequence.copy()
-    mode_pattern.rotate(-1*modes[mode])
+    mode_pattern.rotate(-1 * modes[mode])
+    return [(root + i) % 12 for i in itertools.compress(range(12), mode_pattern)]
+
+
+# Krumhansl-Kessler probe tone profiles, index 0 is the tonic.
+major_profile = [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]
+minor_profile = [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
+key_modes = ["Major", "Minor"]
+
+
+@lru_cache(maxsize=None)
+def get_key_profiles():
+    '''(24, 12) profile of every key, rows 0-11 major and 12-23 minor rooted at the row's
+    pitch class.  Rows are centered and unit length so a dot product is a correlation.'''
+    # numpy is only needed once a song is analysed, keep it out of GUI startup.
+    import numpy as np
+    profiles = np.array([np.roll(profile, root) for profile in (major_profile, minor_profile)
+                         for root in range(12)])
+    profiles -= profiles.mean(axis=1, keepdims=True)
+    profiles /= np.linalg.norm(profiles, axis=1, keepdims=True)
+    return profiles
+
+
+def find_keys(histograms):
+    '''Krumhansl-Schmuckler key finding for a batch of pitch class histograms.
+
+    histograms is (12,) or (W, 12), preferably duration-weighted (see NoteStatistics).  Every
+    window is correlated against all 24 key profiles in one matrix product.
+
+    Return (roots, modes, scores) arrays of shape (W,): root pitch class, index into key_modes
+    and the correlation.  Windows without notes get root -1 and score nan.
+    '''
+    import numpy as np
+    histograms = np.atleast_2d(np.asarray(histograms, dtype=np.float64))
+    centered = histograms - histograms.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(centered, axis=1, keepdims=True)
+    silent = norms[:, 0] == 0
+    norms[silent] = 1
+    correlations = (centered / norms) @ get_key_profiles().T
+
+    best = correlations.argmax(axis=1)
+    scores = correlations[np.arange(len(best)), best]
+    roots, modes = best % 12, best // 12
+    roots[silent], modes[silent], scores[silent] = -1, 0, np.nan
+    return roots, modes, scores
+
+
+def key_sig_name(root, mode):
+    '''Display form of a key, e.g. "F#/Gb Minor".  mode may be a name or index into key_modes.'''
+    if not isinstance(mode, str):
+        mode = key_modes[mode]
+    return chrom_scale[root] + " " + mode
+
+
+# Chord qualities as intervals above the root.  Earlier entries win ties.
+chord_qualities = [
+    ("5", (0, 7)), ("", (0, 4, 7)), ("m", (0, 3, 7)), ("7", (0, 4, 7, 10)),
+    ("m7", (0, 3, 7, 10)), ("maj7", (0, 4, 7, 11)), ("sus4", (0, 5, 7)), ("sus2", (0, 2, 7)),
+    ("dim", (0, 3, 6)), ("aug", (0, 4, 8)), ("6", (0, 4, 7, 9)), ("m6", (0, 3, 7, 9)),
+    ("m7b5", (0, 3, 6, 10)), ("dim7", (0, 3, 6, 9)), ("add9", (0, 2, 4, 7)),
+    ("9", (0, 2, 4, 7, 10)), ("m9", (0, 2, 3, 7, 10)), ("7sus4", (0, 5, 7, 10)),
+]
+
+
+@lru_cache(maxsize=None)
+def get_chord_table():
+    '''(4096, 12) chord of every pitch class mask (see pc_bits) for every bass pitch class.
+
+    Entries are root * len(chord_qualities) + quality, or -1 if no chord is completely in the
+    mask.  The chord with the most notes wins, notes outside it count against it, and a root
+    on the lowest string breaks ties (so C E G A is C6 over C and Am7 over A).
+    '''
+    import numpy as np
+    masks = np.arange(4096)
+    popcount = np.array([bin(mask).count("1") for mask in masks])
+    templates, sizes, roots = [], [], []
+    for root in range(12):
+        for name, intervals in chord_qualities:
+            templates.append(sum(pc_bits[(root + i) % 12] for i in intervals))
+            sizes.append(len(intervals))
+            roots.append(root)
+    templates, sizes, roots = np.array(templates), np.array(sizes), np.array(roots)
+    priority = np.tile(np.arange(len(chord_qualities)), 12)
+
+    contained = (masks[:, None] & templates[None, :]) == templates[None, :]
+    extras = popcount[masks[:, None] & ~templates[None, :]]
+    score = 4.0 * sizes - 3.0 * extras - 0.01 * priority
+    score[~contained] = -np.inf
+    table = np.full((4096, 12), -1, dtype=np.int16)
+    any_chord = contained.any(axis=1)
+    for bass in range(12):
+        bass_score = score + 2.0 * (roots == bass)
+        table[any_chord, bass] = bass_score[any_chord].argmax(axis=1)
+    return table
+
+
+def find_chords(pc_masks, bass_pcs):
+    '''Chord of each beat (or measure) in one table lookup.  bass_pcs is the pitch class on the
+    lowest sounding string, -1 for rests.'''
+    import numpy as np
+    pc_masks, bass_pcs = np.asarray(pc_masks), np.asarray(bass_pcs)
+    chords = get_chord_table()[pc_masks, np.maximum(bass_pcs, 0)]
+    chords[bass_pcs < 0] = -1
+    return chords
+
+
+def chord_name(chord, bass=-1):
+    '''Display form of a find_chords() entry, e.g. "Am7" or "C/E".  '' for no chord.'''
+    if chord < 0:
+        return ""
+    root, quality = divmod(int(chord), len(chord_qualities))
+    name = chrom_scale[root].split("/")[0] + chord_qualities[quality][0]
+    if bass >= 0 and bass != root:
+        name += "/" + chrom_scale[bass].split("/")[0]
+    return name
 
-    note_pattern = chrom_scale.copy()
-    while note != note_pattern[0]:
-        note_pattern.rotate(-1)
-    notes_in_key = list(itertools.compress(note_pattern, mode_pattern))
 
-    color_map = {note: color for note, color in zip(notes_in_key, roygbiv)}
+def get_key_sig_color_map(note, mode):
+    '''Return a list indexed by pitch class, colour name for notes in the key else None.'''
+    color_map = [None] * 12
+    for pc, color in zip(key_sig_pcs(note, mode), roygbiv):
+        color_map[pc] = color
     return color_map
 
  
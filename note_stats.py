@@ -0,0 +1,93 @@
+import numpy as np
+
+
+class NoteStatistics:
+    '''Windowed pitch class histograms for one TrackTimeline.
+
+    Stores prefix sums of per-beat pitch class counts and seconds, at beat and at measure
+    resolution.  Any bar range or time window is then a subtraction of two rows, and every
+    sliding window of a track is one vectorized subtraction.
+
+    Histograms are (12,) arrays indexed by pitch class, or (W, 12) for W windows.  "seconds"
+    histograms are duration-weighted: each note adds the length of its beat.
+    '''
+    def __init__(self, timeline):
+        self.timeline = timeline
+        pitches = timeline.pitches
+        # (N, 12) number of notes of each pitch class per beat.
+        played = pitches >= 0
+        onehot = (pitches[:, :, None] % 12 == np.arange(12)) & played[:, :, None]
+        self.beat_counts = onehot.sum(axis=1, dtype=np.float64)
+
+        self.cum_counts = self._prefix(self.beat_counts)
+        self.cum_seconds = self._prefix(self.beat_counts * timeline.seconds[:, None])
+        self._index_measures()
+
+    def _index_measures(self):
+        self.measure_cum_counts = self.cum_counts[self.timeline.measure_starts]
+        self.measure_cum_seconds = self.cum_seconds[self.timeline.measure_starts]
+
+    def splice(self, timeline, start, stop, other):
+        '''Statistics of timeline, which is self.timeline.splice(start, stop, other.timeline).
+
+        The inserted beats' prefix sums come from other, the ones after the edit are shifted by
+        how much the edit changed the totals, nothing is summed again.
+        '''
+        b0, b1 = self.timeline.measure_starts[start], self.timeline.measure_starts[stop]
+        spliced = NoteStatistics.__new__(NoteStatistics)
+        spliced.timeline = timeline
+        spliced.beat_counts = np.concatenate((self.beat_counts[:b0], other.beat_counts,
+                                              self.beat_counts[b1:]))
+        for name in ("cum_counts", "cum_seconds"):
+            cum, inserted = getattr(self, name), getattr(other, name)
+            shift = inserted[-1] - (cum[b1] - cum[b0])
+            setattr(spliced, name, np.concatenate((cum[:b0], inserted + cum[b0],
+                                                   cum[b1 + 1:] + shift)))
+        spliced._index_measures()
+        return spliced
+
+    @staticmethod
+    def _prefix(per_beat):
+        cum = np.zeros((len(per_beat) + 1, 12))
+        np.cumsum(per_beat, axis=0, out=cum[1:])
+        return cum
+
+    @property
+    def total_counts(self):
+        return self.cum_counts[-1]
+
+    @property
+    def total_seconds(self):
+        return self.cum_seconds[-1]
+
+    def measures(self, start, stop, weighted=True):
+        '''Histogram of measures [start, stop), 0-based indices into the timeline's measures.'''
+        cum = self.measure_cum_seconds if weighted else self.measure_cum_counts
+        return cum[stop] - cum[start]
+
+    def sliding_measures(self, width, step=1, weighted=True):
+        '''(W, 12) histograms of every window of width measures, window i starts at i*step.'''
+        cum = self.measure_cum_seconds if weighted else self.measure_cum_counts
+        starts = np.arange(0, len(cum) - width, step)
+        return cum[starts + width] - cum[starts]
+
+    def seconds_until(self, t):
+        '''Duration-weighted histogram of everything played before time t (scalar or array).
+
+        A beat cut by t contributes the part of it that has sounded.
+        '''
+        t = np.clip(t, 0, self.timeline.length)
+        beat = np.clip(self.timeline.beat_at(t), 0, max(len(self.timeline) - 1, 0))
+        if not len(self.timeline):
+            return np.zeros(np.shape(t) + (12,))
+        into_beat = (t - self.timeline.onsets[beat])[..., None]
+        return self.cum_seconds[beat] + into_beat * self.beat_counts[beat]
+
+    def window(self, t0, t1):
+        '''Duration-weighted histogram of the time window [t0, t1) in seconds.'''
+        return self.seconds_until(t1) - self.seconds_until(t0)
+
+    def sliding_window(self, width, hop):
+        '''(W, 12) histograms of every width-second window, hop seconds apart.'''
+        starts = np.arange(0, max(self.timeline.length - width, 0) + hop / 2, hop)
+        return self.window(starts, starts + width)
@@ -0,0 +1,253 @@
+import sys
+import numpy as np
+
+'''Playback of a track as a stream of fret changes.
+
+A track has a beat for every note, rest and tie, but the fretboard only changes when the frets
+do.  EventStream compiles a track into events: runs of beats with the same frets (held and tied
+notes, re-struck notes, runs of rests) become one event, and each event lists only the strings
+that change.  EventPlayer plays the events on a clock, one callback per event, so the scheduler
+does work in proportion to what actually changes on screen.
+
+Event callbacks only update state.  FrameRenderer draws once per frame: it looks up the event at
+the current clock time and hands the strings that differ from what was last drawn to the
+fretboard, so a burst of notes between two frames is one draw and draw cost is capped by the
+frame rate rather than by note density.
+
+LookAhead keeps the next few fret states after the playhead in a ring buffer for ghost notes,
+refilling only the slots the playhead has moved past.
+
+    python playback.py SONG [fps]      beats, events, string changes and draws of each track
+'''
+
+
+class EventStream:
+    '''A track compiled to the moments its fret state changes.  onsets are the beat start times,
+    summed from seconds if not given (pass a warped timeline's onsets, see alignment.py).
+    E events:
+
+        times:     (E,) seconds from the start of the track
+        beat_nums: (E,) first beat of each event, len(track) for the final one
+        states:    (E, strings) frets after each event, -1 where a string is unplayed
+        changes:   [((string index, fret or None), ...), ...] per event, strings whose fret
+                   differs from the event before.  The board starts empty.
+
+    The final event, at the end of the track, clears whatever is still held.
+    '''
+    def __init__(self, seconds, frets, onsets=None):
+        seconds = np.asarray(seconds, dtype=np.float64)
+        frets = np.asarray(frets).reshape(len(seconds), -1)
+        cleared = np.full((1, frets.shape[1]), -1, dtype=frets.dtype)
+        # State after each beat and the state before it, plus the cleared board at the end.
+        after = np.concatenate((frets, cleared))
+        before = np.concatenate((cleared, frets))
+        changed = after != before
+        rows = np.flatnonzero(changed.any(axis=1))
+
+        self.num_beats = len(seconds)
+        if onsets is None:
+            onsets = np.cumsum(seconds) - seconds
+        self.length = float(onsets[-1] + seconds[-1]) if len(seconds) else 0.0
+        # (N+1,) start of each beat and the end of the track.
+        self.onsets = np.append(np.asarray(onsets, dtype=np.float64), self.length)
+        self.times = self.onsets[rows]
+        self.beat_nums = rows
+        self.states = after[rows]
+        self.changes = []
+        for row, strings in zip(rows.tolist(), changed[rows].tolist()):
+            new = after[row].tolist()
+            self.changes.append(tuple((string, None if new[string] < 0 else new[string])
+                                      for string, is_changed in enumerate(strings) if is_changed))
+
+    @classmethod
+    def from_beats(cls, track, onsets=None):
+        '''From a list of KivyBeats, e.g. KivySongBuilder.song[0] (retuned or not).'''
+        return cls([beat.seconds for beat in track],
+                   [[-1 if fret is None else fret for fret in beat.frets] for beat in track],
+                   onsets)
+
+    @classmethod
+    def from_timeline(cls, timeline):
+        return cls(timeline.seconds, timeline.frets, timeline.onsets)
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def num_changes(self):
+        return sum(len(changes) for changes in self.changes)
+
+    def event_at(self, seconds):
+        '''Index of the event sounding at seconds from the start, -1 before the first.  seconds
+        can be an array.'''
+        event_nums = np.searchsorted(self.times, seconds, side="right") - 1
+        return event_nums if np.ndim(event_nums) else int(event_nums)
+
+
+class EventPlayer:
+    '''Plays an EventStream on a clock.
+
+    clock needs time() (seconds) and schedule_once(callback, timeout), kivy.clock.Clock does.
+    on_event(event_num) is called as each event comes due and on_end() after the last one, they
+    should only update state and leave drawing to a FrameRenderer.
+    Events are timed from when play() is called rather than from the previous callback, so a
+    late callback doesn't push back the rest of the song: every event that is due is applied,
+    in order, and the next callback is set for the next event.
+    '''
+    def __init__(self, events, on_event, on_end=None, clock=None):
+        if clock is None:
+            from kivy.clock import Clock as clock
+        self.events = events
+        self.on_event = on_event
+        self.on_end = on_end
+        self.clock = clock
+        self.event_num = 0
+        self.start = None
+        self.playing = False
+
+    def play(self, seconds=0.0):
+        '''Play from seconds into the track, events at or after it are still to come.'''
+        self.event_num = int(np.searchsorted(self.events.times, seconds))
+        self.start = self.clock.time() - seconds
+        self.playing = True
+        self._tick()
+
+    def stop(self):
+        self.playing = False
+
+    def current_event(self):
+        '''The event at the current clock time while playing, else the last one played.'''
+        if not self.playing:
+            return self.event_num - 1
+        return min(self.events.event_at(self.clock.time() - self.start), len(self.events) - 1)
+
+    def _tick(self, dt=None):
+        if not self.playing:
+            return
+        times = self.events.times
+        elapsed = self.clock.time() - self.start
+        while self.event_num < len(times) and times[self.event_num] <= elapsed:
+            self.on_event(self.event_num)
+            self.event_num += 1
+        if self.event_num == len(times):
+            self.playing = False
+            if self.on_end is not None:
+                self.on_end()
+            return
+        self.clock.schedule_once(self._tick, max(times[self.event_num] - elapsed, 0))
+
+
+class FrameRenderer:
+    '''Draws what an EventPlayer is playing, once per frame.
+
+    Every frame (clock.schedule_interval(callback, 0), which kivy.clock.Clock runs once per
+    frame) the player's current event is compared with what was drawn last, and if any strings
+    differ draw(changes, event_num) is called with them, as ((string index, fret or None), ...).
+    Events skipped between frames are folded into one draw.  The renderer stops by itself once
+    the player is done and its last state is drawn.
+    '''
+    def __init__(self, player, draw, clock=None):
+        self.player = player
+        self.draw = draw
+        self.clock = player.clock if clock is None else clock
+        self.drawn = np.full(player.events.states.shape[1], -1)
+        self.frame_event = None
+        self.draws = 0
+
+    def start(self, drawn=None):
+        '''drawn is the fret state on screen now, the board is taken to be empty otherwise.'''
+        if drawn is not None:
+            self.drawn[:] = [-1 if fret is None else fret for fret in drawn]
+        self.stop()
+        self.frame_event = self.clock.schedule_interval(self._frame, 0)
+
+    def stop(self):
+        if self.frame_event is not None:
+            self.frame_event.cancel()
+            self.frame_event = None
+
+    def _frame(self, dt=None):
+        event_num = self.player.current_event()
+        if event_num >= 0:
+            state = self.player.events.states[event_num]
+            strings = np.flatnonzero(state != self.drawn)
+            if len(strings):
+                self.drawn[strings] = state[strings]
+                self.draws += 1
+                self.draw([(string, None if fret < 0 else fret)
+                           for string, fret in zip(strings.tolist(), state[strings].tolist())],
+                          event_num)
+        if not self.player.playing:
+            self.stop()
+
+
+class LookAhead:
+    '''The fret states of the next size events after the playhead, in a ring buffer.
+
+    states[slot] is the state of event event_nums[slot], all -1 past the end of the track.  The
+    next event is in slot head, the one after it in head + 1 and so on (mod size), distance(slot)
+    says how far ahead a slot is.  advance(event_num) moves the playhead and refills only the
+    slots that fell behind it, returning them, so a drawer only has to move those.
+    '''
+    def __init__(self, events, size=3):
+        self.events = events
+        self.size = size
+        self.states = np.full((size, events.states.shape[1]), -1, dtype=events.states.dtype)
+        self.event_nums = np.full(size, len(events))
+        self.head = 0
+        self.event_num = None
+
+    def distance(self, slot):
+        return (slot - self.head) % self.size
+
+    def advance(self, event_num):
+        if event_num == self.event_num:
+            return ()
+        steps = self.size if self.event_num is None else event_num - self.event_num
+        if not 0 < steps < self.size:
+            # Started, jumped or went back, fill the whole buffer.
+            self.head = 0
+            slots = range(self.size)
+            first = event_num + 1
+        else:
+            slots = [(self.head + i) % self.size for i in range(steps)]
+            self.head = (self.head + steps) % self.size
+            first = event_num + self.size - steps + 1
+        self.event_num = event_num
+        for i, slot in enumerate(slots):
+            self._fill(slot, first + i)
+        return slots
+
+    def _fill(self, slot, event_num):
+        if event_num < len(self.events):
+            self.states[slot] = self.events.states[event_num]
+            self.event_nums[slot] = event_num
+        else:
+            self.states[slot] = -1
+            self.event_nums[slot] = len(self.events)
+
+    def upcoming(self):
+        '''The states in order, nearest first (a copy, for printing and checks).'''
+        return np.roll(self.states, -self.head, axis=0)
+
+
+def main(argv):
+    if len(argv) in (1, 2):
+        from gp_to_kivy import KivySongBuilder
+        song = KivySongBuilder(argv[0])
+        fps = float(argv[1]) if len(argv) == 2 else 90
+        for track_num, track in enumerate(song.song, 1):
+            events = EventStream.from_beats(track)
+            # Events showing at each frame, a draw happens when that moves on.
+            frame_events = events.event_at(np.arange(0, events.length + 1 / fps, 1 / fps))
+            draws = np.count_nonzero(np.diff(frame_events, prepend=-1) > 0)
+            print("Track {}: {} beats, {} events, {} string changes (vs {} string updates "
+                  "beat by beat), {} draws at {:g} fps".format(
+                      track_num, len(track), len(events), events.num_changes, len(track) * 6,
+                      draws, fps))
+    else:
+        print("python playback.py SONG [fps]")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
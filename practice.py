@@ -0,0 +1,313 @@
+import sys
+import time
+import wave
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from fingering import get_fret_index
+
+'''Practice scoring: how much of a track a WAV recording of the player actually plays.
+
+The WAV is read in chunks.  PitchTracker turns each chunk into frames and, with one batched FFT
+and a matrix product, into a salience per semitone (harmonic summation: the magnitude around a
+note's first few harmonics).  BeatScorer adds each frame to the beat sounding at its time, so
+only per beat sums are kept however long the recording is.  At the end every beat's notes are
+checked against the semitones that stood out during it, pitches heard that the tab doesn't
+have count against the score, and the detected pitches are placed on frets through the track's
+tuning.
+
+The recording is taken to start at the track's time 0, on the aligned timeline if the track has
+one (see KivySongBuilder.align_track).
+
+    python practice.py SONG TAKE.wav [track]          score a take
+    python practice.py render SONG OUT.wav [track]    synthesize a take of the track, to try it
+'''
+
+SAMPLE_FORMATS = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+
+def read_chunks(path, seconds=1.0):
+    '''(sample rate, generator of mono float32 chunks in [-1, 1]) of a PCM WAV file.'''
+    reader = wave.open(path, "rb")
+    sample_rate, channels, width = reader.getframerate(), reader.getnchannels(), reader.getsampwidth()
+    if width not in (1, 2, 3, 4):
+        reader.close()
+        raise ValueError("{}: unsupported sample width {}".format(path, width))
+    frames = max(int(sample_rate * seconds), 1)
+
+    def chunks():
+        with reader:
+            while True:
+                data = reader.readframes(frames)
+                if not data:
+                    return
+                yield _decode(data, width, channels)
+    return sample_rate, chunks()
+
+
+def _decode(data, width, channels):
+    if width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = (raw[:, 0] << 8 | raw[:, 1] << 16 | raw[:, 2] << 24) >> 8
+    else:
+        samples = np.frombuffer(data, dtype=SAMPLE_FORMATS[width])
+    if width == 1:
+        samples = samples.astype(np.float32) - 128
+    samples = samples.astype(np.float32) / (1 << (8 * width - 1))
+    return samples.reshape(-1, channels).mean(axis=1)
+
+
+def midi_frequency(pitch):
+    return 440.0 * 2 ** ((np.asarray(pitch) - 69) / 12)
+
+
+class PitchTracker:
+    '''Semitone salience of a stream of audio, for MIDI pitches low..high.
+
+    feed(samples) returns (times, salience): the centre time in seconds of each complete frame
+    and an (F, high - low + 1) array.  Samples that don't make up a whole hop yet are kept for
+    the next call.
+    '''
+    def __init__(self, sample_rate, low=40, high=88, frame_size=4096, hop=1024, harmonics=5):
+        self.sample_rate = sample_rate
+        self.low, self.high = low, high
+        self.frame_size, self.hop = frame_size, hop
+        self.window = np.hanning(frame_size).astype(np.float32)
+        self.weights = self._harmonic_weights(harmonics)
+        self.buffer = np.zeros(0, dtype=np.float32)
+        self.position = 0  # Sample index of buffer[0].
+
+    def _harmonic_weights(self, harmonics):
+        '''(bins, notes) matrix summing the bins within a quarter tone of each harmonic,
+        harmonic h weighted 0.8**(h-1).'''
+        bin_hz = self.sample_rate / self.frame_size
+        num_bins = self.frame_size // 2 + 1
+        weights = np.zeros((num_bins, self.high - self.low + 1), dtype=np.float32)
+        for note, f0 in enumerate(midi_frequency(np.arange(self.low, self.high + 1))):
+            for h in range(1, harmonics + 1):
+                f = f0 * h
+                first = int(np.floor(f * 2 ** (-1 / 24) / bin_hz + 0.5))
+                last = max(int(np.floor(f * 2 ** (1 / 24) / bin_hz + 0.5)), first)
+                if last >= num_bins:
+                    break
+                weights[first:last + 1, note] += 0.8 ** (h - 1) / (last - first + 1)
+        return weights
+
+    def feed(self, samples):
+        buffer = np.concatenate((self.buffer, samples))
+        num_frames = (len(buffer) - self.frame_size) // self.hop + 1 if len(buffer) >= self.frame_size else 0
+        if num_frames <= 0:
+            self.buffer = buffer
+            return np.zeros(0), np.zeros((0, self.weights.shape[1]), dtype=np.float32)
+        frames = sliding_window_view(buffer, self.frame_size)[::self.hop][:num_frames]
+        magnitudes = np.abs(np.fft.rfft(frames * self.window, axis=1)).astype(np.float32)
+        starts = self.position + np.arange(num_frames) * self.hop
+        times = (starts + self.frame_size / 2) / self.sample_rate
+        consumed = num_frames * self.hop
+        self.buffer = buffer[consumed:]
+        self.position += consumed
+        return times, magnitudes @ self.weights
+
+
+class PracticeScore:
+    '''How a take went, per beat of the timeline it was scored against.  N beats, M measures:
+
+        hits:           (N, 6) True where the tab's note was heard
+        wrong:          (N,) pitches heard in each beat that aren't in the tab
+        detected_frets: (N, 6) fret of each heard pitch placed through the tuning, -1 elsewhere
+        beat_scores:    (N,) notes heard over notes plus wrong pitches, nan for silent rests
+        measure_scores: (M,) the same per measure, nan for empty measures
+        score:          the same over the whole track
+
+    So a take only scores well if it plays the tab's notes and not others.
+    '''
+    def __init__(self, timeline, hits, wrong, detected_frets):
+        self.hits = hits
+        self.wrong = wrong
+        self.detected_frets = detected_frets
+        expected = (timeline.pitches >= 0).sum(axis=1) + wrong
+        heard = hits.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.beat_scores = heard / expected
+            starts = timeline.measure_starts[:-1]
+            filled = np.flatnonzero(np.diff(timeline.measure_starts))
+            measure_expected = np.zeros(timeline.num_measures)
+            measure_heard = np.zeros(timeline.num_measures)
+            if len(filled):
+                measure_expected[filled] = np.add.reduceat(expected, starts[filled])
+                measure_heard[filled] = np.add.reduceat(heard, starts[filled])
+            self.measure_scores = measure_heard / measure_expected
+        self.score = float(heard.sum() / max(expected.sum(), 1))
+
+
+class BeatScorer:
+    '''Scores a take against a TrackTimeline from PitchTracker frames as they arrive.
+
+    Each frame's salience is added to the beat sounding at its time.  A pitch counts as heard
+    in a beat if its average salience there is a peak (no lower than the semitones either side),
+    at least threshold times the beat's strongest one, contrast times the beat's median (its
+    floor) and silence times the strongest of the take.  A note tied over several beats counts
+    as heard in all of them if it's heard in any, a re-picked one has to be heard again.
+    '''
+    def __init__(self, timeline, tuning, low=40, high=88, threshold=0.35, contrast=3.0,
+                 silence=0.02, offset=0.0):
+        self.timeline = timeline
+        self.tuning = tuple(tuning)
+        self.low, self.high = low, high
+        self.threshold, self.contrast, self.silence = threshold, contrast, silence
+        self.offset = offset  # Seconds of the take before the track's time 0.
+        self.sums = np.zeros((len(timeline), high - low + 1), dtype=np.float64)
+        self.counts = np.zeros(len(timeline), dtype=np.intp)
+
+    def feed(self, times, salience):
+        beats = self.timeline.beat_at(times - self.offset)
+        inside = (beats >= 0) & (times - self.offset < self.timeline.length)
+        np.add.at(self.sums, beats[inside], salience[inside])
+        self.counts += np.bincount(beats[inside], minlength=len(self.counts))
+
+    def result(self):
+        means = self.sums / np.maximum(self.counts, 1)[:, None]
+        strongest = means.max(axis=1)
+        # Peaks only, a note's energy spills into the semitones either side of it.  They have
+        # to stand out from the beat's floor (noise, or everything ringing at once), and from
+        # silence.
+        padded = np.pad(means, ((0, 0), (1, 1)))
+        peaks = (means >= padded[:, :-2]) & (means >= padded[:, 2:])
+        floor = np.maximum(self.contrast * np.median(means, axis=1),
+                           self.silence * strongest.max(initial=0))
+        heard = (peaks & (means >= floor[:, None]) & (means >= self.threshold * strongest[:, None])
+                 & (strongest > 0)[:, None])
+
+        pitches = self.timeline.pitches
+        notes = pitches - self.low
+        expected = (pitches >= 0) & (notes >= 0) & (pitches <= self.high)
+        hits = expected & np.take_along_axis(heard, np.clip(notes, 0, heard.shape[1] - 1), axis=1)
+
+        # A tied note fades, it's heard if it's heard anywhere from where it was struck.  Runs
+        # are numbered down each string, offset per string.
+        frets = self.timeline.frets
+        struck = expected & ~self.timeline.ties
+        runs = np.cumsum(struck, axis=0) + np.arange(frets.shape[1]) * (len(frets) + 1)
+        run_hits = np.zeros(frets.shape[1] * (len(frets) + 1), dtype=bool)
+        np.logical_or.at(run_hits, runs[expected], hits[expected])
+        hits = expected & run_hits[runs]
+        return PracticeScore(self.timeline, hits, self._wrong_notes(heard),
+                             self._detected_frets(heard, hits))
+
+    def _wrong_notes(self, heard):
+        '''(N,) heard pitches that aren't in the tab.  Pitches of the beat and the one before
+        (still ringing, and frames overlap beats) are allowed, as are the fourths, fifths,
+        octaves, twelfths and two octaves either side of them, where their harmonics line up
+        with another note's and harmonic summation puts salience too.'''
+        pitches = self.timeline.pitches
+        notes = np.where(pitches >= 0, pitches - self.low, -1 << 10)
+        notes = np.hstack((notes, np.vstack((np.full((1, notes.shape[1]), -1 << 10), notes[:-1]))))
+        beats = np.broadcast_to(np.arange(len(heard))[:, None], notes.shape)
+        explained = np.zeros_like(heard)
+        for interval in (0, 5, -5, 7, -7, 12, -12, 19, -19, 24, -24):
+            targets = notes + interval
+            inside = (targets >= 0) & (targets < heard.shape[1])
+            explained[beats[inside], targets[inside]] = True
+        return (heard & ~explained).sum(axis=1)
+
+    def _detected_frets(self, heard, hits):
+        '''Heard pitches on the fretboard: the tab's string and fret for hits, otherwise the
+        free string closest to the beat's frets.'''
+        index = get_fret_index(self.tuning)
+        frets = np.where(hits, self.timeline.frets, -1).astype(np.int16)
+        hit_pitches = np.where(hits, self.timeline.pitches, -1)
+        for beat in np.flatnonzero(heard.any(axis=1)).tolist():
+            beat_frets = frets[beat]
+            tab_frets = self.timeline.frets[beat]
+            played = tab_frets[tab_frets > 0]
+            hand = played.mean() if len(played) else 0
+            for note in np.flatnonzero(heard[beat]).tolist():
+                pitch = note + self.low
+                if pitch in hit_pitches[beat]:
+                    continue
+                free = [(abs(fret - hand), string, fret) for string, fret in index.positions(pitch)
+                        if beat_frets[string] < 0]
+                if free:
+                    distance, string, fret = min(free)
+                    beat_frets[string] = fret
+        return frets
+
+
+def score_take(song, path, track_num=0, chunk_seconds=1.0, offset=0.0, **scorer_args):
+    '''Score a WAV take of track track_num of a KivySongBuilder, return a PracticeScore.'''
+    timeline = song.aligned_timeline(track_num)
+    if timeline is None:
+        timeline = song.timelines[track_num]
+    tuning = [value for number, value in song.gp_tunings[track_num]][:timeline.frets.shape[1]]
+    low, high = min(tuning), max(tuning) + 24
+    sample_rate, chunks = read_chunks(path, chunk_seconds)
+    tracker = PitchTracker(sample_rate, low, high)
+    scorer = BeatScorer(timeline, tuning, low, high, offset=offset, **scorer_args)
+    for samples in chunks:
+        scorer.feed(*tracker.feed(samples))
+    return scorer.result()
+
+
+def render_take(timeline, path, sample_rate=22050):
+    '''Write a plucked-string rendering of timeline to a 16-bit mono WAV, a stand-in take for
+    trying score_take.  Every note but a tied one is struck, and sounds until the string is
+    struck again, changes or stops.'''
+    frets, pitches = timeline.frets, timeline.pitches
+    ends = np.append(timeline.onsets, timeline.length)
+    samples = np.zeros(int(ends[-1] * sample_rate) + 1, dtype=np.float32)
+    for string in range(pitches.shape[1]):
+        column = frets[:, string]
+        starts = np.flatnonzero((column >= 0) & ~timeline.ties[:, string])
+        changes = np.flatnonzero((column != np.concatenate(([-1], column[:-1])))
+                                 | ((column >= 0) & ~timeline.ties[:, string]))
+        for start in starts.tolist():
+            stop = changes[np.searchsorted(changes, start, side="right")] \
+                if changes[-1] > start else len(column)
+            first, last = int(ends[start] * sample_rate), int(ends[stop] * sample_rate)
+            t = np.arange(last - first) / sample_rate
+            f0 = midi_frequency(pitches[start, string])
+            tone = sum(0.8 ** (h - 1) * np.sin(2 * np.pi * f0 * h * t) for h in range(1, 6))
+            samples[first:last] += (0.1 * np.exp(-3 * t) * tone).astype(np.float32)
+    samples = np.clip(samples, -1, 1)
+    with wave.open(path, "wb") as writer:
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(sample_rate)
+        writer.writeframes((samples * 32767).astype("<i2").tobytes())
+    return len(samples) / sample_rate
+
+
+def main(argv):
+    from gp_to_kivy import KivySongBuilder
+    if len(argv) in (3, 4) and argv[0] == "render":
+        song = KivySongBuilder(argv[1])
+        track_num = int(argv[3]) - 1 if len(argv) == 4 else 0
+        seconds = render_take(song.timelines[track_num], argv[2])
+        print("{:.1f} s written to {}".format(seconds, argv[2]))
+    elif len(argv) in (2, 3):
+        song = KivySongBuilder(argv[0])
+        track_num = int(argv[2]) - 1 if len(argv) == 3 else 0
+        with wave.open(argv[1], "rb") as reader:
+            duration = reader.getnframes() / reader.getframerate()
+        start = time.perf_counter()
+        result = score_take(song, argv[1], track_num)
+        seconds = time.perf_counter() - start
+        timeline = song.aligned_timeline(track_num)
+        if timeline is None:
+            timeline = song.timelines[track_num]
+        print("{:.1%}: {} of {} notes heard, {} wrong pitches".format(
+            result.score, result.hits.sum(), (timeline.pitches >= 0).sum(), result.wrong.sum()))
+        weak = [(score, number) for score, number in zip(result.measure_scores.tolist(),
+                                                          timeline.measure_numbers.tolist())
+                if score < 0.75]
+        if weak:
+            print("Measures under 75%: " + ", ".join("{} ({:.0%})".format(number, score)
+                                                     for score, number in weak))
+        print("{:.1f} s of audio scored in {:.2f} s, {:.0f}x real time".format(
+            duration, seconds, duration / seconds))
+    else:
+        print("python practice.py SONG TAKE.wav [track] | render SONG OUT.wav [track]")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
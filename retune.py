@@ -0,0 +1,47 @@
+import numpy as np
+from fingering import get_fret_index
+
+
+def retune_frets(pitches, tuning, capo=0, transpose=0, num_frets=24):
+    '''Fret matrix that plays pitches (TrackTimeline.pitches, -1 == not played) in tuning.
+
+    tuning is the open string MIDI values, index 0 is string 1.  Frets are counted from the
+    capo.  Every note stays on its string when it can, that part is one vectorized pass over the
+    whole matrix.  Notes that fall off the neck are moved to the free string closest to the
+    rest of the beat's hand position, or dropped if there isn't one.
+
+    Return (frets, dropped): (N, S) int8 frets with -1 where a string isn't played, and the
+    number of notes that couldn't be placed.
+    '''
+    played = pitches >= 0
+    open_strings = np.array(tuning, dtype=np.int16) + capo
+    frets = pitches.astype(np.int16) + transpose - open_strings[None, :]
+    frets[~played] = -1
+    unplayable = played & ((frets < 0) | (frets > num_frets - capo))
+
+    dropped = 0
+    if unplayable.any():
+        index = get_fret_index(tuple(open_strings.tolist()), num_frets - capo)
+        for row in np.flatnonzero(unplayable.any(axis=1)):
+            dropped += _relocate(frets[row], pitches[row] + transpose, unplayable[row], index)
+    return frets.astype(np.int8), dropped
+
+
+def _relocate(frets, pitches, unplayable, index):
+    '''Move the unplayable notes of one beat (frets row, edited in place) to free strings.'''
+    frets[unplayable] = -1
+    fretted = frets[frets > 0]
+    hand = fretted.mean() if len(fretted) else 0
+    dropped = 0
+    for pitch in pitches[unplayable]:
+        if not 0 <= pitch < 128:
+            dropped += 1
+            continue
+        free = [(string, fret) for string, fret in index.positions(int(pitch))
+                if frets[string] < 0]
+        if not free:
+            dropped += 1
+            continue
+        string, fret = min(free, key=lambda position: abs(position[1] - hand))
+        frets[string] = fret
+    return dropped
@@ -0,0 +1,160 @@
+import os
+import sqlite3
+import numpy as np
+
+'''Riff search across a song library.
+
+Every track of every song is reduced to its line of lowest notes (the root of power chords and
+chords, the note itself in single note riffs).  Consecutive notes are turned into n-grams of
+intervals, which don't change under transposition, and n-grams of rhythm (how much longer or
+shorter each note is than the one before, which doesn't change with tempo).  The index maps each
+n-gram to the (song, track, measure) it starts in and lives in a sqlite file, so it persists and
+songs can be added or re-indexed one at a time.
+'''
+
+GRAM_SIZE = 4  # Intervals per n-gram, i.e. 5 notes.
+MAX_INTERVAL = 24
+MAX_RHYTHM = 4
+
+# kind column of postings.
+INTERVALS, INTERVALS_AND_RHYTHM = 0, 1
+
+
+def melody(timeline):
+    '''(pitches, onsets, beats) of the lowest note of every beat that has notes, beats are the
+    indices of those beats in the timeline.'''
+    pitches = np.where(timeline.pitches >= 0, timeline.pitches, 1 << 14).min(axis=1)
+    beats = np.flatnonzero(pitches < (1 << 14))
+    return pitches[beats].astype(np.int64), timeline.onsets[beats], beats
+
+
+def interval_grams(pitches, gram_size=GRAM_SIZE):
+    '''One int key per gram_size consecutive intervals of pitches.'''
+    if len(pitches) <= gram_size:
+        return np.zeros(0, dtype=np.int64)
+    intervals = np.clip(np.diff(pitches), -MAX_INTERVAL, MAX_INTERVAL) + MAX_INTERVAL
+    windows = np.lib.stride_tricks.sliding_window_view(intervals, gram_size)
+    base = (2 * MAX_INTERVAL + 1) ** np.arange(gram_size, dtype=np.int64)
+    return windows @ base
+
+
+def rhythm_grams(onsets, gram_size=GRAM_SIZE):
+    '''One int key per gram_size consecutive notes' rhythm, aligned with interval_grams.
+
+    Each note's rhythm is log2 of its inter-onset time over the previous note's, in half steps,
+    so a dotted or double-length note is recognized at any tempo.
+    '''
+    if len(onsets) <= gram_size:
+        return np.zeros(0, dtype=np.int64)
+    lengths = np.diff(onsets)
+    ratios = np.log2(np.maximum(lengths[1:], 1e-6) / np.maximum(lengths[:-1], 1e-6))
+    codes = np.clip(np.round(ratios * 2), -MAX_RHYTHM, MAX_RHYTHM).astype(np.int64) + MAX_RHYTHM
+    windows = np.lib.stride_tricks.sliding_window_view(codes, gram_size - 1)
+    base = (2 * MAX_RHYTHM + 1) ** np.arange(gram_size - 1, dtype=np.int64)
+    return windows @ base
+
+
+def riff_grams(pitches, onsets=None, gram_size=GRAM_SIZE):
+    '''(kind, keys) of a note sequence.  Rhythm is only included if onsets are given.'''
+    keys = interval_grams(np.asarray(pitches, dtype=np.int64), gram_size)
+    if onsets is None:
+        return INTERVALS, keys
+    rhythm = rhythm_grams(np.asarray(onsets, dtype=np.float64), gram_size)
+    # Interval keys are < 49**4, room for the rhythm above them in an int64.
+    return INTERVALS_AND_RHYTHM, keys + rhythm * (2 * MAX_INTERVAL + 1) ** gram_size
+
+
+class RiffIndex:
+    '''Inverted index of interval and rhythm n-grams, persisted to a sqlite file.
+
+        index = RiffIndex("library.riffs")
+        index.update(paths)                   # Only new or modified files are parsed.
+        index.search([40, 43, 45, 40, 38, 40])
+        index.search(pitches, onsets)         # Match rhythm too.
+    '''
+    def __init__(self, path, gram_size=GRAM_SIZE):
+        self.path = path
+        self.gram_size = gram_size
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS songs (
+                id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL);
+            CREATE TABLE IF NOT EXISTS postings (
+                gram INTEGER, kind INTEGER, song INTEGER, track INTEGER, measure INTEGER);
+            CREATE INDEX IF NOT EXISTS postings_gram ON postings (kind, gram);
+            CREATE INDEX IF NOT EXISTS postings_song ON postings (song);
+        ''')
+
+    def close(self):
+        self.db.close()
+
+    def update(self, paths, builder=None):
+        '''Index new or modified files, return the number (re)indexed.
+
+        builder(path) returns a KivySongBuilder or a TimelineSong (the default).
+        '''
+        if builder is None:
+            from gp_to_kivy import TimelineSong as builder
+        indexed = 0
+        for path in paths:
+            path = os.path.abspath(path)
+            mtime = os.path.getmtime(path)
+            row = self.db.execute("SELECT mtime FROM songs WHERE path = ?", (path,)).fetchone()
+            if row is not None and row[0] == mtime:
+                continue
+            self.add_song(path, builder(path), mtime)
+            indexed += 1
+        return indexed
+
+    def add_song(self, path, song, mtime=None):
+        '''Index a built KivySongBuilder under path, replacing anything indexed for it.'''
+        self.remove(path)
+        with self.db:
+            song_id = self.db.execute("INSERT INTO songs (path, mtime) VALUES (?, ?)",
+                                      (path, mtime)).lastrowid
+            for track_num, timeline in enumerate(song.timelines):
+                pitches, onsets, beats = melody(timeline)
+                measures = timeline.measure_numbers[timeline.beat_measures[beats]]
+                for kind, keys in (riff_grams(pitches, None, self.gram_size),
+                                   riff_grams(pitches, onsets, self.gram_size)):
+                    # Repeated measures share a number, only post each gram once per measure.
+                    postings = np.unique(np.stack([keys, measures[:len(keys)]], axis=1), axis=0)
+                    rows = [(gram, kind, song_id, track_num, measure)
+                            for gram, measure in postings.tolist()]
+                    self.db.executemany("INSERT INTO postings VALUES (?, ?, ?, ?, ?)", rows)
+
+    def remove(self, path):
+        with self.db:
+            row = self.db.execute("SELECT id FROM songs WHERE path = ?", (path,)).fetchone()
+            if row is not None:
+                self.db.execute("DELETE FROM postings WHERE song = ?", row)
+                self.db.execute("DELETE FROM songs WHERE id = ?", row)
+
+    def search(self, pitches, onsets=None, limit=20):
+        '''Ranked [(path, track, measure, score), ...] of places that contain the riff.
+
+        pitches are MIDI note numbers in any key; give onsets (seconds or beats, any tempo) to
+        match rhythm as well.  score is the fraction of the riff's n-grams that start in that
+        measure.
+        '''
+        kind, keys = riff_grams(pitches, onsets, self.gram_size)
+        keys = sorted(set(keys.tolist()))
+        if not keys:
+            return []
+        marks = ",".join("?" * len(keys))
+        rows = self.db.execute('''
+            SELECT songs.path, track, measure, COUNT(DISTINCT gram) AS hits
+            FROM postings JOIN songs ON songs.id = postings.song
+            WHERE kind = ? AND gram IN ({})
+            GROUP BY song, track, measure
+            ORDER BY hits DESC, songs.path, track, measure
+            LIMIT ?'''.format(marks), [kind] + keys + [limit]).fetchall()
+        return [(path, track, measure, hits / len(keys)) for path, track, measure, hits in rows]
+
+    def search_measures(self, timeline, start, stop, rhythm=True, limit=20):
+        '''Use measures [start, stop) of a loaded TrackTimeline as the query.  These index the
+        timeline's measures, with repeats unrolled, not MeasureHeader numbers.'''
+        pitches, onsets, beats = melody(timeline)
+        in_range = ((beats >= timeline.measure_starts[start]) &
+                    (beats < timeline.measure_starts[stop]))
+        return self.search(pitches[in_range], onsets[in_range] if rhythm else None, limit)
@@ -0,0 +1,331 @@
+import heapq
+import itertools
+import sys
+import time
+import numpy as np
+
+'''Headless playback of a song on fretless.Fretboard, on a virtual clock.
+
+Fretboard.play_song normally runs on kivy's Clock in real time with a window open.  Simulation
+gives the same widget a VirtualClock instead: nothing is shown and simulated time jumps straight
+to the next callback, so an hour of playback takes seconds.  Every event the player fires and
+every draw the renderer makes is recorded with its clock time, and the clock can make each
+callback late by a random latency to see how the scheduler copes:
+
+    events:  each event is fired once, in order, never early, and never later than the latency
+             of the callback that fired it (events are timed from the start of the song, so
+             lateness mustn't build up over a long song)
+    frames:  after each frame the strings show the state of the event at that clock time, and
+             the ghost notes the states of the events after it
+    end:     the song ends once, with the board cleared and nothing left scheduled
+
+    python simulator.py SONG [hours] [latency_ms] [fps]
+
+loops track 1 of SONG for hours (default: once through) with callbacks late by an exponentially
+distributed latency of mean latency_ms (default 0), at fps frames a second (default 60).
+'''
+
+
+class ClockEvent:
+    '''What VirtualClock.schedule_once and schedule_interval return, like kivy's ClockEvent.'''
+    def __init__(self, callback, interval, now):
+        self.callback = callback
+        self.interval = interval  # None for schedule_once.
+        self.last = now  # When scheduled or last run, for the dt passed to callback.
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class VirtualClock:
+    '''A stand-in for kivy.clock.Clock that runs on simulated time, as fast as the callbacks do.
+
+    schedule_once callbacks run timeout seconds on, and interval-0 callbacks run together once
+    a frame, every 1/fps seconds, in the order they were scheduled (other intervals run on
+    their own timer).  latency() is called for every callback and frame and returns how many
+    seconds late it runs, as a busy main loop would; a frame that runs late enough to miss the
+    next one drops it.  run() fires callbacks in time order until none are left.
+    '''
+    def __init__(self, fps=60, latency=None):
+        self.now = 0.0
+        self.frame_interval = 1 / fps
+        self.latency = latency
+        # (fire time, order scheduled, due time, event), event is None for a frame.
+        self.queue = []
+        self.order = itertools.count()
+        self.frame_events = []
+        self.frame_pending = False
+        self.callbacks = 0
+        self.frames = 0
+        self.dropped_frames = 0
+        self.max_latency = 0.0
+
+    def time(self):
+        return self.now
+
+    def schedule_once(self, callback, timeout=0):
+        event = ClockEvent(callback, None, self.now)
+        self._push(self.now + timeout, event)
+        return event
+
+    def schedule_interval(self, callback, timeout):
+        event = ClockEvent(callback, timeout, self.now)
+        if timeout:
+            self._push(self.now + timeout, event)
+            return event
+        self.frame_events.append(event)
+        if not self.frame_pending:
+            self.frame_pending = True
+            self._push(self.now + self.frame_interval, None)
+        return event
+
+    def pending(self):
+        '''Callbacks still to run, cancelled ones aside.'''
+        return (sum(1 for fire, order, due, event in self.queue
+                    if event is not None and not event.cancelled) +
+                sum(1 for event in self.frame_events if not event.cancelled))
+
+    def run(self, until=None):
+        '''Run callbacks until there are none left, or until the clock would pass until.'''
+        queue = self.queue
+        while queue:
+            if until is not None and queue[0][0] > until:
+                self.now = until
+                return
+            fire, order, due, event = heapq.heappop(queue)
+            self.now = max(self.now, fire)
+            if event is None:
+                self._frame(due)
+            elif not event.cancelled:
+                self._fire(event, due)
+
+    def _push(self, due, event):
+        delay = self.latency() if self.latency is not None else 0.0
+        self.max_latency = max(self.max_latency, delay)
+        heapq.heappush(self.queue, (due + delay, next(self.order), due, event))
+
+    def _fire(self, event, due):
+        self._call(event)
+        if event.interval is None:
+            event.cancel()
+        if not event.cancelled:
+            self._push(due + self._ticks_gone(due, event.interval) * event.interval, event)
+
+    def _frame(self, due):
+        self.frames += 1
+        for event in list(self.frame_events):
+            if not event.cancelled:
+                self._call(event)
+        self.frame_events = [event for event in self.frame_events if not event.cancelled]
+        if self.frame_events:
+            ticks = self._ticks_gone(due, self.frame_interval)
+            self.dropped_frames += ticks - 1
+            self._push(due + ticks * self.frame_interval, None)
+        else:
+            self.frame_pending = False
+
+    def _call(self, event):
+        self.callbacks += 1
+        dt = self.now - event.last
+        event.last = self.now
+        # Like kivy, returning False unschedules.
+        if event.callback(dt) is False:
+            event.cancel()
+
+    def _ticks_gone(self, due, interval):
+        '''Ticks from due to the next one that hasn't already gone by.'''
+        return max(int((self.now - due) // interval), 0) + 1
+
+
+class LoopedSong:
+    '''A song whose first track is played repeats times over, for long simulations.  Only
+    what Fretboard.play_song reads is there, and loops play at the written tempo.'''
+    def __init__(self, song, repeats):
+        self.song = [song.song[0] * repeats]
+        self.beat_chord_names = [song.beat_chord_names[0] * repeats]
+
+    def aligned_timeline(self, track_num):
+        return None
+
+
+def headless_fretboard(song, look_ahead=3, size=(1000, 300)):
+    '''A fretless.Fretboard laid out as fretless.kv has it, without a window.'''
+    from fretless import Fretboard, String
+    fretboard = Fretboard(orientation="vertical", spacing=2, size=size, look_ahead=look_ahead)
+    for string in range(1, 7):
+        widget = String()
+        fretboard.add_widget(widget)
+        fretboard.ids[str(string)] = widget
+    fretboard.do_layout()
+    fretboard._update_canvas(fretboard, None)
+    fretboard.song = song
+    return fretboard
+
+
+class Simulation:
+    '''Plays fretboard's song on clock and records what it does, see the module docstring.
+
+    fired: (event number, clock time) per player callback
+    draws: (clock time, event number, changes) per renderer draw
+    '''
+    def __init__(self, fretboard, clock):
+        self.fretboard = fretboard
+        self.clock = clock
+        fretboard.clock = clock
+        self.fired = []
+        self.draws = []
+        self.ends = []
+        self.frame_mismatches = []
+        self.ghost_mismatches = []
+        self.frames = 0
+        # play_song hands these bound methods to the player and renderer, wrap them first.
+        play_event, draw_event, end_song = (fretboard._play_event, fretboard._draw_event,
+                                            fretboard._end_song)
+
+        def _play_event(event_num):
+            self.fired.append((event_num, clock.time()))
+            play_event(event_num)
+
+        def _draw_event(changes, event_num):
+            self.draws.append((clock.time(), event_num, changes))
+            draw_event(changes, event_num)
+            self._check_ghosts(event_num)
+
+        def _end_song():
+            self.ends.append(clock.time())
+            end_song()
+
+        fretboard._play_event = _play_event
+        fretboard._draw_event = _draw_event
+        fretboard._end_song = _end_song
+
+    def run(self):
+        fretboard = self.fretboard
+        wall = time.perf_counter()
+        fretboard.play_song()
+        self.start = fretboard.player.start
+        self.events = fretboard.events
+        # Scheduled after the renderer, so it runs after it in every frame.
+        self.clock.schedule_interval(self._check_frame, 0)
+        # Anything still going a minute after the song should have ended never stops.
+        self.clock.run(self.start + self.events.length + 60)
+        self.wall_seconds = time.perf_counter() - wall
+        self.problems = self._problems()
+        return self
+
+    def board(self):
+        return [self.fretboard.ids[str(string + 1)].active_fret for string in range(6)]
+
+    def _check_frame(self, dt):
+        self.frames += 1
+        player = self.fretboard.player
+        event_num = player.current_event()
+        expected = ([None] * 6 if event_num < 0 else
+                    [None if fret < 0 else fret for fret in self.events.states[event_num].tolist()])
+        if self.board() != expected:
+            self.frame_mismatches.append((self.clock.time(), event_num))
+        if not player.playing:
+            return False
+
+    def _check_ghosts(self, event_num):
+        upcoming = self.fretboard.upcoming
+        if upcoming is None:
+            return
+        states = self.events.states[event_num + 1:event_num + 1 + upcoming.size]
+        expected = np.full_like(upcoming.states, -1)
+        expected[:len(states)] = states
+        if not np.array_equal(upcoming.upcoming(), expected):
+            self.ghost_mismatches.append((self.clock.time(), event_num))
+
+    def lateness(self):
+        '''Seconds each event fired after it was due.'''
+        if not self.fired:
+            return np.zeros(0)
+        event_nums, times = np.array(self.fired).T
+        return times - (self.start + self.events.times[event_nums.astype(int)])
+
+    def display_lag(self):
+        '''Seconds from each drawn event being due to it being on the board.  Events a frame
+        skipped over aren't drawn at all and aren't counted.'''
+        if not self.draws:
+            return np.zeros(0)
+        times = np.array([draw_time for draw_time, event_num, changes in self.draws])
+        event_nums = np.array([event_num for draw_time, event_num, changes in self.draws])
+        return times - (self.start + self.events.times[event_nums])
+
+    def _problems(self):
+        problems = []
+        events = self.events
+        event_nums = [event_num for event_num, fired_time in self.fired]
+        if event_nums != list(range(len(events))):
+            problems.append("events fired out of order, twice or not at all")
+        lateness = self.lateness()
+        if len(lateness) and lateness.min() < -1e-9:
+            problems.append("{} events fired early".format(np.count_nonzero(lateness < -1e-9)))
+        if len(lateness) and lateness.max() > self.clock.max_latency + 1e-9:
+            problems.append("events up to {:.3f}s late, more than any callback was".format(
+                lateness.max()))
+        if len(self.ends) != 1:
+            problems.append("song ended {} times".format(len(self.ends)))
+        if self.frame_mismatches:
+            problems.append("{} frames showed the wrong frets, first at {:.3f}s".format(
+                len(self.frame_mismatches), self.frame_mismatches[0][0] - self.start))
+        if self.ghost_mismatches:
+            problems.append("{} ghost redraws showed the wrong states, first at {:.3f}s".format(
+                len(self.ghost_mismatches), self.ghost_mismatches[0][0] - self.start))
+        if self.board() != [None] * 6:
+            problems.append("board not cleared at the end")
+        if self.clock.pending():
+            problems.append("{} callbacks still scheduled after the song".format(
+                self.clock.pending()))
+        return problems
+
+    def report(self):
+        events = self.events
+        lateness = self.lateness() * 1000
+        lag = self.display_lag() * 1000
+        tenth = max(len(lateness) // 10, 1)
+        simulated = self.clock.time() - self.start
+        lines = [
+            "Simulated {:.1f}s in {:.2f}s ({:.0f}x real time)".format(
+                simulated, self.wall_seconds, simulated / max(self.wall_seconds, 1e-9)),
+            "{} events, {} clock callbacks, {} frames ({} dropped), {} draws, {} string "
+            "changes".format(len(events), self.clock.callbacks, self.frames,
+                             self.clock.dropped_frames, len(self.draws),
+                             sum(len(changes) for draw_time, event_num, changes in self.draws)),
+            "Event lateness ms: mean {:.2f}, p99 {:.2f}, max {:.2f}; mean over first tenth "
+            "{:.2f}, last tenth {:.2f}".format(
+                lateness.mean(), np.percentile(lateness, 99), lateness.max(),
+                lateness[:tenth].mean(), lateness[-tenth:].mean()) if len(lateness) else
+            "No events",
+            "Display lag ms: mean {:.2f}, p99 {:.2f}, max {:.2f}".format(
+                lag.mean(), np.percentile(lag, 99), lag.max()) if len(lag) else "No draws",
+            "Song end {:.2f}ms after the last event was due".format(
+                (self.ends[0] - self.start - events.times[-1]) * 1000) if self.ends else
+            "Song never ended",
+        ]
+        lines += ["PROBLEM: " + problem for problem in self.problems] or ["No problems"]
+        return "\n".join(lines)
+
+
+def main(argv):
+    if 1 <= len(argv) <= 4:
+        from gp_to_kivy import KivySongBuilder
+        song = KivySongBuilder(argv[0])
+        hours = float(argv[1]) if len(argv) > 1 else None
+        latency_ms = float(argv[2]) if len(argv) > 2 else 0.0
+        fps = float(argv[3]) if len(argv) > 3 else 60
+        if hours:
+            length = sum(beat.seconds for beat in song.song[0])
+            song = LoopedSong(song, max(int(np.ceil(hours * 3600 / length)), 1))
+        rng = np.random.default_rng(0)
+        latency = (lambda: rng.exponential(latency_ms / 1000)) if latency_ms else None
+        simulation = Simulation(headless_fretboard(song), VirtualClock(fps, latency)).run()
+        print(simulation.report())
+    else:
+        print("python simulator.py SONG [hours] [latency_ms] [fps]")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
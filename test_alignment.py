@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pytest
+
+from alignment import band, dtw, grid_times, warp_times
+from gp_to_kivy import KivySongBuilder
+
+SONG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tgr-nm-01-g1.gp5")
+
+
+@pytest.fixture(scope="module")
+def song():
+    return KivySongBuilder(SONG)
+
+
+def perform(reference, seed, wander=0.05, jitter=0.01, drop=0.02):
+    '''(true times, recorded times) of a take of reference times: the tempo wanders by up to
+    wander, each time is off by jitter seconds and drop of them are missing.'''
+    rng = np.random.default_rng(seed)
+    fine = np.linspace(reference[0], reference[-1] + 1, 20000)
+    rate = 1 + sum(wander / 2 * np.sin(2 * np.pi * fine / period + rng.uniform(0, 2 * np.pi))
+                   for period in (30, 70, 150))
+    rate = np.clip(rate, 1 - wander, 1 + wander)
+    clock = np.concatenate(([0], np.cumsum(np.diff(fine) / rate[1:])))
+    truth = np.interp(reference, fine, clock) + 0.3
+    keep = rng.random(len(truth)) >= drop
+    keep[[0, -1]] = True
+    return truth, np.sort(truth + rng.normal(0, jitter, len(truth)))[keep]
+
+
+@pytest.mark.parametrize("grid", ["notes", "beats", "measures"])
+def test_dropped_times_with_tempo_wander(song, grid):
+    reference = grid_times(song.timelines[0], grid, song.time_signature_numerators(0))
+    errors = []
+    for seed in range(3):
+        truth, recorded = perform(reference, seed)
+        errors.append(np.abs(warp_times(reference, reference, recorded, grid != "notes") - truth))
+    errors = np.concatenate(errors)
+    assert np.median(errors) < 0.02
+    # Even grids can't be told apart by rhythm, they mustn't slip whole steps.
+    if grid != "notes":
+        assert errors.max() < 0.1
+
+
+def test_banded_dtw_matches_full_dtw():
+    rng = np.random.default_rng(0)
+    cost = rng.random((40, 50))
+    full = dtw(lambda i, j: cost[i, j], np.zeros(40, dtype=int), np.full(40, 50), 0.5)
+    # The reference: every cell, one at a time.
+    total = np.full((41, 51), np.inf)
+    total[0, 0] = 0
+    for i in range(1, 41):
+        for j in range(1, 51):
+            total[i, j] = cost[i - 1, j - 1] + min(total[i - 1, j - 1], total[i - 1, j] + 0.5,
+                                                   total[i, j - 1] + 0.5)
+    path_cost = cost[full].sum() + 0.5 * np.count_nonzero(
+        (np.diff(full[0]) == 0) | (np.diff(full[1]) == 0))
+    assert path_cost == pytest.approx(total[40, 50])
+
+
+def test_band_is_narrow_and_connected():
+    stretched = np.arange(8000) * 0.3
+    recorded = stretched + 0.01
+    lo, hi = band(stretched, recorded, 10.0)
+    assert lo[0] == 0 and hi[-1] == len(recorded)
+    assert np.all(lo[1:] <= hi[:-1]) and np.all(np.diff(lo) >= 0)
+    assert (hi - lo).max() < 100
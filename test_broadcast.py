@@ -0,0 +1,53 @@
+import asyncio
+import os
+import pytest
+
+from broadcast import HOST, BeatBroadcaster, demo, stand_in_client
+from gp_to_kivy import TimelineSong
+from timeline import TrackTimeline
+
+SONG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tgr-nm-01-g1.gp5")
+MEASURES = 16
+
+
+@pytest.fixture(scope="module")
+def timeline():
+    '''First MEASURES measures of track 1.'''
+    timeline = TimelineSong(SONG).timelines[0]
+    beats = timeline.measure_starts[MEASURES]
+    return TrackTimeline(timeline.seconds[:beats], timeline.frets[:beats],
+                         timeline.pitches[:beats], timeline.pc_masks[:beats],
+                         timeline.measure_starts[:MEASURES + 1],
+                         timeline.measure_numbers[:MEASURES], ties=timeline.ties[:beats])
+
+
+def test_every_client_gets_every_beat_while_slow_ones_drop(timeline):
+    stats, slow_stats, dropped = asyncio.run(demo(timeline, num_clients=20, num_slow=2,
+                                                  speed=16.0))
+    for s in stats:
+        assert s["beats"] == len(timeline) and s["gaps"] == 0
+        # Slow clients don't hold the others up: every beat still arrives before it's due.
+        assert min(s["early"]) > 0
+    assert dropped > 0
+    assert all(s["beats"] < len(timeline) for s in slow_stats)
+
+
+def test_close_leaves_no_clients(timeline):
+    async def run():
+        broadcaster = BeatBroadcaster(timeline, port=0, queue_size=4, send_buffer=4096)
+        await broadcaster.start()
+        stats = [{}, {}]
+        tasks = [asyncio.create_task(stand_in_client(HOST, broadcaster.port, stats[0])),
+                 asyncio.create_task(stand_in_client(HOST, broadcaster.port, stats[1],
+                                                     read_delay=10))]
+        while len(broadcaster.clients) < 2:
+            await asyncio.sleep(0.01)
+        for beat in range(100):
+            broadcaster.broadcast({"type": "beat", "beat": beat, "at": 0})
+        await broadcaster.close(timeout=0.1)
+        assert not broadcaster.clients
+        # The normal client got "end of stream" rather than hanging, the slow one is asleep.
+        await asyncio.wait_for(tasks[0], 1)
+        tasks[1].cancel()
+        await asyncio.gather(tasks[1], return_exceptions=True)
+    asyncio.run(run())
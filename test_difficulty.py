@@ -0,0 +1,74 @@
+import os
+import numpy as np
+
+from difficulty import (TrackDifficulty, analyse_paths, difficulty_path, load_difficulty,
+                        save_difficulty)
+from gp_to_kivy import TimelineSong
+from timeline import TrackTimeline
+
+SONG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tgr-nm-01-g1.gp5")
+TUNING = np.array([64, 59, 55, 50, 45, 40])
+_ = -1
+
+
+def hand_built():
+    '''Two measures of four half second beats, index 0 is string 1.'''
+    frets = np.array([
+        [_, _, _, _, _, 3],   # Low E, 3rd fret.
+        [_, _, _, _, _, 3],   # Picked again.
+        [8, _, _, _, _, _],   # High E: a string skip and a shift of 5 frets.
+        [8, 10, _, _, _, _],  # The 8 is tied, 10 is the one note struck, span 2.
+        [_, _, _, _, _, _],   # Rest, the hand stays at 8.
+        [_, _, 0, 1, 5, _],   # 3 notes, open G doesn't count for span (4) or position (7 shift).
+        [_, _, _, 1, 5, _],   # Both tied.
+        [_, _, _, _, _, 2],   # 1 fret move, not a shift.
+    ], dtype=np.int8)
+    ties = np.zeros(frets.shape, dtype=bool)
+    ties[3, 0] = ties[6, 3] = ties[6, 4] = True
+    pitches = np.where(frets >= 0, frets + TUNING, -1).astype(np.int16)
+    return TrackTimeline(np.full(8, 0.5), frets, pitches, np.zeros(8, dtype=np.uint16),
+                         np.array([0, 4, 8]), np.array([1, 2]), ties=ties)
+
+
+def test_hand_built_counts():
+    difficulty = TrackDifficulty(hand_built(), np.array([120.0, 90.0]))
+    measures = difficulty.measures
+    assert measures["notes"].tolist() == [4, 4]
+    assert measures["notes_per_second"].tolist() == [2.0, 2.0]
+    assert measures["fret_span"].tolist() == [2, 4]
+    assert measures["position_shifts"].tolist() == [1, 1]
+    assert measures["shift_frets"].tolist() == [5, 7]
+    assert measures["string_skips"].tolist() == [1, 0]
+    assert measures["tempo"].tolist() == [120.0, 90.0]
+
+    row = difficulty.summary()[0]
+    assert (row["notes"], row["seconds"], row["max_fret_span"]) == (8, 4.0, 4)
+    assert (row["position_shifts"], row["string_skips"]) == (2, 1)
+    assert (row["max_tempo"], row["tempo_changes"]) == (120.0, 1)
+
+
+def test_repicked_notes_count_and_ties_dont():
+    timeline = TimelineSong(SONG).timelines[0]
+    assert timeline.ties.any()
+    played = timeline.frets >= 0
+    notes = TrackDifficulty(timeline).measures["notes"]
+    assert notes.sum() == played.sum() - timeline.ties.sum()
+
+
+def test_saved_tables_load_the_same(tmp_path):
+    paths = [SONG, SONG]
+    tracks, measures = analyse_paths(paths, workers=None)
+    library = str(tmp_path / "set.fretlib")
+    save_difficulty(difficulty_path(library), paths, tracks, measures)
+    loaded_paths, songs, loaded_tracks, loaded_measures = load_difficulty(library)
+    assert loaded_paths == paths
+    # Byte for byte, the tempo columns can be nan.
+    assert loaded_tracks.dtype == tracks.dtype and loaded_tracks.tobytes() == tracks.tobytes()
+    assert loaded_measures.dtype == measures.dtype
+    assert loaded_measures.tobytes() == measures.tobytes()
+    num_tracks = len(tracks) // 2
+    assert songs["first_track"].tolist() == [0, num_tracks]
+    assert songs["notes"].tolist() == [tracks["notes"][:num_tracks].sum()] * 2
+    # Track rows point at their own measures.
+    second = tracks[num_tracks]
+    assert second["first_measure"] == tracks["num_measures"][:num_tracks].sum()
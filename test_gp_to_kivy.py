@@ -0,0 +1,25 @@
+import os
+
+from gp_to_kivy import RETUNINGS_KEPT, KivySongBuilder
+
+SONG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tgr-nm-01-g1.gp5")
+
+
+def test_retuned_tracks_are_bounded_but_keep_the_playing_one():
+    song = KivySongBuilder(SONG)
+    tuning = [value for number, value in song.gp_tunings[0]]
+    lows = [tuning[5] + shift for shift in (-6, -5, -4, -3, -2, -1)]
+    for low in lows:
+        song.apply_tuning(0, tuning[:5] + [low])
+    playing = song.song[0]
+    # Back to an older tuning: the one that was playing stays cached along with the newest.
+    song.apply_tuning(0, tuning[:5] + [lows[0]])
+    cached = [key[1][5] for key in song._retuned_tracks]
+    assert len(cached) <= RETUNINGS_KEPT + 1
+    assert lows[-1] in cached and lows[0] in cached
+    assert song.song[0] is song._retuned_tracks[(0, tuple(tuning[:5] + [lows[0]]), 0, 0)][0]
+
+    # Edits still reach the playing track.
+    song.insert_measures(1, [track_data[0:1] for track_data in song.song_data])
+    assert len(song.song[0]) == len(song.timelines[0]) == len(song.original_song[0])
+    assert len(playing) == len(song.timelines[0])
@@ -0,0 +1,51 @@
+import os
+import threading
+
+from midi_io import MidiInput
+
+
+def test_stop_without_input_ends_the_thread(tmp_path):
+    path = str(tmp_path / "midi")
+    os.mkfifo(path)
+    # Held open for writing (O_RDWR doesn't wait for a reader), so the reader blocks for input.
+    writer = os.open(path, os.O_RDWR)
+    try:
+        changed = threading.Event()
+        frets = []
+        midi_input = MidiInput(path, (64, 59, 55, 50, 45, 40),
+                               lambda new: frets.append(new) or changed.set())
+        open_fds = len(os.listdir("/proc/self/fd"))
+        midi_input.start()
+        os.write(writer, bytes([0x90, 45, 100]))  # Note on, A2.
+        assert changed.wait(2)
+        assert frets[-1] == [None, None, None, None, 0, None]
+        midi_input.stop()
+        assert not midi_input.thread.is_alive()
+        # The device and the wake pipe are closed.
+        assert len(os.listdir("/proc/self/fd")) == open_fds
+    finally:
+        os.close(writer)
+
+
+def test_stop_after_end_of_input(tmp_path):
+    path = str(tmp_path / "take.mid")
+    with open(path, "wb") as file:
+        file.write(bytes([0x90, 45, 100, 0x80, 45, 0]))
+    open_fds = len(os.listdir("/proc/self/fd"))
+    midi_input = MidiInput(path, (64, 59, 55, 50, 45, 40), lambda frets: None)
+    midi_input.start()
+    midi_input.thread.join(2)
+    assert not midi_input.thread.is_alive()
+    midi_input.stop()
+    assert len(os.listdir("/proc/self/fd")) == open_fds
+    midi_input.stop()
+
+
+def test_stop_after_the_device_failed_to_open(tmp_path):
+    open_fds = len(os.listdir("/proc/self/fd"))
+    midi_input = MidiInput(str(tmp_path / "missing"), (64, 59, 55, 50, 45, 40),
+                           lambda frets: None)
+    midi_input.start()
+    midi_input.thread.join(2)
+    midi_input.stop()
+    assert len(os.listdir("/proc/self/fd")) == open_fds
@@ -0,0 +1,75 @@
+import os
+import wave
+import numpy as np
+import pytest
+
+from gp_to_kivy import KivySongBuilder
+from practice import BeatScorer, PitchTracker, midi_frequency, read_chunks, render_take
+from timeline import TrackTimeline
+
+SONG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tgr-nm-01-g1.gp5")
+MEASURES = 24
+SAMPLE_RATE = 22050
+
+
+@pytest.fixture(scope="module")
+def track():
+    '''(first MEASURES measures of track 1, its tuning).'''
+    song = KivySongBuilder(SONG)
+    timeline = song.timelines[0]
+    beats = timeline.measure_starts[MEASURES]
+    short = TrackTimeline(timeline.seconds[:beats], timeline.frets[:beats],
+                          timeline.pitches[:beats], timeline.pc_masks[:beats],
+                          timeline.measure_starts[:MEASURES + 1],
+                          timeline.measure_numbers[:MEASURES], ties=timeline.ties[:beats])
+    return short, [value for number, value in song.gp_tunings[0]]
+
+
+def score(timeline, tuning, path):
+    low, high = min(tuning), max(tuning) + 24
+    sample_rate, chunks = read_chunks(path)
+    tracker = PitchTracker(sample_rate, low, high)
+    scorer = BeatScorer(timeline, tuning, low, high)
+    for samples in chunks:
+        scorer.feed(*tracker.feed(samples))
+    return scorer.result().score
+
+
+def write(path, samples):
+    with wave.open(str(path), "wb") as writer:
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(SAMPLE_RATE)
+        writer.writeframes((np.clip(samples, -1, 1) * 32767).astype("<i2").tobytes())
+
+
+def test_rendered_take_scores_high(track, tmp_path):
+    timeline, tuning = track
+    render_take(timeline, str(tmp_path / "take.wav"), SAMPLE_RATE)
+    assert score(timeline, tuning, str(tmp_path / "take.wav")) > 0.9
+
+
+def test_noise_scores_low(track, tmp_path):
+    timeline, tuning = track
+    samples = np.random.default_rng(0).normal(0, 0.1, int(timeline.length * SAMPLE_RATE))
+    write(tmp_path / "noise.wav", samples)
+    assert score(timeline, tuning, str(tmp_path / "noise.wav")) < 0.05
+
+
+def test_drone_of_every_semitone_scores_low(track, tmp_path):
+    timeline, tuning = track
+    t = np.arange(int(timeline.length * SAMPLE_RATE)) / SAMPLE_RATE
+    samples = sum(np.sin(2 * np.pi * midi_frequency(pitch) * t)
+                  for pitch in range(min(tuning), max(tuning) + 25)) * 0.01
+    write(tmp_path / "drone.wav", samples)
+    assert score(timeline, tuning, str(tmp_path / "drone.wav")) < 0.05
+
+
+def test_wrong_notes_score_low(track, tmp_path):
+    timeline, tuning = track
+    sharp = TrackTimeline(timeline.seconds, timeline.frets,
+                          np.where(timeline.pitches >= 0, timeline.pitches + 1, -1),
+                          timeline.pc_masks, timeline.measure_starts, timeline.measure_numbers,
+                          ties=timeline.ties)
+    render_take(sharp, str(tmp_path / "sharp.wav"), SAMPLE_RATE)
+    assert score(timeline, tuning, str(tmp_path / "sharp.wav")) < 0.05
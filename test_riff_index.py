@@ -0,0 +1,42 @@
+import os
+import numpy as np
+import pytest
+
+from gp_to_kivy import TimelineSong
+from riff_index import RiffIndex, melody
+
+SONG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tgr-nm-01-g1.gp5")
+
+
+@pytest.fixture(scope="module")
+def song():
+    return TimelineSong(SONG)
+
+
+@pytest.fixture
+def index(tmp_path, song):
+    index = RiffIndex(str(tmp_path / "library.riffs"))
+    index.add_song(SONG, song)
+    yield index
+    index.close()
+
+
+def test_search_measures_in_repeated_song(song, index):
+    timeline = song.timelines[0]
+    # The sample song opens with repeats, measure numbers aren't in order.
+    assert list(timeline.measure_numbers[:4]) == [1, 2, 1, 2]
+    results = index.search_measures(timeline, 1, 3)
+    # Timeline measures 1 and 2 are measures 2 and 1, the riff starts in measure 2.
+    path, track, measure, score = results[0]
+    assert (track, measure) == (0, 2)
+    assert score > 0.5
+
+
+def test_search_measures_takes_one_pass_of_a_repeat(song, index):
+    timeline = song.timelines[0]
+    queries = []
+    index.search = lambda pitches, onsets=None, limit=20: queries.append(pitches) or []
+    index.search_measures(timeline, 0, 2)
+    pitches, onsets, beats = melody(timeline)
+    first_pass = pitches[beats < timeline.measure_starts[2]]
+    assert np.array_equal(queries[0], first_pass)
@@ -0,0 +1,18 @@
+import os
+import numpy as np
+
+from gp_to_kivy import KivySongBuilder
+from simulator import LoopedSong, Simulation, VirtualClock, headless_fretboard
+
+SONG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tgr-nm-01-g1.gp5")
+
+
+def test_playback_with_latency_has_no_problems():
+    # Every callback and frame late by 20 ms on average, over the song played twice.
+    rng = np.random.default_rng(0)
+    clock = VirtualClock(60, lambda: rng.exponential(0.02))
+    simulation = Simulation(headless_fretboard(LoopedSong(KivySongBuilder(SONG), 2)), clock).run()
+    assert simulation.problems == []
+    # The latency was really there: every event fired, some of them late.
+    assert len(simulation.fired) == len(simulation.events.times)
+    assert simulation.lateness().max() > 0
@@ -0,0 +1,116 @@
+import numpy as np
+
+
+class TrackTimeline:
+    '''Array form of one track of KivySongBuilder.song, for analysis and fast lookups.
+
+    Built from a track of song_data so measures (including repeats) are kept.  N beats, M
+    measures:
+
+        seconds:  (N,)   beat lengths in seconds
+        onsets:   (N,)   beat start times in seconds
+        frets:    (N, 6) fret per string (index 0 is string 1), -1 where the string isn't played
+        pitches:  (N, 6) MIDI note number per string, -1 where the string isn't played
+        pc_masks: (N,)   12-bit pitch class mask of each beat (see music_theory.pc_bits)
+        measure_starts:  (M+1,) index of the first beat of each measure, last entry == N
+        measure_numbers: (M,)   MeasureHeader.number of each measure
+        ties:     (N, 6) True where the string's note is a tie, carrying on the note before it
+                  rather than struck again (all False if not given)
+    '''
+    def __init__(self, seconds, frets, pitches, pc_masks, measure_starts, measure_numbers,
+                 onsets=None, ties=None):
+        self.seconds = seconds
+        self.frets = frets
+        self.pitches = pitches
+        self.pc_masks = pc_masks
+        self.measure_starts = measure_starts
+        self.measure_numbers = measure_numbers
+        self.onsets = np.cumsum(seconds) - seconds if onsets is None else onsets
+        self.ties = np.zeros(frets.shape, dtype=bool) if ties is None else ties
+
+    @classmethod
+    def from_track_data(cls, track_data):
+        seconds, frets, pitches, pc_masks, ties = [], [], [], [], []
+        measure_starts, measure_numbers = [0], []
+        for measure in track_data:
+            header = measure[0]
+            for beat in measure[1:]:
+                seconds.append(beat.seconds)
+                frets.append([-1 if f is None else f for f in beat.frets])
+                pitches.append([-1 if p is None else p for p in beat.pitches])
+                pc_masks.append(beat.pc_mask)
+                ties.append(beat.ties or [False] * 6)
+            measure_starts.append(len(seconds))
+            measure_numbers.append(header.number)
+        return cls(np.array(seconds, dtype=np.float64),
+                   np.array(frets, dtype=np.int8).reshape(-1, 6),
+                   np.array(pitches, dtype=np.int16).reshape(-1, 6),
+                   np.array(pc_masks, dtype=np.uint16),
+                   np.array(measure_starts, dtype=np.intp),
+                   np.array(measure_numbers, dtype=np.intp),
+                   ties=np.array(ties, dtype=bool).reshape(-1, 6))
+
+    def splice(self, start, stop, other):
+        '''New timeline with measures [start, stop) replaced by all of other's measures.
+
+        Only the arrays are copied, onsets and measure starts after the edit are shifted
+        rather than summed again.
+        '''
+        b0, b1 = self.measure_starts[start], self.measure_starts[stop]
+        shift = other.length - float(self.seconds[b0:b1].sum())
+        onset = self.onsets[b0] if b0 < len(self) else self.length
+
+        def join(before, inserted, after):
+            return np.concatenate((before[:b0], inserted, after[b1:]))
+        return TrackTimeline(
+            join(self.seconds, other.seconds, self.seconds),
+            join(self.frets, other.frets, self.frets),
+            join(self.pitches, other.pitches, self.pitches),
+            join(self.pc_masks, other.pc_masks, self.pc_masks),
+            np.concatenate((self.measure_starts[:start], other.measure_starts[:-1] + b0,
+                            self.measure_starts[stop:] + len(other) - (b1 - b0))),
+            np.concatenate((self.measure_numbers[:start], other.measure_numbers,
+                            self.measure_numbers[stop:])),
+            np.concatenate((self.onsets[:b0], other.onsets + onset, self.onsets[b1:] + shift)),
+            join(self.ties, other.ties, self.ties))
+
+    def __len__(self):
+        return len(self.seconds)
+
+    @property
+    def num_measures(self):
+        return len(self.measure_numbers)
+
+    @property
+    def length(self):
+        return float(self.seconds.sum())
+
+    @property
+    def measure_onsets(self):
+        '''(M+1,) start time of each measure, last entry is the end of the track.'''
+        return np.append(self.onsets, self.length)[self.measure_starts]
+
+    @property
+    def beat_measures(self):
+        '''(N,) measure index of each beat.'''
+        return np.repeat(np.arange(self.num_measures), np.diff(self.measure_starts))
+
+    @property
+    def measure_pc_masks(self):
+        '''(M,) 12-bit pitch class mask of each measure, 0 for empty measures.'''
+        masks = np.zeros(self.num_measures, dtype=self.pc_masks.dtype)
+        filled = np.flatnonzero(np.diff(self.measure_starts))
+        if len(filled):
+            masks[filled] = np.bitwise_or.reduceat(self.pc_masks,
+                                                   self.measure_starts[filled])
+        return masks
+
+    @property
+    def bass_pitches(self):
+        '''(N,) lowest pitch of each beat, -1 for rests.'''
+        lowest = np.where(self.pitches >= 0, self.pitches, 1 << 14).min(axis=1)
+        return np.where(lowest < (1 << 14), lowest, -1)
+
+    def beat_at(self, seconds):
+        '''Index of the beat sounding at time seconds (scalar or array).'''
+        return np.searchsorted(self.onsets, seconds, side='right') - 1